@@ -1,312 +1,406 @@
 from fastapi import (
     APIRouter,
-    UploadFile,
-    File,
+    Header,
     HTTPException,
     Query,
-    BackgroundTasks,
+    Request,
 )
-import os
-import openai
-from typing import Union
-
-from fastapi.responses import JSONResponse
-import tempfile
-from app.util.logger import get_logger
-from app.services.model import Transcriber as tc
-from app.services.model import MinutesSummarizer as ms
+from fastapi.responses import StreamingResponse
+import asyncio
 import json
+import os
 import time
+import uuid
+from typing import AsyncIterator, Union
 
-import requests
+from fastapi.concurrency import run_in_threadpool
 
+from app.util.logger import get_logger
+from app.services.admission import AdmissionRejected, admission
+from app.services.model import Transcriber as tc
+from app.services.job_queue import TERMINAL_EVENTS, job_queue
+from app.services.upload import (
+    MultipartUpload,
+    UnsupportedUpload,
+    UploadWriter,
+    file_sha256,
+    upload_store,
+)
+from app.util.metrics import AUDIO_DURATION_BUCKETS, metrics
 
-import torch
-from app.util.split_audio import split_audio_voiced
+from app.core.config import settings
 
-torch.set_num_threads(1)
 logger = get_logger(__name__)
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
-slack_token = os.getenv("slack_token")
-# Slack Webhook URL
-WEBHOOK_URL = os.getenv("WEBHOOK_URL")
-
 api_router = APIRouter()
 
 
-async def execute_summarize(
-    upload_file: UploadFile = File(...),
-    prompt: Union[str, None] = Query(default=None),
-    response_format: Union[str, None] = Query(
-        default="text", enum=["text", "vtt", "srt", "verbose_json", "json"]
-    ),
-):
-    # 一時ファイルの作成
-    _, file_extension = os.path.splitext(upload_file.filename)
-    with tempfile.NamedTemporaryFile(
-        delete=False, suffix=file_extension
-    ) as input_tempfile:
-        for chunk in upload_file.file:
-            input_tempfile.write(chunk)
-        input_tempfile.flush()
+async def spool_upload(writer: UploadWriter, chunks: AsyncIterator[bytes]) -> None:
+    """
+    アップロードを大きなバッファ単位でファイルに書き出す
+    先頭で形式や長さが不正と分かれば、残りを読まずにUnsupportedUploadを送出する
+    """
+    try:
+        async for data in chunks:
+            await writer.write(data)
+    finally:
+        await writer.close()
 
-    logger.info(type(input_tempfile))
 
-    # 有効なファイルかチェック
-    if not tc.is_acceptable_file(input_tempfile.name):
-        raise HTTPException(status_code=400, detail="Unsupported file type")
+def too_many_requests(e: AdmissionRejected) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
 
+async def precheck_admission() -> None:
+    """アップロードの本体を読む前に、混雑していれば断る"""
+    try:
+        await run_in_threadpool(admission.precheck)
+    except AdmissionRejected as e:
+        raise too_many_requests(e)
+
+
+async def probe_duration(input_path: str) -> float:
+    """
+    ffprobeで長さを調べる。ヘッダの長さはクライアントが書き換えられるので、
+    残りを受け取る前に断るためだけに使い、受付の判断やジョブの長さには使わない
+    読めない場合と4時間以上の場合はValueErrorを送出する
+    """
+    try:
+        with metrics.span("probe"):
+            duration = await run_in_threadpool(tc.get_audio_duration, input_path)
+    except Exception:
+        raise ValueError("Unsupported file type")
     # 4時間以上のファイルはエラー
-    duration = tc.get_audio_duration(input_tempfile.name)
-    if duration > 4 * 60 * 60 + 60:
-        raise HTTPException(
-            status_code=400, detail="Too long audio file. (max 4 hours)"
-        )
-    # videoであれば音声を抽出
-    if tc.is_video_file(input_tempfile.name):
-        logger.info("Extracting audio from video")
-        input_tempfile = tc.extract_audio_from_video(input_tempfile)
-        logger.info(f"Extracted audio size: {os.path.getsize(input_tempfile.name)}")
-
-    # VADで無音区間を削除
-    logger.info("Removing silent parts")
-    model, utils = torch.hub.load("/silero-vad/", model="silero_vad", source="local")
-    (get_speech_timestamps, save_audio, read_audio, VADIterator, collect_chunks) = utils
-
-    SAMPLING_RATE = 16000
-    wav = read_audio(
-        input_tempfile.name,
-        sampling_rate=SAMPLING_RATE,
+    if duration > settings.MAX_AUDIO_SECONDS:
+        raise ValueError("Too long audio file. (max 4 hours)")
+    metrics.observe("minutes_audio_duration_seconds", duration, AUDIO_DURATION_BUCKETS)
+    return duration
+
+
+async def enqueue_upload(
+    job_id: str,
+    filename: str,
+    input_path: str,
+    content_hash: str,
+    duration: float,
+    prompt: Union[str, None],
+    response_format: Union[str, None],
+) -> dict:
+    await run_in_threadpool(
+        job_queue.enqueue,
+        filename=filename,
+        input_path=input_path,
+        content_hash=content_hash,
+        prompt=prompt,
+        response_format=response_format,
+        duration=duration,
+        job_id=job_id,
     )
-    # get speech timestamps from full audio file
-    speech_timestamps = get_speech_timestamps(wav, model, sampling_rate=SAMPLING_RATE)
-
-    split_audio_voiced_data = split_audio_voiced(wav, speech_timestamps)
-
-    transcript = ""
-    for segment in split_audio_voiced_data:
-        # merge all speech chunks to one audio
-        with tempfile.NamedTemporaryFile(
-            delete=False, suffix=".wav"
-        ) as output_tempfile:
-            save_audio(
-                output_tempfile.name,
-                collect_chunks(segment["voiced_segments"], wav),
-                sampling_rate=SAMPLING_RATE,
-            )
 
-        # whisper APIの25MB制限に対応するために圧縮
-        if os.path.getsize(output_tempfile.name) > 25000000:
-            compressed_file = tc.compress_audio(output_tempfile)
-        else:
-            compressed_file = output_tempfile
-
-        # 一時ファイルを使用してtranscribeを実行
-        chunk_transcript = openai.Audio.transcribe(
-            "whisper-1",
-            open(compressed_file.name, "rb"),
-            prompt=prompt,
-            response_format=response_format,
-            temperature=0,
-            language="ja",
-        )
-        transcript += chunk_transcript
+    return {
+        "status": "success",
+        "message": "Message processed successfully.",
+        "job_id": job_id,
+    }
 
-        os.remove(compressed_file.name)  # Manually delete the temporary file
 
-    os.remove(input_tempfile.name)  # Manually delete the temporary file
-    whisper_cost = duration * 0.006 / 60
-    logger.info(f"Whisper cost: {whisper_cost} $")
+def get_input_path(job_id: str, filename: str) -> str:
+    _, file_extension = os.path.splitext(filename)
+    os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+    return os.path.join(settings.UPLOAD_DIR, f"{job_id}{file_extension}")
 
-    total_costs = 0
 
-    # chunk毎に要約を作成
-    response_messages, map_costs = ms.map_sammaries(transcript)
-    total_costs += map_costs
+# 本体はStarletteのフォームの解析を通さずに読むので、ドキュメント用にスキーマを書く
+SUMMARIZE_REQUEST_BODY = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "properties": {"upload_file": {"type": "string", "format": "binary"}},
+                "required": ["upload_file"],
+            }
+        }
+    },
+}
 
-    logger.info(f"total costs map: {total_costs}")
-    logger.info(f"response_messages: {response_messages}")
 
-    doc_summaries: list = response_messages
+@api_router.post("/summarize", openapi_extra={"requestBody": SUMMARIZE_REQUEST_BODY})
+async def summarize(
+    request: Request,
+    prompt: Union[str, None] = Query(default=None),
+    response_format: Union[str, None] = Query(
+        default="text", enum=["text", "vtt", "srt", "verbose_json", "json"]
+    ),
+):
+    """
+    multipart/form-dataのupload_fileを受け取ってジョブにする
+    本体は受信しながら読むので、混雑している場合・ファイル名や先頭が不正な場合は
+    残りを受信する前に断る
+    """
+    await precheck_admission()
+    try:
+        multipart = MultipartUpload(
+            request.headers.get("content-type", ""), "upload_file"
+        )
+        chunks = request.stream()
+        filename = await multipart.read_filename(chunks)
+    except UnsupportedUpload as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # 有効なファイルかチェック
+    if not tc.is_acceptable_file(filename):
+        raise HTTPException(status_code=400, detail="Unsupported file type")
 
-    output = dict()
+    # ワーカーが読めるようにアップロードをスプールに保存する
+    # 書き込みながら内容のハッシュを計算し、キャッシュのキーにする
+    # ファイルの読み書きやffprobeはイベントループを止めないようにスレッドで行う
+    job_id = uuid.uuid4().hex
+    input_path = get_input_path(job_id, filename)
+    writer = await run_in_threadpool(UploadWriter, input_path, filename)
+    try:
+        with metrics.span("upload"):
+            await spool_upload(writer, multipart.iter_file(chunks))
+        writer.ensure_header()
+    except UnsupportedUpload as e:
+        os.remove(input_path)
+        raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        os.remove(input_path)
+        raise
+    logger.info(f"upload saved: {input_path} sha256: {writer.content_hash}")
+
+    try:
+        duration = await probe_duration(input_path)
+        # 長さと見積もりの料金で、受け付けるかを決める
+        estimate = await run_in_threadpool(admission.admit, duration)
+    except ValueError as e:
+        os.remove(input_path)
+        raise HTTPException(status_code=400, detail=str(e))
+    except AdmissionRejected as e:
+        os.remove(input_path)
+        raise too_many_requests(e)
+    except BaseException:
+        # ジョブキューのSQLiteがロックされている場合等も、アップロードを残さない
+        os.remove(input_path)
+        raise
+    try:
+        return await enqueue_upload(
+            job_id,
+            filename,
+            input_path,
+            writer.content_hash,
+            duration,
+            prompt,
+            response_format,
+        )
+    except BaseException:
+        os.remove(input_path)
+        raise
+    finally:
+        admission.release(estimate)
+
+
+def upload_status(meta: dict) -> dict:
+    return {
+        "upload_id": meta["upload_id"],
+        "filename": meta["filename"],
+        "size": meta["size"],
+        "offset": meta["offset"],
+    }
 
-    # TPM制限に当たらないように1分待つ
-    time.sleep(60)
 
-    def get_simple_summary(doc_summaries: list):
-        response, costs = ms.get_simple_summary(doc_summaries)
-        logger.info(f"chat create: {response}")
-        return response, costs
+async def get_upload_or_404(upload_id: str) -> dict:
+    meta = await run_in_threadpool(upload_store.get, upload_id)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return meta
 
-    simple_summary_response, simple_summary_costs = get_simple_summary(doc_summaries)
-    response_message = simple_summary_response["choices"][0]["message"]
-    # Step 2: check if GPT wanted to call a function
-    if response_message.get("function_call"):
-        # Step 3: call the function
-        # Note: the JSON response may not always be valid; be sure to handle errors
-        try:
-            function_args = json.loads(response_message["function_call"]["arguments"])
-        except Exception as e:
-            logger.error(f"Error parsing function arguments: {e}")
-            function_args = None
-        simple_summary = function_args
-    else:
-        simple_summary = None
-
-    output["simple_summary"] = simple_summary
-    output["doc_summaries"] = doc_summaries
-    output["transcript"] = transcript
-    # 結果を加工
-    total_tokens = 0
-    prompt_tokens = 0
-    completion_tokens = 0
-
-    total_tokens += simple_summary_response["usage"]["total_tokens"]
-    prompt_tokens += simple_summary_response["usage"]["prompt_tokens"]
-    completion_tokens += simple_summary_response["usage"]["completion_tokens"]
-    logger.info(f"total tokens: {total_tokens}")
-
-    # gpt-4
-    logger.info(f"Whisper cost: {whisper_cost} $")
-    logger.info(f"map cost: {map_costs} $")
-    logger.info(f"simple summary cost: {simple_summary_costs} $")
-    logger.info(f"GPT cost: {map_costs+simple_summary_costs} $")
-    logger.info(f"Total cost: {whisper_cost + map_costs+simple_summary_costs} $")
-
-    # Slack通知のブロックを作成
-    blocks = []
-
-    # Header
-    blocks.append(
-        {
-            "type": "header",
-            "text": {
-                "type": "plain_text",
-                "text": f"{upload_file.filename}",
-                "emoji": True,
-            },
-        }
-    )
 
-    # Summary
-    blocks.append(
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": f"*Summary:* {output['simple_summary']['summary']}",
-            },
-        }
-    )
-
-    # Bullet Points
-    bullet_points_text = "\n".join(
-        [f"• {point}" for point in output["simple_summary"]["summary_bullet"]]
-    )
-    blocks.append(
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": f"*Bullet Points:*\n{bullet_points_text}",
-            },
-        }
-    )
-
-    # Decisions
-    decisions_text = "\n".join(
-        [f"• {decision}" for decision in output["simple_summary"]["decisions"]]
-    )
-    blocks.append(
-        {
-            "type": "section",
-            "text": {"type": "mrkdwn", "text": f"*Decisions:*\n{decisions_text}"},
-        }
-    )
+@api_router.post("/uploads")
+async def create_upload(
+    filename: str = Query(...),
+    size: Union[int, None] = Query(default=None),
+):
+    """
+    数GBの録音を分割して送るための再開可能なアップロードを作成する
+    PUT /uploads/{upload_id}?offset=... で本体を送り、completeでジョブにする
+    """
+    if not tc.is_acceptable_file(filename):
+        raise HTTPException(status_code=400, detail="Unsupported file type")
+    await precheck_admission()
+    meta = await run_in_threadpool(upload_store.create, filename, size)
+    return upload_status(meta)
 
-    # Tasks
-    tasks_text = "\n".join([f"• {task}" for task in output["simple_summary"]["tasks"]])
-    blocks.append(
-        {
-            "type": "section",
-            "text": {"type": "mrkdwn", "text": f"*Tasks:*\n{tasks_text}"},
-        }
-    )
 
-    # Long Summary
-    long_summary_text = "\n".join(
-        [f"• {summary}" for summary in output["doc_summaries"]]
-    )
-    blocks.append(
-        {
-            "type": "section",
-            "text": {"type": "mrkdwn", "text": f"*Long Summary:*\n{long_summary_text}"},
-        }
-    )
+@api_router.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    """切断された場合は、ここで返すoffsetから送り直す"""
+    return upload_status(await get_upload_or_404(upload_id))
 
-    # Transcriptはスニペットとして表示
-    content = output["transcript"]
-
-    # ファイルをアップロード
-    response = requests.post(
-        "https://slack.com/api/files.upload",
-        headers={"Authorization": "Bearer " + slack_token},
-        data={
-            "channels": "C05TS2WLS74",  # アップロードするチャンネルのID
-            "filename": f"transcript_{upload_file.filename}.txt",
-            "filetype": "text",
-            "content": content,
-        },
-    )
-    logger.info(response.json())
-
-    # レスポンスからファイルのURLを取得
-    file_url = response.json().get("file").get("url_private")
-    blocks.append(
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": f"*Transcript:*\n<{file_url}|transcript.txt>",
-            },
-        }
-    )
 
-    # JSONデータを作成
-    json_data = {
-        "username": "ボイスレコーダーくん",
-        "icon_emoji": ":star2:",
-        "blocks": blocks,
-    }
+async def save_upload_header(meta: dict, writer: UploadWriter) -> None:
+    """先頭を確認できたら保存し、続きの送信やcompleteで読み直さないようにする"""
+    if writer.header is not None and meta["header"] is None:
+        meta["header"] = writer.header
+        await run_in_threadpool(upload_store.save_meta, meta)
 
-    # HTTP POSTリクエストを送信
-    response = requests.post(
-        WEBHOOK_URL,
-        data=json.dumps(json_data),
-        headers={"Content-Type": "application/json"},
-    )
 
-    # 応答を確認
-    if response.status_code != 200:
-        raise ValueError(
-            f"Request to slack returned an error {response.status_code}, the response is:\n{response.text}"
+@api_router.put("/uploads/{upload_id}")
+async def put_upload(upload_id: str, request: Request, offset: int = Query(...)):
+    meta = await get_upload_or_404(upload_id)
+    if offset != meta["offset"]:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Offset mismatch. (expected {meta['offset']})",
         )
 
-    # 成功したことをステータスコード200で返す
-    return JSONResponse(content=output, status_code=200)
-
-
-@api_router.post("/summarize")
-async def summarize(
-    background_tasks: BackgroundTasks,
-    upload_file: UploadFile = File(...),
+    # 宣言されたサイズを超えた時点で、残りを読まずに断る
+    writer = await run_in_threadpool(upload_store.open_writer, meta, offset)
+    try:
+        # 切断された場合も、受け取った分は書き出して続きから再開できるようにする
+        with metrics.span("upload"):
+            await spool_upload(writer, request.stream())
+    except UnsupportedUpload as e:
+        await run_in_threadpool(upload_store.remove, upload_id)
+        raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        await save_upload_header(meta, writer)
+        raise
+
+    await save_upload_header(meta, writer)
+    meta["offset"] = writer.offset
+    return upload_status(meta)
+
+
+@api_router.post("/uploads/{upload_id}/complete")
+async def complete_upload(
+    upload_id: str,
     prompt: Union[str, None] = Query(default=None),
     response_format: Union[str, None] = Query(
         default="text", enum=["text", "vtt", "srt", "verbose_json", "json"]
     ),
 ):
-    background_tasks.add_task(execute_summarize, upload_file, prompt, response_format)
+    meta = await get_upload_or_404(upload_id)
+    if meta["size"] is not None and meta["offset"] != meta["size"]:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Upload is incomplete. ({meta['offset']}/{meta['size']} bytes)",
+        )
 
-    return {"status": "success", "message": "Message processed successfully."}
+    if not meta["header"]:
+        # 先頭の確認に足りない短いファイル
+        writer = await run_in_threadpool(upload_store.open_writer, meta, meta["offset"])
+        await writer.close()
+        try:
+            writer.ensure_header()
+        except UnsupportedUpload as e:
+            await run_in_threadpool(upload_store.remove, upload_id)
+            raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        duration = await probe_duration(upload_store.data_path(upload_id))
+    except ValueError as e:
+        await run_in_threadpool(upload_store.remove, upload_id)
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # 混雑している場合はアップロードを残したまま断り、後でcompleteだけ送り直してもらう
+    try:
+        estimate = await run_in_threadpool(admission.admit, duration)
+    except AdmissionRejected as e:
+        raise too_many_requests(e)
+    try:
+        job_id = uuid.uuid4().hex
+        input_path = get_input_path(job_id, meta["filename"])
+        await run_in_threadpool(upload_store.finish, upload_id, input_path)
+        try:
+            content_hash = await run_in_threadpool(file_sha256, input_path)
+            logger.info(f"upload saved: {input_path} sha256: {content_hash}")
+
+            return await enqueue_upload(
+                job_id,
+                meta["filename"],
+                input_path,
+                content_hash,
+                duration,
+                prompt,
+                response_format,
+            )
+        except BaseException:
+            # アップロードは移動済みなので、ジョブにならなかった入力を残さない
+            os.remove(input_path)
+            raise
+    finally:
+        admission.release(estimate)
+
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await run_in_threadpool(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "filename": job["filename"],
+        "progress": job["progress"],
+        "result": job["result"],
+        "error": job["error"],
+        "attempts": job["attempts"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
+
+
+def format_event(event: dict) -> str:
+    data = {**event["data"], "time": event["created_at"]}
+    return (
+        f"id: {event['id']}\n"
+        f"event: {event['type']}\n"
+        f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    )
+
+
+@api_router.get("/jobs/{job_id}/events")
+async def get_job_events(
+    job_id: str,
+    request: Request,
+    last_event_id: Union[int, None] = Header(default=None),
+):
+    """
+    ジョブの途中結果をServer-Sent Eventsで流す
+    vad, transcript(チャンク毎), transcript_done, summary(チャンク毎), simple_summary,
+    最後にsucceededかfailedを送って終了する。再接続時はLast-Event-IDの続きから送る
+    """
+    job = await run_in_threadpool(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def stream_events() -> AsyncIterator[str]:
+        after_id = last_event_id or 0
+        last_sent = time.monotonic()
+        while not await request.is_disconnected():
+            events = await run_in_threadpool(job_queue.get_events, job_id, after_id)
+            for event in events:
+                yield format_event(event)
+                after_id = event["id"]
+                if event["type"] in TERMINAL_EVENTS:
+                    return
+            if events:
+                last_sent = time.monotonic()
+                continue
+            # プロキシに切断されないように、イベントがなくてもコメントを送る
+            if time.monotonic() - last_sent > settings.JOB_EVENTS_KEEPALIVE_SECONDS:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            await asyncio.sleep(settings.JOB_EVENTS_POLL_SECONDS)
+
+    return StreamingResponse(
+        stream_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,36 @@
+import time
+
+from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
+
+from app.services.job_queue import job_queue
+from app.util.metrics import metrics
+
+metrics_router = APIRouter()
+
+
+def render_metrics() -> str:
+    # キューの状態はスクレイプ時にジョブのテーブルから数える
+    stats = job_queue.stats()
+    oldest_queued_at = stats["oldest_queued_at"]
+    gauges = {
+        "minutes_jobs": [
+            ({"status": status}, count) for status, count in stats["counts"].items()
+        ],
+        "minutes_oldest_queued_job_age_seconds": [
+            ({}, time.time() - oldest_queued_at if oldest_queued_at else 0)
+        ],
+    }
+    return metrics.render(gauges)
+
+
+@metrics_router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> PlainTextResponse:
+    """
+    Prometheusのテキスト形式でメトリクスを返す
+    """
+    return PlainTextResponse(
+        await run_in_threadpool(render_metrics),
+        media_type="text/plain; version=0.0.4",
+    )
@@ -5,6 +5,134 @@ class Settings(BaseSettings):
     PROJECT_NAME: str = "minutes_generator"
     API_V1_STR: str = "/api/v1"
 
+    # 4時間以上のファイルはエラー
+    MAX_AUDIO_SECONDS: int = 4 * 60 * 60 + 60
+
+    # Silero VAD
+    VAD_REPO_DIR: str = "/silero-vad/"
+    # 同時に処理できるジョブ数分のモデルをロードする
+    VAD_POOL_SIZE: int = 1
+    VAD_SAMPLING_RATE: int = 16000
+    # Trueの場合、音声全体をデコードせずにストリームでVADを行う
+    VAD_STREAMING: bool = False
+    # ストリーム処理で一度にffmpegから読むフレームの長さ(秒)
+    VAD_FRAME_SECONDS: int = 30
+    # 1以上の場合、音声をこの数の区間に分けてバッチで推論する(0は逐次)
+    VAD_BATCH_SHARDS: int = 0
+    # 区間の境界の前で、状態を温めるために余分に推論する長さ(秒)
+    VAD_BATCH_CONTEXT_SECONDS: float = 4.0
+    # バッチ推論で使うtorchのスレッド数(0はCPU数をワーカーのスレッドで分けた数)
+    VAD_BATCH_THREADS: int = 0
+
+    # whisperに同時に投げるチャンク数
+    # ローカルのスタブに向ける場合はOPENAI_API_BASEを設定する
+    WHISPER_CONCURRENCY: int = 4
+    # 文字起こしのチャンクの分け方("balanced" or "greedy")
+    # balancedは無音の長い位置で、チャンクの長さが揃うように切る
+    CHUNK_PLANNER: str = "balanced"
+    # チャンクの目安の長さ(秒)と数(0の場合は長さから決める)
+    CHUNK_TARGET_SECONDS: int = 300
+    CHUNK_COUNT: int = 0
+    # これより長い音声区間は音量の小さい位置で分割する(秒)
+    CHUNK_SEGMENT_MAX_SECONDS: int = 60
+    # 境界を理想の位置からずらしてよい幅(チャンクの長さに対する割合)
+    CHUNK_BALANCE_TOLERANCE: float = 0.1
+    # whisperに送るチャンクのコーデック("flac" or "opus")
+    # flacで上限を超えそうなチャンクはopusにする
+    CHUNK_CODEC: str = "flac"
+    # opusのビットレートの上限(kbps)。音声認識にはこれで十分
+    OPUS_MAX_BITRATE_KBPS: int = 32
+    # チャンク毎の要約を同時に投げる数
+    MAP_CONCURRENCY: int = 4
+    # 要約に使うモデル(MinutesSummarizer.PROFILESのキー)
+    SUMMARY_MAP_MODEL: str = "gpt-4-0613"
+    SUMMARY_REDUCE_MODEL: str = "gpt-4-0613"
+    # 文字起こしが1回で収まる場合に、mapを省いて直接要約するモデル(空の場合は常にmapを行う)
+    SUMMARY_SINGLE_PASS_MODEL: str = "gpt-4-1106-preview"
+    # single passにする文字起こしのトークン数の上限
+    SUMMARY_SINGLE_PASS_MAX_INPUT_TOKENS: int = 32000
+    # OpenAI APIの一時的なエラーのリトライ回数と初回の待ち時間(秒)
+    OPENAI_MAX_RETRIES: int = 3
+    OPENAI_RETRY_BACKOFF: float = 2.0
+    # モデル毎のレート制限(1分あたり)。RATE_LIMIT_DB_PATHで全ワーカーのジョブで共有する
+    OPENAI_TPM: int = 10000
+    OPENAI_RPM: int = 500
+    WHISPER_RPM: int = 50
+    # レート制限の残りを置くSQLite。空の場合はワーカープロセス毎に制限する
+    RATE_LIMIT_DB_PATH: str = "/tmp/minutes-generator/rate_limit.sqlite3"
+
+    # 同じ音声の再アップロード時に使う結果のキャッシュ
+    CACHE_ENABLED: bool = True
+    CACHE_DIR: str = "/tmp/minutes-generator/cache"
+    CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+
+    # 失敗したジョブを途中から再開するためのチェックポイント
+    CHECKPOINT_DIR: str = "/tmp/minutes-generator/jobs"
+    CHECKPOINT_TTL_SECONDS: int = 24 * 60 * 60
+
+    # ジョブキュー
+    JOB_DB_PATH: str = "/tmp/minutes-generator/jobs.sqlite3"
+    # アップロードされたファイルをワーカーに渡すまで置いておく場所
+    UPLOAD_DIR: str = "/tmp/minutes-generator/uploads"
+    # アップロードを書き出すバッファのサイズと、形式の確認に使う先頭のバイト数
+    UPLOAD_BUFFER_BYTES: int = 8 * 1024 * 1024
+    UPLOAD_SNIFF_BYTES: int = 1024 * 1024
+    # 完了しないまま残った再開可能なアップロードを削除するまでの秒数
+    UPLOAD_TTL_SECONDS: int = 86400
+    # /jobs/{job_id}/eventsでイベントを確認する間隔と、keepaliveを送る間隔(秒)
+    JOB_EVENTS_POLL_SECONDS: float = 1.0
+    JOB_EVENTS_KEEPALIVE_SECONDS: float = 15.0
+    # 終わったジョブのイベントを削除するまでの秒数
+    JOB_EVENTS_TTL_SECONDS: int = 86400
+    # /metricsで公開するメトリクス。プロセス間で共有するためSQLiteに記録する
+    METRICS_ENABLED: bool = True
+    METRICS_DB_PATH: str = "/tmp/minutes-generator/metrics.sqlite3"
+    # メトリクスをメモリからSQLiteに書き込む間隔(秒)
+    METRICS_FLUSH_SECONDS: float = 1.0
+    # Slack APIの向き先(ベンチマークではローカルのスタブに向ける)
+    SLACK_API_BASE: str = "https://slack.com/api"
+    # 文字起こしをアップロードするチャンネルのID
+    SLACK_CHANNEL: str = "C05TS2WLS74"
+    # Slackへの通知を積むoutbox。ワーカーのsupervisorが別に送る
+    SLACK_OUTBOX_DB_PATH: str = "/tmp/minutes-generator/slack.sqlite3"
+    # 送信の試行回数と、再送の初回の待ち時間・待ち時間の上限(秒)
+    SLACK_MAX_ATTEMPTS: int = 8
+    SLACK_RETRY_BACKOFF: float = 5.0
+    SLACK_RETRY_MAX_BACKOFF: float = 600.0
+    # 同時に送る通知の数(接続プールの大きさ)と、1回の送信のタイムアウト(秒)
+    SLACK_CONCURRENCY: int = 4
+    SLACK_TIMEOUT_SECONDS: float = 30.0
+    # outboxを確認する間隔(秒)
+    SLACK_POLL_SECONDS: float = 2.0
+
+    # 受付の制限。待ち・実行中のジョブの合計がどれかの上限を超える場合は429を返す
+    # 0以下の上限は使わない
+    ADMISSION_ENABLED: bool = True
+    ADMISSION_MAX_ACTIVE_JOBS: int = 20
+    ADMISSION_MAX_QUEUED_AUDIO_HOURS: float = 12.0
+    ADMISSION_MAX_QUEUED_COST_DOLLARS: float = 0
+    # 見積もりに使う、音声1秒あたりの文字起こしのトークン数と処理時間(秒)
+    ADMISSION_TOKENS_PER_AUDIO_SECOND: float = 6.0
+    ADMISSION_SECONDS_PER_AUDIO_SECOND: float = 0.1
+    # 429で返すRetry-Afterの範囲(秒)
+    ADMISSION_MIN_RETRY_AFTER: int = 5
+    ADMISSION_MAX_RETRY_AFTER: int = 900
+
+    # ワーカープロセス数
+    WORKER_PROCESSES: int = 1
+    # Trueの場合、ワーカーはVADモデル等の読み込みを待たずにジョブの取得を始める
+    FAST_START: bool = False
+    JOB_MAX_ATTEMPTS: int = 3
+    # この秒数ハートビートがない実行中のジョブは待ちに戻す
+    JOB_STALE_SECONDS: int = 10 * 60
+    WORKER_POLL_SECONDS: float = 1.0
+    # デコード・VAD・エンコードを実行するスレッド数
+    CPU_EXECUTOR_WORKERS: int = 2
+    # ジョブの中間データを置くディレクトリ。空の場合は/dev/shmがあればそこを使う
+    WORKSPACE_DIR: str = ""
+    # 1回のジョブで書ける中間データのバイト数(4時間の音声で約1.2GB)
+    WORKSPACE_QUOTA_BYTES: int = 2 * 1024 * 1024 * 1024
+
     class Config:
         # 環境変数のキーの大文字小文字を区別するかどうかを制御します。
         # Trueの場合、環境変数のキーは大文字小文字を区別します。
@@ -2,7 +2,12 @@ from fastapi import FastAPI
 
 from app.api.api import api_router
 from app.api.heartbeat import heartbeat_router
+from app.api.metrics import metrics_router
 from app.core.config import settings
+from app.services.job_queue import job_queue
+from app.util.logger import get_logger
+
+logger = get_logger(__name__)
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
@@ -10,7 +15,17 @@ app = FastAPI(
     version="0.1.0",
 )
 
+
+@app.on_event("startup")
+def initialize_job_queue() -> None:
+    # 重い処理はapp.workerのワーカープロセスで行う
+    # VADモデルのロードもワーカーの起動時に行う
+    job_queue.initialize()
+    logger.info(f"job queue: {job_queue.db_path}")
+
+
 app.include_router(heartbeat_router)
+app.include_router(metrics_router)
 app.include_router(api_router, prefix=settings.API_V1_STR, tags=["API"])
 
 if __name__ == "__main__":
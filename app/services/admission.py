@@ -0,0 +1,159 @@
+import math
+import threading
+import time
+from typing import List, NamedTuple
+
+from app.core.config import settings
+from app.services.job_queue import RUNNING, job_queue
+from app.services.model import MinutesSummarizer
+from app.util.logger import get_logger
+from app.util.metrics import metrics
+
+logger = get_logger(__name__)
+
+# whisperの料金(ドル/分)
+WHISPER_DOLLARS_PER_MINUTE = 0.006
+
+
+class JobEstimate(NamedTuple):
+    audio_seconds: float
+    # 文字起こしのトークン数の見積もり
+    tokens: int
+    cost_dollars: float
+    # ワーカー1つで処理する時間の見積もり(秒)
+    processing_seconds: float
+
+
+def estimate_job(duration: float) -> JobEstimate:
+    """
+    音声の長さから、文字起こしのトークン数・料金・処理時間を見積もる
+    mapは文字起こし全体を入力し、出力は合計でMAX_TOKENS以内になる
+    reduceは最大でMAX_TOKENSを入力し、REDUCE_OUTPUT_TOKENSを出力する
+    """
+    tokens = int(duration * settings.ADMISSION_TOKENS_PER_AUDIO_SECOND)
+    map_profile = MinutesSummarizer.get_profile(settings.SUMMARY_MAP_MODEL)
+    reduce_profile = MinutesSummarizer.get_profile(settings.SUMMARY_REDUCE_MODEL)
+    map_usage = {"prompt_tokens": tokens, "completion_tokens": map_profile.max_tokens}
+    reduce_usage = {
+        "prompt_tokens": reduce_profile.max_tokens,
+        "completion_tokens": MinutesSummarizer.REDUCE_OUTPUT_TOKENS,
+    }
+    cost_dollars = (
+        duration / 60 * WHISPER_DOLLARS_PER_MINUTE
+        + MinutesSummarizer.calculate_costs(map_usage, map_profile.model)
+        + MinutesSummarizer.calculate_costs(reduce_usage, reduce_profile.model)
+    )
+    # TPMの制限で待つ時間も処理時間に含める
+    request_tokens = sum(map_usage.values()) + sum(reduce_usage.values())
+    processing_seconds = (
+        duration * settings.ADMISSION_SECONDS_PER_AUDIO_SECOND
+        + request_tokens / settings.OPENAI_TPM * 60
+    )
+    return JobEstimate(duration, tokens, cost_dollars, processing_seconds)
+
+
+class AdmissionRejected(Exception):
+    """混雑しているので受け付けない。retry_after秒後に再送してもらう"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Too many jobs in progress ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    待ち・実行中のジョブと、受付処理中のジョブの見積もりの合計で受け付けを制限する
+    ジョブ数、音声の合計時間、料金の合計のどれかが上限を超える場合は断る
+    受付処理中(ハッシュの計算やキューへの追加の前)のジョブはreserveで予約しておく
+    """
+
+    def __init__(self):
+        self._reserved: List[JobEstimate] = []
+        self._lock = threading.Lock()
+
+    def _backlog(self) -> List[JobEstimate]:
+        """待ち・実行中のジョブの見積もり。実行中のものは経過時間を引く"""
+        now = time.time()
+        backlog = []
+        for job in job_queue.active_jobs():
+            estimate = estimate_job(job["duration"] or 0)
+            if job["status"] == RUNNING and job["started_at"] is not None:
+                elapsed = now - job["started_at"]
+                estimate = estimate._replace(
+                    processing_seconds=max(estimate.processing_seconds - elapsed, 0)
+                )
+            backlog.append(estimate)
+        return backlog + list(self._reserved)
+
+    @staticmethod
+    def _retry_after(excess: float, total: float, backlog: List[JobEstimate]) -> int:
+        """
+        上限を超えた分(excess)が処理し終わるまでの秒数
+        全体(total)に対する割合だけ、ワーカーが並列で処理する時間がかかるとみなす
+        """
+        work = sum(estimate.processing_seconds for estimate in backlog)
+        fraction = min(excess / total, 1) if total > 0 else 1
+        seconds = work * fraction / max(settings.WORKER_PROCESSES, 1)
+        return int(
+            min(
+                max(math.ceil(seconds), settings.ADMISSION_MIN_RETRY_AFTER),
+                settings.ADMISSION_MAX_RETRY_AFTER,
+            )
+        )
+
+    def check(self, estimate: JobEstimate, backlog: List[JobEstimate]) -> None:
+        # 何も処理していなければ、どんなジョブも受け付ける
+        if not settings.ADMISSION_ENABLED or not backlog:
+            return
+        limits = [
+            ("jobs", settings.ADMISSION_MAX_ACTIVE_JOBS, lambda e: 1),
+            (
+                "audio",
+                settings.ADMISSION_MAX_QUEUED_AUDIO_HOURS * 3600,
+                lambda e: e.audio_seconds,
+            ),
+            (
+                "cost",
+                settings.ADMISSION_MAX_QUEUED_COST_DOLLARS,
+                lambda e: e.cost_dollars,
+            ),
+        ]
+        for reason, limit, amount in limits:
+            # 0以下の上限は使わない
+            if limit <= 0:
+                continue
+            total = sum(amount(queued) for queued in backlog)
+            excess = total + amount(estimate) - limit
+            if excess > 0:
+                metrics.inc("minutes_admission_rejected_total", reason=reason)
+                raise AdmissionRejected(
+                    reason, self._retry_after(excess, total, backlog)
+                )
+
+    def admit(self, duration: float) -> JobEstimate:
+        """
+        受け付けられる場合は、releaseを呼ぶまで見積もりを予約しておく
+        releaseの前にジョブをキューに追加すれば、以降はキューの側で数えられる
+        """
+        estimate = estimate_job(duration)
+        with self._lock:
+            self.check(estimate, self._backlog())
+            self._reserved.append(estimate)
+        logger.info(
+            f"job admitted: {duration:.0f}s audio, ~{estimate.tokens} tokens, "
+            f"~${estimate.cost_dollars:.2f}"
+        )
+        return estimate
+
+    def release(self, estimate: JobEstimate) -> None:
+        with self._lock:
+            self._reserved.remove(estimate)
+
+    def precheck(self) -> None:
+        """アップロードを読む前に、長さの分からないジョブとして断れるかを確認する"""
+        with self._lock:
+            self.check(estimate_job(0), self._backlog())
+
+
+admission = AdmissionController()
@@ -0,0 +1,260 @@
+import io
+import subprocess
+from contextlib import closing
+from functools import partial
+from typing import Callable, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from app.util.logger import get_logger
+from app.util.split_audio import SegmentPlan
+
+logger = get_logger(__name__)
+
+# ffmpegから読み出すPCMは16bit signed little endian
+PCM_BYTES_PER_SAMPLE = 2
+# 一度に読み出すバイト数
+DECODE_READ_BYTES = 1 << 20
+
+
+def limit_args(max_seconds: Optional[float]) -> List[str]:
+    """上限を1秒超えたところでデコードを止める。超えたかどうかはサンプル数で確かめる"""
+    return [] if max_seconds is None else ["-t", str(max_seconds + 1)]
+
+
+def too_long(num_samples: int, sampling_rate: int, max_seconds: Optional[float]):
+    return max_seconds is not None and num_samples > max_seconds * sampling_rate
+
+
+def decode_pcm(
+    filepath: str,
+    sampling_rate: int = 16000,
+    duration: Optional[float] = None,
+    allocate: Optional[Callable[[int], np.ndarray]] = None,
+    max_seconds: Optional[float] = None,
+) -> np.ndarray:
+    """
+    ffmpeg一回で動画・音声をモノラルのfloat32 PCMにデコードし、NumPy配列で返す
+    中間ファイルは作らない。durationが分かっていればその長さで確保し、再確保を避ける
+    allocateを渡すと、サンプル数を受け取って配列を返すその関数で確保する
+    (ジョブのワークスペースのmmapに置く場合など)
+    durationはヘッダ等の自己申告なので、長さの制限はmax_secondsでデコードした長さに対して行う
+    """
+    if allocate is None:
+        allocate = partial(np.empty, dtype=np.float32)
+    capacity = int((duration or 60) * sampling_rate) + sampling_rate
+    audio = allocate(capacity)
+    num_bytes = 0
+
+    process = subprocess.Popen(
+        [
+            "ffmpeg",
+            "-nostdin",
+            "-loglevel",
+            "error",
+            "-i",
+            filepath,
+            "-vn",
+            "-f",
+            "f32le",
+            "-acodec",
+            "pcm_f32le",
+            "-ac",
+            "1",
+            "-ar",
+            str(sampling_rate),
+            *limit_args(max_seconds),
+            "-",
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    try:
+        while True:
+            # 確保した分を使い切るまでは、残りの長さだけ読む
+            if num_bytes >= audio.nbytes:
+                # 見積もりより長ければ倍に広げる
+                grown = allocate(len(audio) * 2)
+                grown.view(np.uint8)[:num_bytes] = audio.view(np.uint8)[:num_bytes]
+                audio = grown
+            buffer = memoryview(audio.view(np.uint8))[
+                num_bytes : num_bytes + DECODE_READ_BYTES
+            ]
+            read = process.stdout.readinto(buffer)
+            if not read:
+                break
+            num_bytes += read
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {filepath}: {stderr.decode()}")
+
+    num_samples = num_bytes // audio.itemsize
+    if too_long(num_samples, sampling_rate, max_seconds):
+        raise ValueError("Too long audio file. (max 4 hours)")
+    # 余りが大きい場合だけ詰め直してメモリを返す
+    if type(audio) is np.ndarray and len(audio) - num_samples > sampling_rate * 60:
+        return audio[:num_samples].copy()
+    return audio[:num_samples]
+
+
+def iter_pcm_frames(
+    filepath: str,
+    frame_samples: int,
+    sampling_rate: int = 16000,
+    max_seconds: Optional[float] = None,
+) -> Iterator[np.ndarray]:
+    """
+    ffmpegでモノラルの16bit PCMにデコードし、固定長のフレームずつ返す
+    最後のフレームだけはframe_samplesより短くなることがある
+    max_secondsより長ければ、そこまで読んだところでValueErrorを送出する
+    """
+    process = subprocess.Popen(
+        [
+            "ffmpeg",
+            "-nostdin",
+            "-loglevel",
+            "error",
+            "-i",
+            filepath,
+            "-vn",
+            "-f",
+            "s16le",
+            "-acodec",
+            "pcm_s16le",
+            "-ac",
+            "1",
+            "-ar",
+            str(sampling_rate),
+            *limit_args(max_seconds),
+            "-",
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    frame_bytes = frame_samples * PCM_BYTES_PER_SAMPLE
+    num_samples = 0
+    try:
+        while True:
+            data = process.stdout.read(frame_bytes)
+            if not data:
+                break
+            # 奇数バイトで終わることはないが、念のためサンプル境界に揃える
+            usable = len(data) - len(data) % PCM_BYTES_PER_SAMPLE
+            num_samples += usable // PCM_BYTES_PER_SAMPLE
+            if too_long(num_samples, sampling_rate, max_seconds):
+                raise ValueError("Too long audio file. (max 4 hours)")
+            yield np.frombuffer(data[:usable], dtype=np.int16)
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {filepath}: {stderr.decode()}")
+
+
+def pcm_to_float(pcm: np.ndarray) -> np.ndarray:
+    """16bit PCMを[-1, 1)のfloat32に変換する"""
+    return pcm.astype(np.float32) / 32768.0
+
+
+def to_pcm16(piece: np.ndarray) -> np.ndarray:
+    """float(-1〜1)の配列は16bit PCMに変換する。16bitのものはそのまま返す"""
+    piece = np.asarray(piece)
+    if piece.dtype.kind == "f":
+        piece = np.clip(piece * 32768.0, -32768, 32767).astype(np.int16)
+    return piece.astype("<i2", copy=False)
+
+
+def encode_pcm(
+    pieces: Iterable,
+    output_args: List[str],
+    sampling_rate: int = 16000,
+    name: str = "chunk",
+) -> io.BytesIO:
+    """
+    音声区間をパイプでffmpegに渡し、output_argsの形式でメモリ上にエンコードする
+    一時ファイルは作らない。nameはAPIへのアップロード時のファイル名として使われる
+    """
+    data = b"".join(to_pcm16(piece).tobytes() for piece in pieces)
+    result = subprocess.run(
+        [
+            "ffmpeg",
+            "-nostdin",
+            "-loglevel",
+            "error",
+            "-f",
+            "s16le",
+            "-ar",
+            str(sampling_rate),
+            "-ac",
+            "1",
+            "-i",
+            "pipe:0",
+            *output_args,
+            "pipe:1",
+        ],
+        input=data,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to encode {name}: {result.stderr.decode()}")
+    buffer = io.BytesIO(result.stdout)
+    buffer.name = name
+    return buffer
+
+
+def iter_voiced_chunks(
+    filepath: str,
+    plan: SegmentPlan,
+    frame_samples: int,
+    sampling_rate: int = 16000,
+) -> Iterator[List[np.ndarray]]:
+    """
+    音声をもう一度ストリームで読み、チャンク毎に音声区間のPCMを返す
+    区間はフレームのスライスのまま返すので、保持するのは処理中のチャンク分だけ
+    """
+    chunk_bounds = plan.chunk_bounds.tolist()
+    segments = plan.segments.tolist()
+    segment_index = 0
+    chunk_index = 0
+    pieces = []
+    position = 0
+
+    frames = iter_pcm_frames(filepath, frame_samples, sampling_rate)
+    with closing(frames):
+        for frame in frames:
+            frame_start = position
+            frame_end = position + len(frame)
+            position = frame_end
+
+            while segment_index < len(segments):
+                start, end = segments[segment_index]
+                if start >= frame_end:
+                    break
+                lo = max(start, frame_start)
+                hi = min(end, frame_end)
+                if hi > lo:
+                    pieces.append(frame[lo - frame_start : hi - frame_start])
+                if end > frame_end:
+                    # セグメントが次のフレームにまたがる
+                    break
+
+                segment_index += 1
+                if segment_index == chunk_bounds[chunk_index + 1]:
+                    yield pieces
+                    pieces = []
+                    chunk_index += 1
+
+            if segment_index == len(segments):
+                # 残りはデコードしない
+                break
+
+    # デコード結果がタイムスタンプより短かった場合の残り
+    if pieces:
+        yield pieces
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import Counter
+from typing import Any, Optional, Sequence
+
+from app.core.config import settings
+from app.util.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def content_key(*parts: Any) -> str:
+    """キャッシュキーの要素をまとめてハッシュにする"""
+    return hashlib.sha256(
+        json.dumps(parts, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+class ResultCache:
+    """
+    アップロードされた音声の内容ハッシュをキーにした、ステージ毎の結果のディスクキャッシュ
+    <directory>/<stage>/<key>.json に保存し、合計サイズがmax_bytesを超えたら
+    最後に使われたのが古いものから削除する
+    """
+
+    def __init__(self, directory: str, max_bytes: int, enabled: bool = True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits: Counter = Counter()
+        self.misses: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def _path(self, stage: str, key_parts: Sequence[Any]) -> str:
+        return os.path.join(self.directory, stage, f"{content_key(*key_parts)}.json")
+
+    def get(self, stage: str, key_parts: Sequence[Any]) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        path = self._path(stage, key_parts)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            # LRUのために最終利用時刻を更新する
+            os.utime(path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self._lock:
+                self.misses[stage] += 1
+            logger.info(f"cache miss: {stage}")
+            return None
+        with self._lock:
+            self.hits[stage] += 1
+        logger.info(f"cache hit: {stage}")
+        return value
+
+    def put(self, stage: str, key_parts: Sequence[Any], value: Any) -> None:
+        if not self.enabled:
+            return
+        path = self._path(stage, key_parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 書き込み途中のファイルを読まないように、一時ファイルから置き換える
+        with tempfile.NamedTemporaryFile(
+            "w", dir=os.path.dirname(path), suffix=".tmp", delete=False
+        ) as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(f.name, path)
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        total_bytes = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_bytes += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            logger.info(f"cache evicted: {path}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": dict(self.hits), "misses": dict(self.misses)}
+
+
+result_cache = ResultCache(
+    settings.CACHE_DIR,
+    max_bytes=settings.CACHE_MAX_BYTES,
+    enabled=settings.CACHE_ENABLED,
+)
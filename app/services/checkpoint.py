@@ -0,0 +1,76 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Optional
+
+from app.core.config import settings
+from app.util.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class JobCheckpoint:
+    """
+    ジョブの途中結果をジョブディレクトリ以下に保存する
+    同じジョブをやり直した場合は、完了済みの単位を読み込んでスキップする
+    例: probe, vad, transcript/0003, map/0002, reduce
+    """
+
+    def __init__(self, root: str, job_id: str):
+        self.job_id = job_id
+        self.job_dir = os.path.join(root, job_id)
+        os.makedirs(self.job_dir, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.job_dir, f"{name}.json")
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self._path(name))
+
+    def load(self, name: str) -> Optional[Any]:
+        try:
+            with open(self._path(name), "r", encoding="utf-8") as f:
+                value = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        logger.info(f"checkpoint loaded: {self.job_id}/{name}")
+        return value
+
+    def save(self, name: str, value: Any) -> None:
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 途中で落ちても壊れたファイルが残らないように置き換えで書き込む
+        with tempfile.NamedTemporaryFile(
+            "w", dir=os.path.dirname(path), suffix=".tmp", delete=False
+        ) as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(f.name, path)
+
+    def clear(self) -> None:
+        """ジョブが最後まで完了したら途中結果を削除する"""
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+
+    @staticmethod
+    def cleanup_expired(root: str, ttl_seconds: int) -> None:
+        """再開されないまま残ったジョブディレクトリを削除する"""
+        if not os.path.isdir(root):
+            return
+        now = time.time()
+        for name in os.listdir(root):
+            job_dir = os.path.join(root, name)
+            try:
+                expired = now - os.path.getmtime(job_dir) > ttl_seconds
+            except FileNotFoundError:
+                continue
+            if expired:
+                logger.info(f"removing expired checkpoint: {name}")
+                shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def get_job_checkpoint(job_id: str) -> JobCheckpoint:
+    JobCheckpoint.cleanup_expired(
+        settings.CHECKPOINT_DIR, settings.CHECKPOINT_TTL_SECONDS
+    )
+    return JobCheckpoint(settings.CHECKPOINT_DIR, job_id)
@@ -0,0 +1,367 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+from app.util.logger import get_logger
+
+logger = get_logger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    input_path TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    prompt TEXT,
+    response_format TEXT,
+    duration REAL,
+    progress TEXT NOT NULL DEFAULT '{}',
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    heartbeat_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created_at ON jobs (status, created_at);
+CREATE TABLE IF NOT EXISTS job_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_events_job_id ON job_events (job_id, id);
+"""
+
+# ジョブの最後に記録されるイベント
+TERMINAL_EVENTS = ("succeeded", "failed")
+
+JSON_COLUMNS = ("progress", "result")
+
+
+class JobQueue:
+    """
+    SQLiteを使ったプロセス間で共有するジョブキュー
+    APIはジョブを積むだけで、処理はapp.workerのワーカープロセスが行う
+    """
+
+    def __init__(self, db_path: str, max_attempts: int = 3):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self._initialized = False
+
+    def initialize(self) -> None:
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+        self._initialized = True
+
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            self.initialize()
+        # 接続はスレッド・プロセス間で共有しない
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        for column in JSON_COLUMNS:
+            if job.get(column) is not None:
+                job[column] = json.loads(job[column])
+        return job
+
+    def enqueue(
+        self,
+        filename: str,
+        input_path: str,
+        content_hash: str,
+        prompt: Optional[str],
+        response_format: Optional[str],
+        duration: Optional[float] = None,
+        job_id: Optional[str] = None,
+    ) -> str:
+        job_id = job_id or uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO jobs (
+                    id, status, filename, input_path, content_hash,
+                    prompt, response_format, duration, created_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    job_id,
+                    QUEUED,
+                    filename,
+                    input_path,
+                    content_hash,
+                    prompt,
+                    response_format,
+                    duration,
+                    time.time(),
+                ),
+            )
+        logger.info(f"job queued: {job_id} ({filename})")
+        return job_id
+
+    def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        """一番古い待ちジョブを取り出して実行中にする"""
+        with self._connect() as conn:
+            # 他のワーカーと同じジョブを取らないように書き込みロックを取る
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1",
+                    (QUEUED,),
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                now = time.time()
+                conn.execute(
+                    """
+                    UPDATE jobs
+                    SET status = ?, worker = ?, attempts = attempts + 1,
+                        started_at = ?, heartbeat_at = ?
+                    WHERE id = ?
+                    """,
+                    (RUNNING, worker, now, now, row["id"]),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        job = self._to_dict(row)
+        job.update(status=RUNNING, worker=worker, attempts=job["attempts"] + 1)
+        return job
+
+    @staticmethod
+    def _insert_event(
+        conn: sqlite3.Connection, job_id: str, event_type: str, data: Dict[str, Any]
+    ) -> None:
+        conn.execute(
+            "INSERT INTO job_events (job_id, type, data, created_at) VALUES (?, ?, ?, ?)",
+            (job_id, event_type, json.dumps(data, ensure_ascii=False), time.time()),
+        )
+
+    def add_event(self, job_id: str, event_type: str, **data: Any) -> None:
+        """途中結果をイベントとして記録する。APIがSSEでクライアントに流す"""
+        with self._connect() as conn:
+            self._insert_event(conn, job_id, event_type, data)
+
+    def get_events(
+        self, job_id: str, after_id: int = 0, limit: int = 100
+    ) -> List[Dict[str, Any]]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT * FROM job_events WHERE job_id = ? AND id > ?
+                ORDER BY id LIMIT ?
+                """,
+                (job_id, after_id, limit),
+            ).fetchall()
+        events = [dict(row) for row in rows]
+        for event in events:
+            event["data"] = json.loads(event["data"])
+        return events
+
+    def update_progress(self, job_id: str, stage: str, **info: Any) -> None:
+        progress = {"stage": stage, **info}
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET progress = ?, heartbeat_at = ? WHERE id = ?",
+                (json.dumps(progress, ensure_ascii=False), time.time(), job_id),
+            )
+
+    def heartbeat(self, job_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE id = ?",
+                (time.time(), job_id),
+            )
+
+    def complete(self, job_id: str, result: Dict[str, Any]) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE jobs SET status = ?, result = ?, error = NULL, finished_at = ?
+                WHERE id = ?
+                """,
+                (
+                    SUCCEEDED,
+                    json.dumps(result, ensure_ascii=False),
+                    time.time(),
+                    job_id,
+                ),
+            )
+            # 結果はGET /jobs/{job_id}で取得する
+            self._insert_event(conn, job_id, "succeeded", {})
+        logger.info(f"job succeeded: {job_id}")
+
+    def fail(self, job_id: str, error: str) -> bool:
+        """
+        失敗を記録する。試行回数が残っていれば待ちに戻してTrueを返す
+        チェックポイントがあるので、やり直しは途中から再開される
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT attempts FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            retry = row is not None and row["attempts"] < self.max_attempts
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                (
+                    QUEUED if retry else FAILED,
+                    error,
+                    None if retry else time.time(),
+                    job_id,
+                ),
+            )
+            self._insert_event(
+                conn, job_id, "retrying" if retry else "failed", {"error": error}
+            )
+        logger.info(f"job {'requeued' if retry else 'failed'}: {job_id}: {error}")
+        return retry
+
+    def _requeue_running(
+        self, condition: str, params: tuple, error: str
+    ) -> List[Dict[str, Any]]:
+        """
+        条件に合う実行中のジョブを待ちに戻す。試行回数を使い切ったものは失敗にする
+        ワーカーごと落ちたジョブ(OOM等)はfailを通らないので、ここで回数を確かめる
+        失敗にしたジョブを返す
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    f"SELECT * FROM jobs WHERE status = ? AND {condition}",
+                    (RUNNING, *params),
+                ).fetchall()
+                now = time.time()
+                failed = []
+                for row in rows:
+                    retry = row["attempts"] < self.max_attempts
+                    conn.execute(
+                        """
+                        UPDATE jobs SET status = ?, worker = NULL, error = ?, finished_at = ?
+                        WHERE id = ?
+                        """,
+                        (
+                            QUEUED if retry else FAILED,
+                            error,
+                            None if retry else now,
+                            row["id"],
+                        ),
+                    )
+                    self._insert_event(
+                        conn,
+                        row["id"],
+                        "retrying" if retry else "failed",
+                        {"error": error},
+                    )
+                    if not retry:
+                        failed.append(self._to_dict(row))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if rows:
+            logger.warning(
+                f"{error}: requeued {len(rows) - len(failed)} job(s), "
+                f"failed {len(failed)} job(s)"
+            )
+        return failed
+
+    def requeue_stale(self, stale_seconds: float) -> List[Dict[str, Any]]:
+        """
+        ワーカーが落ちて止まったままの実行中ジョブを待ちに戻す
+        試行回数を使い切って失敗にしたジョブを返す
+        """
+        return self._requeue_running(
+            "heartbeat_at < ?",
+            (time.time() - stale_seconds,),
+            "worker stopped sending heartbeats",
+        )
+
+    def prune_events(self, ttl_seconds: float) -> int:
+        """
+        終わってからttl_seconds経ったジョブのイベントを削除する
+        イベントにはチャンク毎の文字起こしや要約が入っていて、結果と重複するため
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                """
+                DELETE FROM job_events WHERE job_id IN (
+                    SELECT id FROM jobs WHERE status IN (?, ?) AND finished_at < ?
+                )
+                """,
+                (SUCCEEDED, FAILED, time.time() - ttl_seconds),
+            )
+        if cursor.rowcount:
+            logger.info(f"pruned {cursor.rowcount} job event(s)")
+        return cursor.rowcount
+
+    def requeue_worker(self, worker: str) -> List[Dict[str, Any]]:
+        """
+        落ちたワーカーが実行していたジョブを待ちに戻す
+        試行回数を使い切って失敗にしたジョブを返す
+        """
+        return self._requeue_running("worker = ?", (worker,), f"worker {worker} exited")
+
+    def stats(self) -> Dict[str, Any]:
+        """状態毎のジョブ数と、一番古い待ちジョブの作成時刻"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT status, COUNT(*) AS count FROM jobs GROUP BY status"
+            ).fetchall()
+            oldest = conn.execute(
+                "SELECT MIN(created_at) FROM jobs WHERE status = ?", (QUEUED,)
+            ).fetchone()[0]
+        counts = {status: 0 for status in (QUEUED, RUNNING, SUCCEEDED, FAILED)}
+        counts.update({row["status"]: row["count"] for row in rows})
+        return {"counts": counts, "oldest_queued_at": oldest}
+
+    def active_jobs(self) -> List[Dict[str, Any]]:
+        """待ち・実行中のジョブの長さと開始時刻。受付の制限に使う"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT status, duration, started_at FROM jobs
+                WHERE status IN (?, ?)
+                """,
+                (QUEUED, RUNNING),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+
+job_queue = JobQueue(settings.JOB_DB_PATH, max_attempts=settings.JOB_MAX_ATTEMPTS)
@@ -1,90 +1,178 @@
-import tempfile
-import subprocess
-import ffmpeg
+import io
 import os
-import openai
 import math
-
+import asyncio
+from functools import lru_cache
+from typing import AsyncIterable, Callable, List, NamedTuple, Optional, Tuple
+
+from app.core.config import settings
+from app.services.audio import PCM_BYTES_PER_SAMPLE, encode_pcm, to_pcm16
+from app.services.checkpoint import JobCheckpoint
+from app.services.rate_limit import get_rate_limiter
 from app.util.logger import get_logger
-
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.prompts import PromptTemplate
+from app.util.metrics import CHUNK_BUCKETS, metrics
 
 from app.models.summary import SimpleSummary
-
-import tiktoken
+from app.services.tokenizer import TokenChunk, count_tokens, get_encoding, split_tokens
 
 logger = get_logger(__name__)
 
+# openai・ffmpeg・langchainは起動を速くするため、使うときにimportする
+# (app.services.warmupで先に読み込んでおける)
+
+
+@lru_cache(maxsize=None)
+def retryable_errors() -> tuple:
+    """リトライしてよい一時的なエラー"""
+    import openai
+
+    return (
+        openai.error.RateLimitError,
+        openai.error.APIError,
+        openai.error.Timeout,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError,
+    )
+
 
 class Transcriber:
-    @staticmethod
-    def extract_audio_from_video(
-        input_tempfile: tempfile.NamedTemporaryFile,
-    ) -> tempfile.NamedTemporaryFile:
-        # 音声を抽出するための一時ファイルを作成
-        with tempfile.NamedTemporaryFile(
-            delete=False, suffix=".mp3"
-        ) as output_tempfile:
-            subprocess.run(
-                [
-                    "ffmpeg",
-                    "-y",
-                    "-i",
-                    input_tempfile.name,
-                    "-q:a",
-                    "0",
-                    "-map",
-                    "a",
-                    output_tempfile.name,
-                ]
-            )
-        os.remove(input_tempfile.name)
-        return output_tempfile
+    # whisper APIのアップロード上限(バイト)
+    UPLOAD_LIMIT = 25000000
+    # 16bit PCMに対するFLACのサイズの見積もり。話し声なら概ね0.5〜0.7になる
+    FLAC_RATIO = 0.75
 
     @classmethod
-    def compress_audio(
-        cls,
-        input_file: tempfile.NamedTemporaryFile,
-    ) -> tempfile.NamedTemporaryFile:
-        logger.info("=== compress audio ===")
-
-        # Check audio duration
-        duration = cls.get_audio_duration(input_file.name)
+    def encode_chunk(
+        cls, pieces: List, sampling_rate: int = 16000, name: str = "chunk"
+    ) -> io.BytesIO:
+        """
+        チャンクをメモリ上で一度だけエンコードする
+        サンプル数から上限に収まるかを先に見積もり、収まらなければopusにする
+        """
+        pieces = [to_pcm16(piece) for piece in pieces]
+        num_samples = sum(len(piece) for piece in pieces)
+        raw_size = num_samples * PCM_BYTES_PER_SAMPLE
+
+        if (
+            settings.CHUNK_CODEC == "flac"
+            and raw_size * cls.FLAC_RATIO < cls.UPLOAD_LIMIT
+        ):
+            audio_file = encode_pcm(
+                pieces, ["-c:a", "flac", "-f", "flac"], sampling_rate, f"{name}.flac"
+            )
+            if audio_file.getbuffer().nbytes <= cls.UPLOAD_LIMIT:
+                return audio_file
+            # 見積もりを外れた場合だけもう一度エンコードする
+            logger.info(
+                f"FLAC size exceeded the limit: {audio_file.getbuffer().nbytes}"
+            )
 
-        # Calculate bitrate based on audio duration
-        bitrate = cls.calculate_bitrate(duration)
+        duration = max(num_samples / sampling_rate, 1)
+        bitrate = cls.calculate_bitrate(
+            duration, max_kbps=settings.OPUS_MAX_BITRATE_KBPS
+        )
         logger.info(f"Target bitrate: {bitrate}")
+        return encode_pcm(
+            pieces,
+            ["-c:a", "libopus", "-b:a", bitrate, "-application", "voip", "-f", "ogg"],
+            sampling_rate,
+            f"{name}.ogg",
+        )
 
-        with tempfile.NamedTemporaryFile(
-            delete=False, suffix=".mp3"
-        ) as output_tempfile:
-            subprocess.run(
-                [
-                    "ffmpeg",
-                    "-y",
-                    "-i",
-                    input_file.name,
-                    "-codec:a",
-                    "mp3",
-                    "-ar",
-                    "16000",
-                    "-ac",
-                    "1",
-                    "-b:a",
-                    bitrate,
-                    output_tempfile.name,
-                ]
-            )
+    @classmethod
+    async def transcribe_file(
+        cls,
+        input_file: io.BytesIO,
+        prompt: Optional[str] = None,
+        response_format: str = "text",
+    ) -> str:
+        """一時的なエラーの場合は待ってから同じチャンクを送り直す"""
+        import openai
+
+        rate_limiter = get_rate_limiter("whisper-1")
+        for attempt in range(settings.OPENAI_MAX_RETRIES + 1):
+            await rate_limiter.acquire_async()
+            # 送り直す場合も先頭から読ませる
+            input_file.seek(0)
+            try:
+                # encode_chunkでアップロード上限に収まる形式になっている
+                return await openai.Audio.atranscribe(
+                    "whisper-1",
+                    input_file,
+                    prompt=prompt,
+                    response_format=response_format,
+                    temperature=0,
+                    language="ja",
+                )
+            except retryable_errors() as e:
+                if attempt == settings.OPENAI_MAX_RETRIES:
+                    raise
+                wait_seconds = settings.OPENAI_RETRY_BACKOFF * 2**attempt
+                logger.warning(
+                    f"Transcription failed ({e.__class__.__name__}: {e}), "
+                    f"retrying in {wait_seconds}s"
+                )
+                await asyncio.sleep(wait_seconds)
 
-        os.remove(input_file.name)
-        logger.info(f"Compressed audio size:{os.path.getsize(output_tempfile.name)}")
-        return output_tempfile
+    @classmethod
+    async def transcribe_files(
+        cls,
+        input_files: AsyncIterable[Optional[io.BytesIO]],
+        prompt: Optional[str] = None,
+        response_format: str = "text",
+        max_workers: int = 4,
+        checkpoint: Optional[JobCheckpoint] = None,
+        on_transcribed: Optional[Callable[[int, str], None]] = None,
+    ) -> List[str]:
+        """
+        チャンクの音声を並列でwhisperに投げ、元の順番で文字起こしを返す
+        書き出されたものから順に送信し、同時に送信中のチャンクはmax_workersまでにする
+        チェックポイントに文字起こしがあるチャンクはNoneでよい
+        """
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def transcribe(index: int, input_file: io.BytesIO) -> str:
+            try:
+                transcript = await cls.transcribe_file(
+                    input_file, prompt, response_format
+                )
+            finally:
+                semaphore.release()
+            if checkpoint is not None:
+                checkpoint.save(f"transcript/{index:04d}", transcript)
+            if on_transcribed is not None:
+                on_transcribed(index, transcript)
+            return transcript
+
+        tasks = []
+        try:
+            index = 0
+            async for input_file in input_files:
+                saved = (
+                    checkpoint.load(f"transcript/{index:04d}")
+                    if checkpoint is not None
+                    else None
+                )
+                if saved is not None:
+                    tasks.append(saved)
+                else:
+                    # 送信中のチャンクが空くまで次のチャンクを書き出さない
+                    await semaphore.acquire()
+                    tasks.append(asyncio.create_task(transcribe(index, input_file)))
+                index += 1
+            return [task if isinstance(task, str) else await task for task in tasks]
+        except BaseException:
+            for task in tasks:
+                if isinstance(task, asyncio.Task):
+                    task.cancel()
+            raise
 
     @staticmethod
-    def calculate_bitrate(duration: float) -> str:
+    def calculate_bitrate(duration: float, max_kbps: Optional[int] = None) -> str:
         TARGET_FILE_SIZE = 25000000
         target_kbps = int(math.floor(TARGET_FILE_SIZE * 8 / duration / 1000 * 0.9))
+        if max_kbps is not None:
+            target_kbps = min(target_kbps, max_kbps)
         return f"{target_kbps}k"
 
     @staticmethod
@@ -101,6 +189,8 @@ class Transcriber:
 
     @staticmethod
     def get_audio_duration(filepath) -> float:
+        import ffmpeg
+
         try:
             probe = ffmpeg.probe(filepath)
             duration = float(probe["format"]["duration"])
@@ -111,100 +201,296 @@ class Transcriber:
         return duration
 
 
+class ModelProfile(NamedTuple):
+    model: str
+    # mapで1チャンクに入れるトークン数
+    chunk_size: int
+    # 1回のリクエストの入力と出力の合計の上限
+    max_tokens: int
+    # 出力の上限。Noneの場合は入力の残りを全て使える
+    max_output_tokens: Optional[int] = None
+
+
+class SummaryPlan(NamedTuple):
+    # Noneの場合はmapを行わず、文字起こしから直接SimpleSummaryを作る
+    map_profile: Optional[ModelProfile]
+    reduce_profile: ModelProfile
+
+    @property
+    def single_pass(self) -> bool:
+        return self.map_profile is None
+
+    @property
+    def key(self) -> tuple:
+        """キャッシュキーに含める、結果に影響するモデルの組"""
+        return (
+            self.map_profile.model if self.map_profile is not None else None,
+            self.reduce_profile.model,
+        )
+
+
 class MinutesSummarizer:
-    # TODO config
-    # MODEL = "gpt-3.5-turbo-16k"
-    # CHUNK_SIZE = 8000
-    # MAX_TOKENS = 15000
     # max_tokensはcompletionのみで計算されていそう
     # you requested 19483 tokens (4483 in the messages, 15000 in the completion)
-    MODEL = "gpt-4-0613"
-    CHUNK_SIZE = 4000
-    MAX_TOKENS = 7500
-
-    # MODEL = "gpt-4-1106-preview"
-    # CHUNK_SIZE = 16000
-    # MAX_TOKENS = 120000
+    PROFILES = {
+        "gpt-4-0613": ModelProfile("gpt-4-0613", 4000, 7500),
+        "gpt-3.5-turbo-16k": ModelProfile("gpt-3.5-turbo-16k", 8000, 15000),
+        "gpt-4-1106-preview": ModelProfile(
+            "gpt-4-1106-preview", 16000, 120000, max_output_tokens=4096
+        ),
+    }
 
     chunk_overlap = 100
+    # 最終的な要約(SimpleSummary)の出力に確保するトークン数
+    REDUCE_OUTPUT_TOKENS = 2000
+    # バッチで要約を連結するときの区切りの見積もり(1つあたり)
+    SEPARATOR_TOKENS = 4
+    # tree reduceの段数の上限。1段で概ね半分以下になるので、通常は数段で収まる
+    TREE_REDUCE_MAX_LEVELS = 8
     COST_DICT = {
         "gpt-4-1106-preview": {"input": 0.01, "output": 0.03},
         "gpt-4-0613": {"input": 0.03, "output": 0.06},
         "gpt-3.5-turbo-16k": {"input": 0.003, "output": 0.004},
     }
 
+    @classmethod
+    def get_profile(cls, model: str) -> ModelProfile:
+        if model not in cls.PROFILES:
+            raise ValueError(f"Unknown summary model: {model}")
+        return cls.PROFILES[model]
+
+    @classmethod
+    def configured_models(cls) -> tuple:
+        """
+        設定された要約のモデルの組
+        ワーカーの起動時に、これらのモデルのtiktokenのエンコーダを読み込んでおくのに使う
+        """
+        return (
+            settings.SUMMARY_MAP_MODEL,
+            settings.SUMMARY_REDUCE_MODEL,
+            settings.SUMMARY_SINGLE_PASS_MODEL,
+        )
+
+    @classmethod
+    def plan_summary(cls, transcript: str) -> SummaryPlan:
+        """
+        文字起こしのトークン数から要約の方法を選ぶ
+        1回のSimpleSummaryに収まる場合はmapを省き、呼び出し回数と待ち時間を減らす
+        """
+        if settings.SUMMARY_SINGLE_PASS_MODEL:
+            profile = cls.get_profile(settings.SUMMARY_SINGLE_PASS_MODEL)
+            num_tokens = count_tokens(transcript, profile.model)
+            if num_tokens <= settings.SUMMARY_SINGLE_PASS_MAX_INPUT_TOKENS:
+                messages, functions = cls.build_simple_summary_request(
+                    [transcript], transcript=True
+                )
+                request_tokens = num_tokens_from_messages(
+                    messages, model=profile.model
+                ) + num_tokens_from_functions(functions, model=profile.model)
+                if request_tokens + cls.REDUCE_OUTPUT_TOKENS <= profile.max_tokens:
+                    logger.info(
+                        f"single pass summary with {profile.model}: {num_tokens} tokens"
+                    )
+                    return SummaryPlan(None, profile)
+        return SummaryPlan(
+            cls.get_profile(settings.SUMMARY_MAP_MODEL),
+            cls.get_profile(settings.SUMMARY_REDUCE_MODEL),
+        )
+
     @staticmethod
     def to_numbered_list_str(items):
         return "\n".join(f"{i+1}. {item}" for i, item in enumerate(items))
 
     @classmethod
-    def map_sammaries(cls, text: str):
-        text_splitter = CharacterTextSplitter.from_tiktoken_encoder(
-            separator=" ", chunk_size=cls.CHUNK_SIZE, chunk_overlap=cls.chunk_overlap
+    def calculate_costs(cls, usage: dict, model: str) -> float:
+        return (
+            usage["prompt_tokens"] * cls.COST_DICT[model]["input"]
+            + usage["completion_tokens"] * cls.COST_DICT[model]["output"]
+        ) / 1000
+
+    @classmethod
+    def record_usage(cls, usage: dict, stage: str, model: str) -> None:
+        """トークン数とコストをメトリクスに記録する"""
+        for kind in ("prompt", "completion"):
+            metrics.inc(
+                "minutes_tokens_total",
+                usage[f"{kind}_tokens"],
+                model=model,
+                stage=stage,
+                kind=kind,
+            )
+        metrics.inc(
+            "minutes_cost_dollars_total",
+            cls.calculate_costs(usage, model),
+            model=model,
+        )
+
+    @classmethod
+    async def create_chat_completion(cls, estimated_tokens: int, **kwargs):
+        """
+        TPM・RPMの予算を確保してからリクエストする
+        一時的なエラーの場合は待ってからリトライする
+        """
+        import openai
+
+        rate_limiter = get_rate_limiter(kwargs["model"])
+        for attempt in range(settings.OPENAI_MAX_RETRIES + 1):
+            await rate_limiter.acquire_async(estimated_tokens)
+            try:
+                return await openai.ChatCompletion.acreate(**kwargs)
+            except retryable_errors() as e:
+                if attempt == settings.OPENAI_MAX_RETRIES:
+                    raise
+                wait_seconds = settings.OPENAI_RETRY_BACKOFF * 2**attempt
+                logger.warning(
+                    f"ChatCompletion failed ({e.__class__.__name__}: {e}), "
+                    f"retrying in {wait_seconds}s"
+                )
+                await asyncio.sleep(wait_seconds)
+
+    @classmethod
+    async def summarize_chunk(
+        cls, chunk: TokenChunk, num_chunks: int, profile: ModelProfile
+    ):
+        logger.info(chunk.text)
+
+        messages = [
+            {
+                "role": "system",
+                "content": """
+                    あなたは会議の議事録を作成するプロフェッショナルアシスタントです。
+                    これから会議の文字起こししたテキストを分割して渡します。
+                    テキストは話者分離をしていません。
+                    この文章から重要な内容を抽出してください。
+                    あなたの推察はせず、文章に明記されている内容をそのまま抽出してください。
+                    抽出は箇条書きではなく、文章で行なってください。
+                    """,
+            },
+            {"role": "user", "content": chunk.text},
+        ]
+        # チャンクは分割時にトークン数が分かっているので、再度エンコードしない
+        num_tokens = (
+            num_tokens_from_messages(
+                [messages[0], {"role": "user", "content": ""}], model=profile.model
+            )
+            + chunk.num_tokens
+        )
+        max_tokens = min(
+            profile.max_tokens // num_chunks,
+            profile.max_tokens - num_tokens,
+            profile.max_output_tokens or profile.max_tokens,
+        )
+        response = await cls.create_chat_completion(
+            # TPMはmax_tokensも含めて計算される
+            estimated_tokens=num_tokens + max_tokens,
+            model=profile.model,
+            messages=messages,
+            temperature=0,
+            max_tokens=max_tokens,
+        )
+        logger.info(f"chat create: {response['choices'][0]['message']['content']}")
+        cls.record_usage(response["usage"], "map", profile.model)
+        return response
+
+    @classmethod
+    async def map_sammaries(
+        cls,
+        text: str,
+        checkpoint: Optional[JobCheckpoint] = None,
+        on_summarized: Optional[Callable[[int, int, str], None]] = None,
+        profile: Optional[ModelProfile] = None,
+    ):
+        profile = profile or cls.get_profile(settings.SUMMARY_MAP_MODEL)
+        # 文字起こしを1度だけトークン化し、トークン列を切り出して分割する
+        text_chunks = split_tokens(
+            text, profile.chunk_size, cls.chunk_overlap, model=profile.model
+        )
+        logger.info(
+            f"text chunks: {len(text_chunks)}, "
+            f"tokens: {[chunk.num_tokens for chunk in text_chunks]}"
+        )
+        metrics.observe(
+            "minutes_job_chunks", len(text_chunks), CHUNK_BUCKETS, stage="map"
         )
-        text_chunks = text_splitter.split_text(text)
         total_tokens = 0
         prompt_tokens = 0
         completion_tokens = 0
         costs = 0
         response_messages = []
 
-        for chunk in text_chunks:
-            logger.info(chunk)
-
-            messages = [
-                {
-                    "role": "system",
-                    "content": """
-                        あなたは会議の議事録を作成するプロフェッショナルアシスタントです。
-                        これから会議の文字起こししたテキストを分割して渡します。
-                        テキストは話者分離をしていません。
-                        この文章から重要な内容を抽出してください。
-                        あなたの推察はせず、文章に明記されている内容をそのまま抽出してください。
-                        抽出は箇条書きではなく、文章で行なってください。
-                        """,
-                },
-                {"role": "user", "content": chunk},
-            ]
-            num_tokens = num_tokens_from_messages(messages, model=cls.MODEL)
-            response = openai.ChatCompletion.create(
-                model=cls.MODEL,
-                messages=messages,
-                temperature=0,
-                max_tokens=min(
-                    cls.MAX_TOKENS // len(text_chunks), cls.MAX_TOKENS - num_tokens
-                ),
+        semaphore = asyncio.Semaphore(settings.MAP_CONCURRENCY)
+
+        async def summarize(index: int, chunk: TokenChunk):
+            async with semaphore:
+                response = await cls.summarize_chunk(chunk, len(text_chunks), profile)
+            if checkpoint is not None:
+                checkpoint.save(f"map/{index:04d}", response)
+            if on_summarized is not None:
+                on_summarized(
+                    index,
+                    len(text_chunks),
+                    response["choices"][0]["message"]["content"],
+                )
+            return response
+
+        # チャンク毎の要約を並列で作成する。リトライはチャンク単位で行う
+        # チェックポイントに結果があるチャンクは再度リクエストしない
+        async def load_or_summarize(index: int, chunk: TokenChunk):
+            saved = (
+                checkpoint.load(f"map/{index:04d}") if checkpoint is not None else None
             )
+            if saved is not None:
+                return saved
+            return await summarize(index, chunk)
+
+        # 元のチャンクの順番で結果を集計する
+        responses = await asyncio.gather(
+            *[
+                load_or_summarize(index, chunk)
+                for index, chunk in enumerate(text_chunks)
+            ]
+        )
+        for response in responses:
             total_tokens += response["usage"]["total_tokens"]
             prompt_tokens += response["usage"]["prompt_tokens"]
             completion_tokens += response["usage"]["completion_tokens"]
-            costs += (
-                response["usage"]["prompt_tokens"] * cls.COST_DICT[cls.MODEL]["input"]
-                + response["usage"]["completion_tokens"]
-                * cls.COST_DICT[cls.MODEL]["output"]
-            ) / 1000
+            costs += cls.calculate_costs(response["usage"], profile.model)
             response_messages.append(response["choices"][0]["message"]["content"])
-            logger.info(f"chat create: {response['choices'][0]['message']['content']}")
         return response_messages, costs
 
-    @classmethod
-    def get_simple_summary(cls, doc_summaries: str):
-        costs = 0
-
+    @staticmethod
+    def build_simple_summary_request(doc_summaries: List[str], transcript=False):
+        """transcriptがTrueの場合は、mapの要約ではなく文字起こしそのものを渡す"""
+        if transcript:
+            source = """これから会議の文字起こししたテキストを渡します。
+        テキストは話者分離をしていません。"""
+            label = "以下は文字起こしである："
+        else:
+            source = "これから会議の文字起こしの要点を抽出した文章を渡します。"
+            label = "以下は要約のセットである："
         template = """
         あなたは会議の議事録を作成するアシスタントです。
-        これから会議の文字起こしの要点を抽出した文章を渡します。
+        {source}
         この会議の要約、要点のリスト、決定事項のリスト、タスクのリストを返してください。
         会議の要約は渡した文章の体裁を留める程度で漏れのない文章で書いてください。タスクのリストには今後やるべきタスクを書いてください。
         タスクのリストには既に完了したことについては記載しないように注意してください。
         決定事項のリストにはタスク以外で決定された事項を書いてください。
 
-        以下は要約のセットである：
+        {label}
         {doc_summaries}"""
 
-        prompt = PromptTemplate(template=template, input_variables=["doc_summaries"])
+        from langchain.prompts import PromptTemplate
+
+        prompt = PromptTemplate(
+            template=template, input_variables=["source", "label", "doc_summaries"]
+        )
         messages = [
-            {"role": "user", "content": prompt.format(doc_summaries=doc_summaries)},
+            {
+                "role": "user",
+                "content": prompt.format(
+                    source=source, label=label, doc_summaries=doc_summaries
+                ),
+            },
         ]
         functions = [
             {
@@ -214,38 +500,192 @@ class MinutesSummarizer:
                 "parameters": SimpleSummary.schema(),
             }
         ]
-        message_tokens = num_tokens_from_messages(messages, model=cls.MODEL)
-        functions_tokens = num_tokens_from_functions(functions, model=cls.MODEL)
+        return messages, functions
+
+    @staticmethod
+    def build_merge_messages(doc_summaries: List[str]) -> List[dict]:
+        content = """
+        あなたは会議の議事録を作成するアシスタントです。
+        これから会議の一部分ずつの要約を、時系列順に複数渡します。
+        これらを時系列を保ったまま1つの要約にまとめてください。
+        決定事項、今後やるべきタスク、数値や固有名詞は省略しないでください。
+
+        以下は要約のセットである：
+        """
+        return [{"role": "user", "content": content + "\n\n".join(doc_summaries)}]
+
+    @classmethod
+    def batch_summaries(
+        cls, doc_summaries: List[str], budget: int, max_item_tokens: int, model: str
+    ) -> List[List[str]]:
+        """
+        要約を順番を保ったまま、トークン数がbudgetに収まるバッチにまとめる
+        max_item_tokensを超える要約は分割しておくので、
+        budget >= 2 * (max_item_tokens + SEPARATOR_TOKENS) ならどの2つも同じバッチに入る
+        """
+        items = []
+        for summary in doc_summaries:
+            num_tokens = count_tokens(summary, model)
+            if num_tokens > max_item_tokens:
+                # 切れ目を文字の境界に合わせると最大3トークン伸びるので、その分短く切る
+                items.extend(
+                    split_tokens(summary, max(max_item_tokens - 3, 1), 0, model=model)
+                )
+            else:
+                items.append(TokenChunk(summary, num_tokens))
+
+        batches = []
+        batch, batch_tokens = [], 0
+        for item in items:
+            # 区切りの分を少し多めに見積もる
+            item_tokens = item.num_tokens + cls.SEPARATOR_TOKENS
+            if batch and batch_tokens + item_tokens > budget:
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(item.text)
+            batch_tokens += item_tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @classmethod
+    async def merge_summaries(
+        cls, doc_summaries: List[str], max_tokens: int, profile: ModelProfile
+    ):
+        """複数の要約を1つの要約にまとめる(tree reduceの途中の段)"""
+        messages = cls.build_merge_messages(doc_summaries)
+        num_tokens = num_tokens_from_messages(messages, model=profile.model)
+        response = await cls.create_chat_completion(
+            estimated_tokens=num_tokens + max_tokens,
+            model=profile.model,
+            messages=messages,
+            temperature=0,
+            max_tokens=max_tokens,
+        )
+        cls.record_usage(response["usage"], "reduce", profile.model)
+        return (
+            response["choices"][0]["message"]["content"],
+            cls.calculate_costs(response["usage"], profile.model),
+        )
+
+    @classmethod
+    def merge_limits(cls, profile: ModelProfile) -> Tuple[int, int]:
+        """
+        まとめ直した要約1つの最大トークン数と、1回のまとめ直しに入れる要約のトークン数
+        入力(2つ分と区切り)と出力で3等分し、2 * (最大トークン数 + 区切り) <= 入力 にする
+        """
+        merge_overhead = num_tokens_from_messages(
+            cls.build_merge_messages([]), model=profile.model
+        )
+        merge_max_tokens = (
+            profile.max_tokens - merge_overhead - 2 * cls.SEPARATOR_TOKENS
+        ) // 3
+        if profile.max_output_tokens is not None:
+            merge_max_tokens = min(merge_max_tokens, profile.max_output_tokens)
+        merge_budget = profile.max_tokens - merge_overhead - merge_max_tokens
+        return merge_max_tokens, merge_budget
+
+    @classmethod
+    async def tree_reduce(cls, doc_summaries: List[str], profile: ModelProfile):
+        """
+        1回のget_simple_summaryに収まるまで、要約をバッチ毎に並列でまとめ直す
+        途中の要約はどの2つも(区切りを含めて)1つのバッチに収まる長さにするので、
+        段毎に半分以下になる。減らなくなった場合や段数が上限を超えた場合は失敗させる
+        """
+        costs = 0
+        merge_max_tokens, merge_budget = cls.merge_limits(profile)
+        semaphore = asyncio.Semaphore(settings.MAP_CONCURRENCY)
+
+        async def merge(batch: List[str]):
+            # 要約が1つだけのバッチも、短くするためにまとめ直す
+            async with semaphore:
+                return await cls.merge_summaries(batch, merge_max_tokens, profile)
+
+        level = 0
+        while True:
+            messages, functions = cls.build_simple_summary_request(doc_summaries)
+            request_tokens = num_tokens_from_messages(
+                messages, model=profile.model
+            ) + num_tokens_from_functions(functions, model=profile.model)
+            if request_tokens + cls.REDUCE_OUTPUT_TOKENS <= profile.max_tokens:
+                return doc_summaries, costs
+
+            if level >= cls.TREE_REDUCE_MAX_LEVELS:
+                raise RuntimeError(
+                    f"tree reduce did not fit in {level} levels ({request_tokens} tokens)"
+                )
+            batches = cls.batch_summaries(
+                doc_summaries,
+                merge_budget,
+                max_item_tokens=merge_max_tokens,
+                model=profile.model,
+            )
+            # 1段目以降の要約はmerge_max_tokens以内なので、2つ以上あれば必ず減る
+            # 1つしか残っていないのに収まらない場合は、まとめ直しても変わらない
+            if level > 0 and len(batches) >= len(doc_summaries):
+                raise RuntimeError(
+                    f"tree reduce made no progress at level {level}: "
+                    f"{len(doc_summaries)} summaries, {request_tokens} tokens"
+                )
+            level += 1
+            logger.info(
+                f"tree reduce level {level}: {len(doc_summaries)} summaries, "
+                f"{request_tokens} tokens -> {len(batches)} batches"
+            )
+            results = await asyncio.gather(*[merge(batch) for batch in batches])
+            doc_summaries = [summary for summary, _ in results]
+            costs += sum(batch_costs for _, batch_costs in results)
+
+    @classmethod
+    async def get_simple_summary(
+        cls,
+        doc_summaries: List[str],
+        profile: Optional[ModelProfile] = None,
+        transcript: bool = False,
+    ):
+        """
+        transcriptがTrueの場合はdoc_summariesに文字起こしを1つだけ渡す(single pass)
+        plan_summaryで収まることを確認済みなので、tree reduceは行わない
+        """
+        profile = profile or cls.get_profile(settings.SUMMARY_REDUCE_MODEL)
+        costs = 0
+
+        if not transcript:
+            # 要約が1回のリクエストに収まらない場合は、先にtree reduceでまとめる
+            doc_summaries, tree_costs = await cls.tree_reduce(doc_summaries, profile)
+            costs += tree_costs
+
+        messages, functions = cls.build_simple_summary_request(
+            doc_summaries, transcript=transcript
+        )
+        message_tokens = num_tokens_from_messages(messages, model=profile.model)
+        functions_tokens = num_tokens_from_functions(functions, model=profile.model)
         logger.info(f"message_tokens: {message_tokens}")
         logger.info(f"functions_tokens: {functions_tokens}")
-        # TODO response_messagesのtoken数を計算して、token_maxを超えていたら、分割する
-        response = openai.ChatCompletion.create(
-            model=cls.MODEL,
+        max_tokens = max(
+            profile.max_tokens - message_tokens - functions_tokens, 0
+        )  # tokenをカウントして補正する
+        if profile.max_output_tokens is not None:
+            max_tokens = min(max_tokens, profile.max_output_tokens)
+        response = await cls.create_chat_completion(
+            estimated_tokens=message_tokens + functions_tokens + max_tokens,
+            model=profile.model,
             messages=messages,
             functions=functions,
             function_call={"name": "get_simple_summary"},
             temperature=0,
-            max_tokens=max(
-                cls.MAX_TOKENS - message_tokens - functions_tokens, 0
-            ),  # tokenをカウントして補正する
+            max_tokens=max_tokens,
         )
 
-        costs += (
-            response["usage"]["prompt_tokens"] * cls.COST_DICT[cls.MODEL]["input"]
-            + response["usage"]["completion_tokens"]
-            * cls.COST_DICT[cls.MODEL]["output"]
-        ) / 1000
+        costs += cls.calculate_costs(response["usage"], profile.model)
+        cls.record_usage(response["usage"], "reduce", profile.model)
 
         return response, costs
 
 
 def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
     """Return the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+    encoding = get_encoding(model)
     if model in {
         "gpt-3.5-turbo-0613",
         "gpt-3.5-turbo-16k-0613",
@@ -290,11 +730,7 @@ def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
 
 def num_tokens_from_functions(functions, model="gpt-3.5-turbo-0613"):
     """Return the number of tokens used by a list of functions."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+    encoding = get_encoding(model)
 
     num_tokens = 0
     for function in functions:
@@ -0,0 +1,475 @@
+import io
+import json
+import os
+import uuid
+from functools import partial
+from typing import Callable, Iterator, Tuple, Union
+
+import numpy as np
+import openai
+
+from app.core.config import settings
+from app.services.audio import decode_pcm, iter_voiced_chunks
+from app.services.cache import result_cache
+from app.services.checkpoint import JobCheckpoint, get_job_checkpoint
+from app.services.model import MinutesSummarizer as ms
+from app.services.model import Transcriber as tc
+from app.services.slack import slack_notifier
+from app.services.workspace import JobWorkspace
+from app.util.executor import run_in_cpu_executor
+from app.util.logger import get_logger
+from app.util.metrics import CHUNK_BUCKETS, metrics
+from app.util.split_audio import (
+    SegmentPlan,
+    plan_balanced_chunks,
+    split_audio_voiced,
+)
+
+logger = get_logger(__name__)
+
+openai.api_key = os.getenv("OPENAI_API_KEY")
+
+
+def report_nothing(stage: str, **info) -> None:
+    pass
+
+
+def publish_nothing(event_type: str, **data) -> None:
+    pass
+
+
+def plan_chunks(
+    speech_timestamps: list, sample_rate: int, audio: Union[np.ndarray, None] = None
+) -> SegmentPlan:
+    """音声区間を文字起こしのチャンクに分ける。audioがあれば音量を見て長い区間を切る"""
+    if settings.CHUNK_PLANNER == "greedy":
+        return split_audio_voiced(
+            speech_timestamps,
+            sample_rate=sample_rate,
+            chunk_min=settings.CHUNK_TARGET_SECONDS / 60,
+        )
+    return plan_balanced_chunks(
+        speech_timestamps,
+        sample_rate=sample_rate,
+        target_seconds=settings.CHUNK_TARGET_SECONDS,
+        num_chunks=settings.CHUNK_COUNT,
+        max_segment_seconds=settings.CHUNK_SEGMENT_MAX_SECONDS,
+        tolerance=settings.CHUNK_BALANCE_TOLERANCE,
+        audio=audio,
+    )
+
+
+def detect_voiced_chunks(
+    input_path: str,
+    content_hash: str,
+    checkpoint: JobCheckpoint,
+    duration: Union[float, None] = None,
+    workspace: Union[JobWorkspace, None] = None,
+) -> Tuple[SegmentPlan, Iterator]:
+    """
+    デコードとVADを行う。CPUを使うのでcpu_executorで実行する
+    動画もffmpegで直接PCMにデコードするので、音声の抽出は不要
+    workspaceがあれば、デコードしたPCMはそのディレクトリのmmapに置く
+    VAD(torch)はデコードの後にimportするので、FAST_STARTでワーカーの起動直後でも
+    VADモデルのロードとデコードが並行して進む
+    """
+    # VADで無音区間を削除
+    logger.info("Removing silent parts")
+
+    SAMPLING_RATE = settings.VAD_SAMPLING_RATE
+    # VADの結果は音声の内容だけで決まる
+    vad_key = (content_hash, SAMPLING_RATE)
+    speech_timestamps = checkpoint.load("vad")
+    if speech_timestamps is None:
+        speech_timestamps = result_cache.get("vad", vad_key)
+    if settings.VAD_STREAMING:
+        # 音声全体をメモリに載せず、フレーム単位で読みながらVADを行う
+        if speech_timestamps is None:
+            from app.services.vad import vad_pool
+
+            # デコードとVADが交互に進むので、まとめてvadとして記録する
+            with metrics.span("vad"):
+                speech_timestamps = list(
+                    vad_pool.stream_speech_timestamps(
+                        input_path, frame_seconds=settings.VAD_FRAME_SECONDS
+                    )
+                )
+            result_cache.put("vad", vad_key, speech_timestamps)
+            checkpoint.save("vad", speech_timestamps)
+        with metrics.span("split"):
+            plan = plan_chunks(speech_timestamps, SAMPLING_RATE)
+        voiced_chunks = iter_voiced_chunks(
+            input_path,
+            plan,
+            frame_samples=settings.VAD_FRAME_SECONDS * SAMPLING_RATE,
+            sampling_rate=SAMPLING_RATE,
+        )
+    else:
+        # ffmpeg一回でデコードしたPCMをVADと切り出しの両方で使う
+        with metrics.span("decode"):
+            wav_array = decode_pcm(
+                input_path,
+                SAMPLING_RATE,
+                duration=duration,
+                max_seconds=settings.MAX_AUDIO_SECONDS,
+                allocate=(
+                    partial(workspace.array, "decode", name="pcm.f32")
+                    if workspace is not None
+                    else None
+                ),
+            )
+        if speech_timestamps is None:
+            import torch
+
+            from app.services.vad import vad_pool
+
+            # get speech timestamps from full audio file
+            # from_numpyはコピーせずにメモリを共有する
+            with metrics.span("vad"):
+                if settings.VAD_BATCH_SHARDS > 0:
+                    speech_timestamps = vad_pool.batched_speech_timestamps(
+                        wav_array,
+                        num_shards=settings.VAD_BATCH_SHARDS,
+                        context_seconds=settings.VAD_BATCH_CONTEXT_SECONDS,
+                        num_threads=settings.VAD_BATCH_THREADS,
+                    )
+                else:
+                    # モデルは起動時にロード済みのものをプールから借りる
+                    with vad_pool.acquire() as model:
+                        speech_timestamps = vad_pool.utils.get_speech_timestamps(
+                            torch.from_numpy(wav_array),
+                            model,
+                            sampling_rate=SAMPLING_RATE,
+                        )
+            result_cache.put("vad", vad_key, speech_timestamps)
+            checkpoint.save("vad", speech_timestamps)
+
+        # 音声区間はwavのスライス(view)のまま扱い、連結のコピーを作らない
+        with metrics.span("split"):
+            plan = plan_chunks(speech_timestamps, SAMPLING_RATE, audio=wav_array)
+        voiced_chunks = (
+            plan.chunk_views(wav_array, index) for index in range(len(plan))
+        )
+    logger.info(f"Voiced segments: {len(plan.segments)}, chunks: {len(plan)}")
+    return plan, iter(voiced_chunks)
+
+
+async def transcribe_audio(
+    input_path: str,
+    content_hash: str,
+    prompt: Union[str, None],
+    response_format: Union[str, None],
+    checkpoint: JobCheckpoint,
+    duration: Union[float, None] = None,
+    report: Callable[..., None] = report_nothing,
+    publish: Callable[..., None] = publish_nothing,
+    workspace: Union[JobWorkspace, None] = None,
+) -> str:
+    plan, voiced_chunks = await run_in_cpu_executor(
+        detect_voiced_chunks, input_path, content_hash, checkpoint, duration, workspace
+    )
+    report("vad", segments=len(plan.segments), chunks=len(plan))
+    publish("vad", segments=len(plan.segments), chunks=len(plan))
+    metrics.observe("minutes_job_chunks", len(plan), CHUNK_BUCKETS, stage="transcribe")
+
+    def encode_chunk(index: int) -> Union[io.BytesIO, None]:
+        # ストリーム処理ではここでデコードが進む
+        chunk_pieces = next(voiced_chunks)
+        # 文字起こし済みのチャンクはエンコードしない
+        if checkpoint.exists(f"transcript/{index:04d}"):
+            return None
+        # メモリ上でアップロードできる形式に一度だけエンコードする
+        with metrics.span("encode"):
+            audio_file = tc.encode_chunk(
+                chunk_pieces, sampling_rate=plan.sample_rate, name=f"chunk_{index:04d}"
+            )
+        if workspace is not None:
+            # エンコードしたチャンクはメモリ上にあるが、同じクォータで数える
+            workspace.record("encode", audio_file.getbuffer().nbytes)
+        return audio_file
+
+    async def encode_chunks():
+        for index in range(len(plan)):
+            yield await run_in_cpu_executor(encode_chunk, index)
+
+    def on_transcribed(index: int, transcript: str) -> None:
+        report("transcribe", chunk=index, chunks=len(plan))
+        # 終わった順に流れるので、クライアントはchunkで並べ直す
+        publish("transcript", chunk=index, chunks=len(plan), text=transcript)
+
+    # チャンク毎の文字起こしを並列で実行し、元の順番で結合する
+    # エンコードと並行して進むので、encodeの時間と重なる
+    with metrics.span("transcribe"):
+        chunk_transcripts = await tc.transcribe_files(
+            encode_chunks(),
+            prompt=prompt,
+            response_format=response_format,
+            max_workers=settings.WHISPER_CONCURRENCY,
+            checkpoint=checkpoint,
+            on_transcribed=on_transcribed,
+        )
+    return "".join(chunk_transcripts)
+
+
+def parse_simple_summary(simple_summary_response) -> Union[dict, None]:
+    response_message = simple_summary_response["choices"][0]["message"]
+    # Step 2: check if GPT wanted to call a function
+    if response_message.get("function_call"):
+        # Step 3: call the function
+        # Note: the JSON response may not always be valid; be sure to handle errors
+        try:
+            function_args = json.loads(response_message["function_call"]["arguments"])
+        except Exception as e:
+            logger.error(f"Error parsing function arguments: {e}")
+            function_args = None
+        return function_args
+    return None
+
+
+async def execute_summarize(
+    input_path: str,
+    filename: str,
+    content_hash: str,
+    prompt: Union[str, None] = None,
+    response_format: Union[str, None] = "text",
+    duration: Union[float, None] = None,
+    report: Callable[..., None] = report_nothing,
+    publish: Callable[..., None] = publish_nothing,
+    workspace: Union[JobWorkspace, None] = None,
+    job_id: Union[str, None] = None,
+) -> dict:
+    """
+    アップロードされた音声から文字起こしと要約を作成し、Slackに通知する
+    reportには進捗がステージ名と付加情報で渡される
+    publishにはチャンク毎の文字起こしや要約などの途中結果が渡される
+    workspaceには中間データを置き、ステージ毎のバイト数を数える
+    job_idが同じであれば(やり直し)途中結果から再開する
+    """
+    # 同じ音声のジョブが並行しても、先に終わった方が途中結果を消さないようにジョブ毎に分ける
+    checkpoint = get_job_checkpoint(job_id or uuid.uuid4().hex)
+
+    # アップロード時にprobe済みであればその結果を使う
+    probe = checkpoint.load("probe")
+    if probe is None:
+        if duration is None:
+            with metrics.span("probe"):
+                duration = await run_in_cpu_executor(tc.get_audio_duration, input_path)
+        probe = {"duration": duration}
+        checkpoint.save("probe", probe)
+    duration = probe["duration"]
+    if duration > settings.MAX_AUDIO_SECONDS:
+        raise ValueError("Too long audio file. (max 4 hours)")
+    report("probe", duration=duration)
+    publish("probe", duration=duration)
+
+    transcript_key = (content_hash, prompt, response_format)
+    transcript = result_cache.get("transcript", transcript_key)
+    whisper_cost = 0
+    if transcript is None:
+        # 元のアップロードはリトライに備えてワーカーが削除する
+        transcript = await transcribe_audio(
+            input_path,
+            content_hash,
+            prompt,
+            response_format,
+            checkpoint,
+            duration=duration,
+            report=report,
+            publish=publish,
+            workspace=workspace,
+        )
+        result_cache.put("transcript", transcript_key, transcript)
+        whisper_cost = duration * 0.006 / 60
+        metrics.inc("minutes_audio_seconds_total", duration, model="whisper-1")
+        metrics.inc("minutes_cost_dollars_total", whisper_cost, model="whisper-1")
+    else:
+        publish("transcript", chunk=0, chunks=1, text=transcript)
+    report("transcribe", done=True)
+    publish("transcript_done")
+
+    logger.info(f"Whisper cost: {whisper_cost} $")
+
+    total_costs = 0
+
+    # 文字起こしの長さから、mapを行うかとモデルを決める
+    plan = ms.plan_summary(transcript)
+    summary_key = (content_hash, prompt, response_format, *plan.key)
+
+    def on_summarized(index: int, num_chunks: int, summary: str) -> None:
+        report("map", chunk=index, chunks=num_chunks)
+        publish("summary", chunk=index, chunks=num_chunks, text=summary)
+
+    if plan.single_pass:
+        # 文字起こしをそのままSimpleSummaryに渡すので、チャンク毎の要約はない
+        map_result = {"doc_summaries": [], "costs": 0}
+    else:
+        map_result = result_cache.get("map", summary_key)
+    if map_result is None:
+        # chunk毎に要約を作成
+        with metrics.span("map"):
+            response_messages, map_costs = await ms.map_sammaries(
+                transcript,
+                checkpoint,
+                on_summarized=on_summarized,
+                profile=plan.map_profile,
+            )
+        result_cache.put(
+            "map", summary_key, {"doc_summaries": response_messages, "costs": map_costs}
+        )
+    else:
+        response_messages, map_costs = map_result["doc_summaries"], 0
+        for index, summary in enumerate(response_messages):
+            publish("summary", chunk=index, chunks=len(response_messages), text=summary)
+    total_costs += map_costs
+
+    logger.info(f"total costs map: {total_costs}")
+    logger.info(f"response_messages: {response_messages}")
+
+    doc_summaries: list = response_messages
+
+    output = dict()
+
+    # TPM制限はRateLimiterで必要な分だけ待つ
+    async def get_simple_summary(doc_summaries: list):
+        if plan.single_pass:
+            response, costs = await ms.get_simple_summary(
+                [transcript], plan.reduce_profile, transcript=True
+            )
+        else:
+            response, costs = await ms.get_simple_summary(
+                doc_summaries, plan.reduce_profile
+            )
+        logger.info(f"chat create: {response}")
+        return response, costs
+
+    report("reduce")
+    summary_result = checkpoint.load("reduce")
+    if summary_result is None:
+        summary_result = result_cache.get("summary", summary_key)
+    if summary_result is None:
+        with metrics.span("reduce"):
+            simple_summary_response, simple_summary_costs = await get_simple_summary(
+                doc_summaries
+            )
+        simple_summary = parse_simple_summary(simple_summary_response)
+        usage = simple_summary_response["usage"]
+        # 関数の引数が壊れていた場合はキャッシュしない
+        if simple_summary is not None:
+            summary_result = {
+                "simple_summary": simple_summary,
+                "usage": usage,
+                "costs": simple_summary_costs,
+            }
+            checkpoint.save("reduce", summary_result)
+            result_cache.put("summary", summary_key, summary_result)
+    else:
+        simple_summary = summary_result["simple_summary"]
+        usage = summary_result["usage"]
+        simple_summary_costs = 0
+
+    publish("simple_summary", simple_summary=simple_summary)
+    output["simple_summary"] = simple_summary
+    output["doc_summaries"] = doc_summaries
+    output["transcript"] = transcript
+    # 結果を加工
+    total_tokens = 0
+    prompt_tokens = 0
+    completion_tokens = 0
+
+    total_tokens += usage["total_tokens"]
+    prompt_tokens += usage["prompt_tokens"]
+    completion_tokens += usage["completion_tokens"]
+    logger.info(f"total tokens: {total_tokens}")
+
+    # gpt-4
+    logger.info(f"Whisper cost: {whisper_cost} $")
+    logger.info(f"map cost: {map_costs} $")
+    logger.info(f"simple summary cost: {simple_summary_costs} $")
+    logger.info(f"GPT cost: {map_costs+simple_summary_costs} $")
+    logger.info(f"Total cost: {whisper_cost + map_costs+simple_summary_costs} $")
+    logger.info(f"cache stats: {result_cache.stats()}")
+
+    # Slack通知のブロックを作成
+    report("slack")
+    blocks = []
+
+    # Header
+    blocks.append(
+        {
+            "type": "header",
+            "text": {
+                "type": "plain_text",
+                "text": f"{filename}",
+                "emoji": True,
+            },
+        }
+    )
+
+    # Summary
+    blocks.append(
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": f"*Summary:* {output['simple_summary']['summary']}",
+            },
+        }
+    )
+
+    # Bullet Points
+    bullet_points_text = "\n".join(
+        [f"• {point}" for point in output["simple_summary"]["summary_bullet"]]
+    )
+    blocks.append(
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": f"*Bullet Points:*\n{bullet_points_text}",
+            },
+        }
+    )
+
+    # Decisions
+    decisions_text = "\n".join(
+        [f"• {decision}" for decision in output["simple_summary"]["decisions"]]
+    )
+    blocks.append(
+        {
+            "type": "section",
+            "text": {"type": "mrkdwn", "text": f"*Decisions:*\n{decisions_text}"},
+        }
+    )
+
+    # Tasks
+    tasks_text = "\n".join([f"• {task}" for task in output["simple_summary"]["tasks"]])
+    blocks.append(
+        {
+            "type": "section",
+            "text": {"type": "mrkdwn", "text": f"*Tasks:*\n{tasks_text}"},
+        }
+    )
+
+    # Long Summary(single passの場合はチャンク毎の要約がない)
+    if output["doc_summaries"]:
+        long_summary_text = "\n".join(
+            [f"• {summary}" for summary in output["doc_summaries"]]
+        )
+        blocks.append(
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": f"*Long Summary:*\n{long_summary_text}",
+                },
+            }
+        )
+
+    # Transcriptのアップロードと通知はoutboxから別に送るので、Slackが遅くても待たない
+    output["slack_message_id"] = slack_notifier.enqueue(filename, blocks, transcript)
+
+    # 最後まで完了したので途中結果は不要
+    checkpoint.clear()
+
+    # 結果はジョブの結果として保存される
+    return output
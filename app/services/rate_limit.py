@@ -0,0 +1,180 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Union
+
+from app.core.config import settings
+from app.util.logger import get_logger
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS token_buckets (
+    name TEXT PRIMARY KEY,
+    available REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class TokenBucket:
+    """
+    1分あたりの上限を秒単位で補充するトークンバケット
+    足りない分は前借りして待ち時間を返すので、待ちは予約した順になる
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.refill_per_second = per_minute / 60
+        self._available = float(per_minute)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """amount分を確保し、使えるようになるまでの秒数を返す"""
+        # 上限を超える要求は上限分だけ待てば通るようにする
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._available = min(
+                self.capacity,
+                self._available + (now - self._updated_at) * self.refill_per_second,
+            )
+            self._updated_at = now
+            self._available -= amount
+            if self._available >= 0:
+                return 0.0
+            return -self._available / self.refill_per_second
+
+
+class SQLiteTokenBucket:
+    """
+    TokenBucketと同じ動きで、残りをSQLiteに置いてワーカープロセス間で共有する
+    ワーカー毎にバケットを持つと、全体ではWORKER_PROCESSES倍の速さで送ってしまう
+    """
+
+    def __init__(self, db_path: str, name: str, per_minute: int):
+        self.db_path = db_path
+        self.name = name
+        self.capacity = per_minute
+        self.refill_per_second = per_minute / 60
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(SCHEMA)
+            finally:
+                conn.close()
+            self._initialized = True
+        # 接続はスレッド・プロセス間で共有しない
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def reserve(self, amount: float) -> float:
+        """amount分を確保し、使えるようになるまでの秒数を返す"""
+        amount = min(amount, self.capacity)
+        conn = self._connect()
+        try:
+            # 他のプロセスと同時に残りを更新しないように書き込みロックを取る
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # プロセス間で比べるので、monotonicではなく時刻を使う
+                now = time.time()
+                row = conn.execute(
+                    "SELECT available, updated_at FROM token_buckets WHERE name = ?",
+                    (self.name,),
+                ).fetchone()
+                available = float(self.capacity)
+                if row is not None:
+                    available = min(
+                        self.capacity,
+                        row[0] + max(now - row[1], 0) * self.refill_per_second,
+                    )
+                available -= amount
+                conn.execute(
+                    """
+                    INSERT INTO token_buckets (name, available, updated_at)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (name) DO UPDATE
+                    SET available = excluded.available, updated_at = excluded.updated_at
+                    """,
+                    (self.name, available, now),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        if available >= 0:
+            return 0.0
+        return -available / self.refill_per_second
+
+
+Bucket = Union[TokenBucket, SQLiteTokenBucket]
+
+
+class RateLimiter:
+    """
+    OpenAI APIのTPM・RPM制限に合わせてリクエスト前に予算を確保する
+    バケットをSQLiteに置く場合は、全てのワーカープロセスのジョブで予算を共有する
+    """
+
+    def __init__(self, tokens: Bucket, requests: Bucket):
+        self.tokens = tokens
+        self.requests = requests
+
+    def reserve(self, tokens: int = 0) -> float:
+        wait_seconds = self.requests.reserve(1)
+        if tokens:
+            wait_seconds = max(wait_seconds, self.tokens.reserve(tokens))
+        if wait_seconds > 0:
+            logger.info(f"Rate limit: waiting {wait_seconds:.1f}s for {tokens} tokens")
+        return wait_seconds
+
+    def acquire(self, tokens: int = 0) -> float:
+        wait_seconds = self.reserve(tokens)
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        return wait_seconds
+
+    async def acquire_async(self, tokens: int = 0) -> float:
+        # SQLiteのロック待ちでイベントループを止めない
+        wait_seconds = await asyncio.to_thread(self.reserve, tokens)
+        if wait_seconds > 0:
+            await asyncio.sleep(wait_seconds)
+        return wait_seconds
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def create_bucket(name: str, per_minute: int) -> Bucket:
+    if settings.RATE_LIMIT_DB_PATH:
+        return SQLiteTokenBucket(settings.RATE_LIMIT_DB_PATH, name, per_minute)
+    return TokenBucket(per_minute)
+
+
+def get_rate_limiter(model: str) -> RateLimiter:
+    """
+    モデル毎のRateLimiterを返す
+    RATE_LIMIT_DB_PATHが空の場合、予算はプロセス毎になる(ワーカー数倍になる)
+    """
+    with _rate_limiters_lock:
+        if model not in _rate_limiters:
+            if model.startswith("whisper"):
+                tokens_per_minute, requests_per_minute = 0, settings.WHISPER_RPM
+            else:
+                tokens_per_minute = settings.OPENAI_TPM
+                requests_per_minute = settings.OPENAI_RPM
+            _rate_limiters[model] = RateLimiter(
+                create_bucket(f"{model}:tokens", tokens_per_minute),
+                create_bucket(f"{model}:requests", requests_per_minute),
+            )
+        return _rate_limiters[model]
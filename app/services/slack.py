@@ -0,0 +1,312 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from app.core.config import settings
+from app.util.logger import get_logger
+from app.util.metrics import metrics
+
+logger = get_logger(__name__)
+
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS slack_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    status TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    blocks TEXT NOT NULL,
+    transcript TEXT NOT NULL,
+    file_url TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS slack_outbox_status_next_attempt_at
+    ON slack_outbox (status, next_attempt_at);
+"""
+
+
+class SlackError(Exception):
+    """Slackへの送信の失敗。retry_afterがあればその秒数待ってから再送する"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class SlackNotifier:
+    """
+    議事録のSlackへの通知をSQLiteのoutboxに積み、ジョブとは別に送る
+    Slackが遅い・落ちている場合もワーカーは待たず、失敗した通知は間隔を空けて再送する
+    ファイルのアップロードが済んだ通知は、再送時にWebhookだけを送り直す
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        api_base: str,
+        webhook_url: Optional[str],
+        token: Optional[str],
+        channel: str,
+        max_attempts: int = 8,
+        backoff: float = 5.0,
+        max_backoff: float = 600.0,
+    ):
+        self.db_path = db_path
+        self.api_base = api_base
+        self.webhook_url = webhook_url
+        self.token = token
+        self.channel = channel
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._initialized = False
+
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(SCHEMA)
+            finally:
+                conn.close()
+            self._initialized = True
+        # 接続はスレッド・プロセス間で共有しない
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, filename: str, blocks: List[dict], transcript: str) -> int:
+        """通知をoutboxに積む。送信はdispatcherが行う"""
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                """
+                INSERT INTO slack_outbox (
+                    status, filename, blocks, transcript, next_attempt_at, created_at
+                ) VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    PENDING,
+                    filename,
+                    json.dumps(blocks, ensure_ascii=False),
+                    transcript,
+                    now,
+                    now,
+                ),
+            )
+        logger.info(f"slack message queued: {cursor.lastrowid} ({filename})")
+        return cursor.lastrowid
+
+    def due_messages(self, limit: int) -> List[Dict[str, Any]]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT * FROM slack_outbox
+                WHERE status = ? AND next_attempt_at <= ?
+                ORDER BY next_attempt_at LIMIT ?
+                """,
+                (PENDING, time.time(), limit),
+            ).fetchall()
+        messages = [dict(row) for row in rows]
+        for message in messages:
+            message["blocks"] = json.loads(message["blocks"])
+        return messages
+
+    def _save_file_url(self, message_id: int, file_url: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE slack_outbox SET file_url = ? WHERE id = ?",
+                (file_url, message_id),
+            )
+
+    def _mark_sent(self, message_id: int) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE slack_outbox
+                SET status = ?, attempts = attempts + 1, error = NULL, sent_at = ?
+                WHERE id = ?
+                """,
+                (SENT, time.time(), message_id),
+            )
+
+    def _mark_failed(self, message: Dict[str, Any], error: SlackError) -> bool:
+        """失敗を記録する。試行回数が残っていれば再送を予約してTrueを返す"""
+        attempts = message["attempts"] + 1
+        retry = attempts < self.max_attempts
+        wait_seconds = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        if error.retry_after is not None:
+            wait_seconds = max(wait_seconds, error.retry_after)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE slack_outbox
+                SET status = ?, attempts = ?, next_attempt_at = ?, error = ?
+                WHERE id = ?
+                """,
+                (
+                    PENDING if retry else FAILED,
+                    attempts,
+                    time.time() + wait_seconds,
+                    str(error),
+                    message["id"],
+                ),
+            )
+        if retry:
+            logger.warning(
+                f"slack message {message['id']} failed ({error}), "
+                f"retrying in {wait_seconds:.0f}s"
+            )
+        else:
+            logger.error(
+                f"slack message {message['id']} failed after {attempts} attempts: "
+                f"{error}"
+            )
+        return retry
+
+    @staticmethod
+    def _retry_after(response: aiohttp.ClientResponse) -> Optional[float]:
+        try:
+            return float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return None
+
+    async def _upload_transcript(
+        self, session: aiohttp.ClientSession, message: Dict[str, Any]
+    ) -> str:
+        """文字起こしをスニペットとしてアップロードし、ファイルのURLを返す"""
+        async with session.post(
+            f"{self.api_base}/files.upload",
+            headers={"Authorization": f"Bearer {self.token}"},
+            data={
+                "channels": self.channel,
+                "filename": f"transcript_{message['filename']}.txt",
+                "filetype": "text",
+                "content": message["transcript"],
+            },
+        ) as response:
+            if response.status != 200:
+                raise SlackError(
+                    f"files.upload returned {response.status}",
+                    self._retry_after(response),
+                )
+            upload_result = await response.json(content_type=None)
+        # Slack APIはエラーも200で返す
+        if not upload_result.get("ok"):
+            raise SlackError(f"files.upload failed: {upload_result.get('error')}")
+        return upload_result["file"]["url_private"]
+
+    async def _post_webhook(
+        self, session: aiohttp.ClientSession, blocks: List[dict]
+    ) -> None:
+        json_data = {
+            "username": "ボイスレコーダーくん",
+            "icon_emoji": ":star2:",
+            "blocks": blocks,
+        }
+        async with session.post(
+            self.webhook_url,
+            data=json.dumps(json_data),
+            headers={"Content-Type": "application/json"},
+        ) as response:
+            if response.status != 200:
+                raise SlackError(
+                    f"webhook returned {response.status}: {await response.text()}",
+                    self._retry_after(response),
+                )
+
+    async def deliver(
+        self, session: aiohttp.ClientSession, message: Dict[str, Any]
+    ) -> bool:
+        """通知を1件送る。成功した場合はTrueを返す"""
+        try:
+            with metrics.span("slack"):
+                file_url = message["file_url"]
+                if file_url is None:
+                    file_url = await self._upload_transcript(session, message)
+                    # 再送時に同じファイルをもう一度アップロードしない
+                    self._save_file_url(message["id"], file_url)
+                blocks = message["blocks"] + [
+                    {
+                        "type": "section",
+                        "text": {
+                            "type": "mrkdwn",
+                            "text": f"*Transcript:*\n<{file_url}|transcript.txt>",
+                        },
+                    }
+                ]
+                await self._post_webhook(session, blocks)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = SlackError(f"{e.__class__.__name__}: {e}")
+        except SlackError as e:
+            error = e
+        except Exception as e:
+            # 想定外の応答(JSONでない・fileがない等)も失敗として記録する
+            # ここで落とすとdispatcherが止まり、試行回数も増えないまま送り直し続ける
+            logger.exception(f"unexpected error sending slack message {message['id']}")
+            error = SlackError(f"{e.__class__.__name__}: {e}")
+        else:
+            self._mark_sent(message["id"])
+            metrics.inc("minutes_slack_messages_total", result="sent")
+            logger.info(f"slack message sent: {message['id']}")
+            return True
+        retry = self._mark_failed(message, error)
+        metrics.inc(
+            "minutes_slack_messages_total", result="retrying" if retry else "failed"
+        )
+        return False
+
+    async def dispatch_once(self, session: aiohttp.ClientSession) -> int:
+        """送信時刻になった通知をまとめて送り、送った件数を返す"""
+        messages = self.due_messages(settings.SLACK_CONCURRENCY)
+        if messages:
+            await asyncio.gather(
+                *[self.deliver(session, message) for message in messages]
+            )
+        return len(messages)
+
+    async def run(self) -> None:
+        """outboxを監視して送り続ける。接続はセッションで使い回す"""
+        connector = aiohttp.TCPConnector(limit=settings.SLACK_CONCURRENCY)
+        timeout = aiohttp.ClientTimeout(total=settings.SLACK_TIMEOUT_SECONDS)
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout
+        ) as session:
+            while True:
+                try:
+                    sent = await self.dispatch_once(session)
+                except sqlite3.Error:
+                    logger.exception("failed to read the slack outbox")
+                    sent = 0
+                if sent == 0:
+                    await asyncio.sleep(settings.SLACK_POLL_SECONDS)
+
+
+slack_notifier = SlackNotifier(
+    settings.SLACK_OUTBOX_DB_PATH,
+    settings.SLACK_API_BASE,
+    # Slack Webhook URL
+    webhook_url=os.getenv("WEBHOOK_URL"),
+    token=os.getenv("slack_token"),
+    channel=settings.SLACK_CHANNEL,
+    max_attempts=settings.SLACK_MAX_ATTEMPTS,
+    backoff=settings.SLACK_RETRY_BACKOFF,
+    max_backoff=settings.SLACK_RETRY_MAX_BACKOFF,
+)
@@ -0,0 +1,82 @@
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, NamedTuple
+
+import numpy as np
+
+from app.util.logger import get_logger
+
+if TYPE_CHECKING:
+    import tiktoken
+
+logger = get_logger(__name__)
+
+
+class TokenChunk(NamedTuple):
+    text: str
+    num_tokens: int
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> "tiktoken.Encoding":
+    """
+    モデル毎のエンコーダを1度だけ作って使い回す
+    BPEのファイルはTIKTOKEN_CACHE_DIRにあればそこから読む(イメージのビルド時に置いておく)
+    """
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        logger.warning(f"model {model} not found. Using cl100k_base encoding.")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str) -> int:
+    return len(get_encoding(model).encode(text))
+
+
+def split_tokens(
+    text: str, chunk_size: int, chunk_overlap: int, model: str
+) -> List[TokenChunk]:
+    """
+    テキストを1度だけトークン化し、トークン列をchunk_size毎に
+    chunk_overlapずつ重ねて切り出す
+    日本語はトークンの途中で文字が分かれることがあるので、
+    文字の境界になる位置まで切れ目をずらす
+    """
+    if not text:
+        return []
+    if chunk_overlap >= chunk_size:
+        raise ValueError("chunk_overlap must be smaller than chunk_size")
+
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text)
+    text_bytes = text.encode("utf-8")
+
+    # 各トークンの開始位置のバイトオフセット
+    token_bytes = encoding.decode_tokens_bytes(tokens)
+    offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in token_bytes], out=offsets[1:])
+    # UTF-8の継続バイト(0b10xxxxxx)から始まる位置では切らない
+    byte_array = np.frombuffer(text_bytes + b"\0", dtype=np.uint8)
+    is_boundary = (byte_array[offsets] & 0xC0) != 0x80
+
+    def snap(index: int) -> int:
+        while index < len(tokens) and not is_boundary[index]:
+            index += 1
+        return index
+
+    chunks = []
+    start = 0
+    while start < len(tokens):
+        end = snap(min(start + chunk_size, len(tokens)))
+        chunks.append(
+            TokenChunk(
+                text_bytes[offsets[start] : offsets[end]].decode("utf-8"),
+                end - start,
+            )
+        )
+        if end >= len(tokens):
+            break
+        start = snap(max(end - chunk_overlap, start + 1))
+    return chunks
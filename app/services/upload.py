@@ -0,0 +1,312 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from multipart.multipart import MultipartParser, parse_options_header
+
+from app.core.config import settings
+from app.util.logger import get_logger
+from app.util.media_header import CONTAINER_EXTENSIONS, MediaHeader, sniff_media
+
+logger = get_logger(__name__)
+
+
+class UnsupportedUpload(ValueError):
+    """残りを読む前に弾くアップロード"""
+
+
+def check_media_header(head: bytes, filename: str) -> MediaHeader:
+    """先頭のバイト列が拡張子どおりの形式で、4時間以内であることを確認する"""
+    header = sniff_media(head)
+    _, ext = os.path.splitext(filename)
+    if header is None or ext.lower() not in CONTAINER_EXTENSIONS[header.container]:
+        raise UnsupportedUpload("Unsupported file type")
+    if header.duration is not None and header.duration > settings.MAX_AUDIO_SECONDS:
+        raise UnsupportedUpload("Too long audio file. (max 4 hours)")
+    return header
+
+
+def file_sha256(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(settings.UPLOAD_BUFFER_BYTES)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+class UploadWriter:
+    """
+    受け取ったバイト列を固定長のバッファにまとめてファイルへ書き出す
+    先頭がUPLOAD_SNIFF_BYTES溜まった時点で形式と長さを確認する
+    offsetを指定すると途中から追記する(再開可能なアップロード用)
+    limitを超えるバイト数が届いた時点で、残りを読まずにUnsupportedUploadを送出する
+    """
+
+    def __init__(
+        self,
+        path: str,
+        filename: str,
+        offset: int = 0,
+        header: Optional[MediaHeader] = None,
+        limit: Optional[int] = None,
+    ):
+        self.path = path
+        self.filename = filename
+        self.offset = offset
+        self.header = header
+        self.limit = limit
+        # 先頭から書く場合だけ内容のハッシュが計算できる
+        self.hasher = hashlib.sha256() if offset == 0 else None
+        self._head = bytearray()
+        self._buffer = bytearray()
+        self._file = open(path, "r+b" if offset else "wb")
+        self._file.seek(offset)
+        self._file.truncate()
+        if header is None and offset > 0:
+            # 前回のアップロードが短くて確認できていない
+            with open(path, "rb") as f:
+                self._head += f.read(settings.UPLOAD_SNIFF_BYTES)
+
+    def _flush(self) -> None:
+        if not self._buffer:
+            return
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        if self.hasher is not None:
+            self.hasher.update(data)
+        self._file.write(data)
+
+    def _sniff(self, force: bool = False) -> None:
+        if self.header is not None:
+            return
+        if len(self._head) >= settings.UPLOAD_SNIFF_BYTES or (force and self._head):
+            self.header = check_media_header(bytes(self._head), self.filename)
+            self._head = bytearray()
+
+    async def write(self, data: bytes) -> None:
+        if self.limit is not None and self.offset + len(data) > self.limit:
+            raise UnsupportedUpload("Upload exceeds declared size")
+        if self.header is None:
+            self._head += data[: settings.UPLOAD_SNIFF_BYTES - len(self._head)]
+            self._sniff()
+        self._buffer += data
+        self.offset += len(data)
+        if len(self._buffer) >= settings.UPLOAD_BUFFER_BYTES:
+            await run_in_threadpool(self._flush)
+
+    async def close(self) -> None:
+        try:
+            await run_in_threadpool(self._flush)
+        finally:
+            self._file.close()
+
+    def ensure_header(self) -> MediaHeader:
+        """アップロードの完了時に、短いファイルでも形式を確認する"""
+        self._sniff(force=True)
+        if self.header is None:
+            raise UnsupportedUpload("Unsupported file type")
+        return self.header
+
+    @property
+    def content_hash(self) -> Optional[str]:
+        return self.hasher.hexdigest() if self.hasher is not None else None
+
+
+class MultipartUpload:
+    """
+    multipart/form-dataの本体を一時ファイルに書き出さずに読み、fieldのファイルの中身を返す
+    Starletteのフォームの解析(UploadFile)は本体を全て受け取ってから返すので、
+    形式の確認や受付の制限で断る場合も最後まで受信してしまう
+    """
+
+    def __init__(self, content_type: str, field: str):
+        media_type, params = parse_options_header(content_type)
+        if media_type != b"multipart/form-data" or b"boundary" not in params:
+            raise UnsupportedUpload("Expected multipart/form-data")
+        self.field = field
+        self.filename: Optional[str] = None
+        # fieldのパートを最後まで読んだ
+        self.finished = False
+        self._in_field = False
+        self._chunks: List[bytes] = []
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._parser = MultipartParser(
+            params[b"boundary"],
+            {
+                "on_part_begin": self._on_part_begin,
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_header_end": self._on_header_end,
+                "on_headers_finished": self._on_headers_finished,
+            },
+        )
+
+    def _on_part_begin(self) -> None:
+        self._disposition = b""
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._in_field:
+            self._chunks.append(data[start:end])
+
+    def _on_part_end(self) -> None:
+        if self._in_field:
+            self._in_field = False
+            self.finished = True
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._disposition)
+        # 最初のfieldのファイルだけを読む
+        if (
+            self.filename is None
+            and options.get(b"name") == self.field.encode()
+            and b"filename" in options
+        ):
+            self.filename = options[b"filename"].decode("utf-8", errors="replace")
+            self._in_field = True
+
+    def _feed(self, data: bytes) -> List[bytes]:
+        self._parser.write(data)
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+    async def read_filename(self, stream: AsyncIterator[bytes]) -> str:
+        """fieldのパートのヘッダまで読み、ファイル名を返す"""
+        async for data in stream:
+            self._chunks = self._feed(data)
+            if self.filename is not None:
+                return self.filename
+        raise UnsupportedUpload(f"{self.field} is required")
+
+    async def iter_file(self, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """read_filenameの続きから、fieldのファイルの中身を返す。後ろのパートは読まない"""
+        chunks, self._chunks = self._chunks, []
+        for chunk in chunks:
+            yield chunk
+        if self.finished:
+            return
+        async for data in stream:
+            for chunk in self._feed(data):
+                yield chunk
+            if self.finished:
+                return
+        raise UnsupportedUpload("Incomplete multipart body")
+
+
+class UploadStore:
+    """
+    再開可能なアップロードの途中のファイルとメタデータを管理する
+    オフセットは書き込み済みのファイルサイズそのもの
+    """
+
+    def __init__(self, directory: str, ttl_seconds: int):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+
+    def data_path(self, upload_id: str) -> str:
+        return os.path.join(self.directory, f"{upload_id}.part")
+
+    def _meta_path(self, upload_id: str) -> str:
+        return os.path.join(self.directory, f"{upload_id}.json")
+
+    def create(self, filename: str, size: Optional[int] = None) -> Dict[str, Any]:
+        self.cleanup_expired()
+        os.makedirs(self.directory, exist_ok=True)
+        upload_id = uuid.uuid4().hex
+        meta = {
+            "upload_id": upload_id,
+            "filename": filename,
+            "size": size,
+            "header": None,
+            "created_at": time.time(),
+        }
+        open(self.data_path(upload_id), "wb").close()
+        self.save_meta(meta)
+        meta["offset"] = 0
+        return meta
+
+    def get(self, upload_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._meta_path(upload_id)) as f:
+                meta = json.load(f)
+            meta["offset"] = os.path.getsize(self.data_path(upload_id))
+        except (FileNotFoundError, ValueError):
+            return None
+        return meta
+
+    def save_meta(self, meta: Dict[str, Any]) -> None:
+        meta = {key: value for key, value in meta.items() if key != "offset"}
+        tmp_path = self._meta_path(meta["upload_id"]) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path(meta["upload_id"]))
+
+    def open_writer(self, meta: Dict[str, Any], offset: int) -> UploadWriter:
+        """作成時に宣言されたサイズを超えた時点で書き込みを止める"""
+        header = MediaHeader(*meta["header"]) if meta["header"] else None
+        return UploadWriter(
+            self.data_path(meta["upload_id"]),
+            meta["filename"],
+            offset,
+            header,
+            limit=meta["size"],
+        )
+
+    def finish(self, upload_id: str, input_path: str) -> None:
+        """完了したアップロードをジョブの入力として移動する"""
+        os.replace(self.data_path(upload_id), input_path)
+        os.remove(self._meta_path(upload_id))
+
+    def remove(self, upload_id: str) -> None:
+        for path in (self.data_path(upload_id), self._meta_path(upload_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def cleanup_expired(self) -> None:
+        """完了しないまま残ったアップロードを削除する"""
+        if not os.path.isdir(self.directory):
+            return
+        now = time.time()
+        for name in os.listdir(self.directory):
+            upload_id, ext = os.path.splitext(name)
+            if ext != ".part":
+                continue
+            try:
+                expired = (
+                    now - os.path.getmtime(os.path.join(self.directory, name))
+                    > self.ttl_seconds
+                )
+            except FileNotFoundError:
+                continue
+            if expired:
+                logger.info(f"removing expired upload: {upload_id}")
+                self.remove(upload_id)
+
+
+upload_store = UploadStore(
+    os.path.join(settings.UPLOAD_DIR, "partial"), settings.UPLOAD_TTL_SECONDS
+)
@@ -0,0 +1,349 @@
+import math
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from contextlib import closing, contextmanager
+from typing import Dict, Iterator, List
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from app.core.config import settings
+from app.services.audio import iter_pcm_frames, pcm_to_float
+from app.util.logger import get_logger
+
+# ジョブのスレッド間でtorchのスレッドを取り合わないようにする
+torch.set_num_threads(1)
+logger = get_logger(__name__)
+
+VADUtils = namedtuple(
+    "VADUtils",
+    [
+        "get_speech_timestamps",
+        "save_audio",
+        "read_audio",
+        "VADIterator",
+        "collect_chunks",
+    ],
+)
+
+
+_torch_threads_lock = threading.Lock()
+_torch_threads_users = 0
+_torch_threads_previous = 1
+
+
+@contextmanager
+def torch_threads(num_threads: int):
+    """
+    一時的にtorchのスレッド数を変える
+    スレッド数はプロセス全体の設定なので、並行するバッチ推論が互いの設定を戻さないよう、
+    最初に入った時の値を最後に抜けた時に戻す
+    その間は同じプロセスの他のtorchの演算(逐次のVAD等)もこのスレッド数で動く
+    """
+    global _torch_threads_users, _torch_threads_previous
+    with _torch_threads_lock:
+        if _torch_threads_users == 0:
+            _torch_threads_previous = torch.get_num_threads()
+        _torch_threads_users += 1
+        torch.set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        with _torch_threads_lock:
+            _torch_threads_users -= 1
+            if _torch_threads_users == 0:
+                torch.set_num_threads(_torch_threads_previous)
+
+
+def batch_threads(num_threads: int = 0) -> int:
+    """
+    バッチ推論で使うtorchのスレッド数
+    0の場合は、CPUのコアをワーカープロセスとCPU_EXECUTOR_WORKERSのスレッドで分けた数
+    """
+    if num_threads > 0:
+        return num_threads
+    slots = max(settings.WORKER_PROCESSES * settings.CPU_EXECUTOR_WORKERS, 1)
+    return max((os.cpu_count() or 1) // slots, 1)
+
+
+def batched_speech_probs(
+    model,
+    audio: torch.Tensor,
+    sampling_rate: int = 16000,
+    window_size: int = 512,
+    num_shards: int = 8,
+    context_windows: int = 64,
+) -> np.ndarray:
+    """
+    音声をnum_shards個の区間に分け、各区間の窓を1つのバッチとしてまとめて推論する
+    モデルの呼び出し回数が1/num_shardsになり、バッチの演算は複数コアで並列に行われる
+    先頭以外の区間はcontext_windows分前から推論してLSTMの状態を温め、その分は捨てる
+    """
+    num_windows = math.ceil(len(audio) / window_size)
+    if num_windows == 0:
+        return np.zeros(0, dtype=np.float32)
+    if len(audio) < window_size:
+        audio = F.pad(audio, (0, window_size - len(audio)))
+    full_windows = len(audio) // window_size
+    # 端数の窓だけ0で埋めたものを別に持ち、音声全体はコピーしない
+    windows = audio[: full_windows * window_size].reshape(full_windows, window_size)
+    last_window = None
+    if full_windows < num_windows:
+        last_window = F.pad(
+            audio[full_windows * window_size :],
+            (0, num_windows * window_size - len(audio)),
+        )
+
+    num_shards = max(min(num_shards, num_windows), 1)
+    shard_windows = math.ceil(num_windows / num_shards)
+    starts = np.arange(num_shards) * shard_windows
+    ends = np.minimum(starts + shard_windows, num_windows)
+    begins = np.maximum(starts - context_windows, 0)
+    steps = int((ends - begins).max())
+
+    probs = np.zeros(num_windows, dtype=np.float32)
+    model.reset_states()
+    for step in range(steps):
+        # 終わった区間も最後の窓を入れ続けて、バッチの大きさ(状態の形)を保つ
+        indices = np.minimum(begins + step, ends - 1)
+        batch = windows.index_select(
+            0, torch.from_numpy(np.minimum(indices, full_windows - 1))
+        )
+        if last_window is not None and (indices == full_windows).any():
+            batch[torch.from_numpy(indices == full_windows)] = last_window
+        with torch.no_grad():
+            output = model(batch, sampling_rate).reshape(-1).numpy()
+        valid = (begins + step >= starts) & (begins + step < ends)
+        probs[indices[valid]] = output[valid]
+    model.reset_states()
+    return probs
+
+
+def speech_timestamps_from_probs(
+    probs: np.ndarray,
+    audio_length_samples: int,
+    sampling_rate: int = 16000,
+    window_size: int = 512,
+    threshold: float = 0.5,
+    min_speech_duration_ms: int = 250,
+    min_silence_duration_ms: int = 100,
+    speech_pad_ms: int = 30,
+) -> List[Dict[str, int]]:
+    """
+    窓毎の発話確率から、get_speech_timestamps(max_speech_duration_sなし)と
+    同じ規則で発話区間を求める
+    """
+    min_speech_samples = sampling_rate * min_speech_duration_ms / 1000
+    speech_pad_samples = sampling_rate * speech_pad_ms / 1000
+    min_silence_samples = sampling_rate * min_silence_duration_ms / 1000
+    neg_threshold = threshold - 0.15
+
+    triggered = False
+    speeches = []
+    current_speech = {}
+    temp_end = 0
+    for i, speech_prob in enumerate(probs.tolist()):
+        if speech_prob >= threshold and temp_end:
+            temp_end = 0
+
+        if speech_prob >= threshold and not triggered:
+            triggered = True
+            current_speech["start"] = window_size * i
+            continue
+
+        if speech_prob < neg_threshold and triggered:
+            if not temp_end:
+                temp_end = window_size * i
+            if window_size * i - temp_end < min_silence_samples:
+                continue
+            current_speech["end"] = temp_end
+            if current_speech["end"] - current_speech["start"] > min_speech_samples:
+                speeches.append(current_speech)
+            current_speech = {}
+            temp_end = 0
+            triggered = False
+
+    if (
+        current_speech
+        and audio_length_samples - current_speech["start"] > min_speech_samples
+    ):
+        current_speech["end"] = audio_length_samples
+        speeches.append(current_speech)
+
+    for i, speech in enumerate(speeches):
+        if i == 0:
+            speech["start"] = int(max(0, speech["start"] - speech_pad_samples))
+        if i != len(speeches) - 1:
+            silence_duration = speeches[i + 1]["start"] - speech["end"]
+            if silence_duration < 2 * speech_pad_samples:
+                speech["end"] += int(silence_duration // 2)
+                speeches[i + 1]["start"] = int(
+                    max(0, speeches[i + 1]["start"] - silence_duration // 2)
+                )
+            else:
+                speech["end"] = int(
+                    min(audio_length_samples, speech["end"] + speech_pad_samples)
+                )
+                speeches[i + 1]["start"] = int(
+                    max(0, speeches[i + 1]["start"] - speech_pad_samples)
+                )
+        else:
+            speech["end"] = int(
+                min(audio_length_samples, speech["end"] + speech_pad_samples)
+            )
+    return speeches
+
+
+class VADModelPool:
+    """
+    Silero VADのモデルを起動時にロードし、ジョブ毎に貸し出すプール
+    """
+
+    def __init__(self, repo_dir: str, size: int = 1, sampling_rate: int = 16000):
+        self.repo_dir = repo_dir
+        self.size = size
+        self.sampling_rate = sampling_rate
+        self.warmup_seconds = None
+        self._models: queue.Queue = queue.Queue()
+        self._utils = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._utils is not None
+
+    @property
+    def utils(self) -> VADUtils:
+        self.load()
+        return self._utils
+
+    def load(self) -> float:
+        """プールのサイズ分だけモデルをロードし、ロードにかかった秒数を返す"""
+        with self._lock:
+            if self._utils is not None:
+                return self.warmup_seconds
+
+            start = time.perf_counter()
+            utils = None
+            for _ in range(self.size):
+                # JITモデルは内部状態を持つため、並行ジョブ毎に別インスタンスを用意する
+                model, utils = torch.hub.load(
+                    self.repo_dir, model="silero_vad", source="local"
+                )
+                # 初回推論時の最適化を済ませておく
+                model(torch.zeros(self.window_size_samples), self.sampling_rate)
+                model.reset_states()
+                self._models.put(model)
+
+            self._utils = VADUtils(*utils)
+            self.warmup_seconds = time.perf_counter() - start
+            logger.info(
+                f"Loaded {self.size} VAD model(s) in {self.warmup_seconds:.2f}s"
+            )
+            return self.warmup_seconds
+
+    @contextmanager
+    def acquire(self, timeout: float = None):
+        """空いているモデルを1つ借りる。全て使用中なら返却されるまで待つ"""
+        self.load()
+        model = self._models.get(timeout=timeout)
+        try:
+            model.reset_states()
+            yield model
+        finally:
+            self._models.put(model)
+
+    @property
+    def window_size_samples(self) -> int:
+        return 512 if self.sampling_rate == 16000 else 256
+
+    def batched_speech_timestamps(
+        self,
+        audio: np.ndarray,
+        num_shards: int = 8,
+        context_seconds: float = 4.0,
+        num_threads: int = 0,
+    ) -> List[Dict[str, int]]:
+        """
+        get_speech_timestamps の代わりに、区間をまとめてバッチで推論する
+        区間の境界の前は状態を温めてから推論するので、結果は逐次の場合とほぼ一致する
+        """
+        window_size = self.window_size_samples
+        context_windows = math.ceil(context_seconds * self.sampling_rate / window_size)
+        with self.acquire() as model, torch_threads(batch_threads(num_threads)):
+            probs = batched_speech_probs(
+                model,
+                torch.from_numpy(audio),
+                sampling_rate=self.sampling_rate,
+                window_size=window_size,
+                num_shards=num_shards,
+                context_windows=context_windows,
+            )
+        return speech_timestamps_from_probs(
+            probs, len(audio), self.sampling_rate, window_size
+        )
+
+    def stream_speech_timestamps(
+        self,
+        filepath: str,
+        frame_seconds: int = 30,
+        min_speech_duration_ms: int = 250,
+    ) -> Iterator[Dict[str, int]]:
+        """
+        音声全体をメモリに載せずに、ffmpegから固定長のフレームを読みながら
+        VADIteratorで発話区間を検出し、確定したものから順に返す
+        """
+        window_size = self.window_size_samples
+        # フレームの境界とVADの窓がずれないようにする
+        frame_samples = frame_seconds * self.sampling_rate // window_size * window_size
+        min_speech_samples = self.sampling_rate * min_speech_duration_ms / 1000
+
+        with self.acquire() as model:
+            vad_iterator = self.utils.VADIterator(
+                model, sampling_rate=self.sampling_rate
+            )
+            speech_start = None
+            position = 0
+            # 長さの制限はヘッダではなく、デコードした長さで確かめる
+            frames = iter_pcm_frames(
+                filepath,
+                frame_samples,
+                self.sampling_rate,
+                max_seconds=settings.MAX_AUDIO_SECONDS,
+            )
+            with closing(frames):
+                for frame in frames:
+                    audio = torch.from_numpy(pcm_to_float(frame))
+                    for offset in range(0, len(audio), window_size):
+                        window = audio[offset : offset + window_size]
+                        if len(window) < window_size:
+                            window = F.pad(window, (0, window_size - len(window)))
+                        speech = vad_iterator(window)
+                        if not speech:
+                            continue
+                        if "start" in speech:
+                            speech_start = max(int(speech["start"]), 0)
+                        elif speech_start is not None:
+                            speech_end = min(int(speech["end"]), position + len(frame))
+                            if speech_end - speech_start >= min_speech_samples:
+                                yield {"start": speech_start, "end": speech_end}
+                            speech_start = None
+                    position += len(frame)
+
+            # 発話中に音声が終わった場合は末尾までを区間とする
+            if speech_start is not None and (
+                position - speech_start >= min_speech_samples
+            ):
+                yield {"start": speech_start, "end": position}
+            vad_iterator.reset_states()
+
+
+vad_pool = VADModelPool(
+    settings.VAD_REPO_DIR,
+    size=settings.VAD_POOL_SIZE,
+    sampling_rate=settings.VAD_SAMPLING_RATE,
+)
@@ -0,0 +1,44 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+from app.util.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+@contextmanager
+def timed(timings: Dict[str, float], name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+def warm_up_worker() -> Dict[str, float]:
+    """
+    ジョブで使う重いモジュール・tiktokenのBPE・VADモデルを読み込み、ステップ毎の秒数を返す
+    BPEはTIKTOKEN_CACHE_DIR、VADモデルはVAD_REPO_DIRのローカルのファイルから読む
+    FAST_STARTの場合はジョブの処理と並行して別スレッドで呼ばれる
+    """
+    timings: Dict[str, float] = {}
+    with timed(timings, "imports"):
+        import openai  # noqa: F401
+        from langchain.prompts import PromptTemplate  # noqa: F401
+
+        from app.services.model import MinutesSummarizer
+        from app.services.tokenizer import get_encoding
+        from app.services.vad import vad_pool
+
+    with timed(timings, "tiktoken"):
+        for model in set(filter(None, MinutesSummarizer.configured_models())):
+            get_encoding(model)
+
+    timings["vad"] = vad_pool.load()
+    logger.info(
+        "warm-up finished: "
+        + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+        + f" (VAD pool size: {vad_pool.size})"
+    )
+    return timings
@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+from typing import Dict
+
+import numpy as np
+
+from app.core.config import settings
+from app.util.logger import get_logger
+from app.util.metrics import metrics
+
+logger = get_logger(__name__)
+
+
+class WorkspaceQuotaExceeded(RuntimeError):
+    """ジョブの中間データがクォータを超えた"""
+
+
+def default_workspace_root() -> str:
+    """メモリ上のtmpfs(/dev/shm)があればそこを使う"""
+    if settings.WORKSPACE_DIR:
+        return settings.WORKSPACE_DIR
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm/minutes-generator"
+    return os.path.join(tempfile.gettempdir(), "minutes-generator-workspace")
+
+
+def pid_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobWorkspace:
+    """
+    ジョブ1回分の中間データを置くディレクトリ
+    ステージ毎に書いたバイト数を数え、合計がquota_bytesを超えたら失敗させる
+    withを抜けるときは例外の場合も必ず削除する
+    ワーカーが落ちて残ったものは、次にワーカーが起動したときに削除する
+    """
+
+    def __init__(self, root: str, job_id: str, quota_bytes: int):
+        self.root = root
+        self.job_id = job_id
+        self.quota_bytes = quota_bytes
+        # 持ち主のプロセスが分かるように、ディレクトリ名にpidを入れる
+        self.directory = os.path.join(root, f"{job_id}-{os.getpid()}")
+        self.stage_bytes: Dict[str, int] = {}
+        self._num_files = 0
+        self._arrays: Dict[str, str] = {}
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self.stage_bytes.values())
+
+    def __enter__(self) -> "JobWorkspace":
+        os.makedirs(self.directory, exist_ok=True)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+        for stage, num_bytes in self.stage_bytes.items():
+            metrics.inc("minutes_workspace_bytes_total", num_bytes, stage=stage)
+        logger.info(f"workspace of {self.job_id} removed: {self.stage_bytes}")
+
+    def record(self, stage: str, num_bytes: int) -> None:
+        """stageで書いたバイト数を記録する。メモリ上の中間データも同じクォータで数える"""
+        if self.total_bytes + num_bytes > self.quota_bytes:
+            raise WorkspaceQuotaExceeded(
+                f"job {self.job_id} exceeded the workspace quota "
+                f"({self.total_bytes + num_bytes} > {self.quota_bytes} bytes "
+                f"at stage {stage})"
+            )
+        self.stage_bytes[stage] = self.stage_bytes.get(stage, 0) + num_bytes
+
+    def path(self, name: str) -> str:
+        self._num_files += 1
+        return os.path.join(self.directory, f"{self._num_files:04d}_{name}")
+
+    def array(
+        self, stage: str, num_items: int, dtype=np.float32, name: str = "array"
+    ) -> np.ndarray:
+        """
+        ワークスペースのファイルをmmapした配列を返す。/dev/shmならメモリ上に置かれる
+        同じnameで確保し直した場合、前のファイルは削除する(mmap済みの配列は使える)
+        """
+        self.record(stage, num_items * np.dtype(dtype).itemsize)
+        path = self.path(name)
+        array = np.memmap(path, dtype=dtype, mode="w+", shape=(max(num_items, 1),))
+        previous = self._arrays.get(name)
+        if previous is not None:
+            os.remove(previous)
+        self._arrays[name] = path
+        return array
+
+    @staticmethod
+    def cleanup_orphans(root: str) -> None:
+        """持ち主のプロセスがいなくなったワークスペースを削除する"""
+        if not os.path.isdir(root):
+            return
+        for name in os.listdir(root):
+            _, _, pid = name.rpartition("-")
+            if not pid.isdigit() or pid_exists(int(pid)):
+                continue
+            logger.info(f"removing orphaned workspace: {name}")
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def get_job_workspace(job_id: str) -> JobWorkspace:
+    return JobWorkspace(
+        default_workspace_root(), job_id, settings.WORKSPACE_QUOTA_BYTES
+    )
@@ -0,0 +1,15 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from app.core.config import settings
+
+# デコード・VAD・エンコードなどCPUを使う処理はイベントループの外で実行する
+cpu_executor = ThreadPoolExecutor(
+    max_workers=settings.CPU_EXECUTOR_WORKERS, thread_name_prefix="cpu"
+)
+
+
+async def run_in_cpu_executor(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(cpu_executor, partial(func, *args, **kwargs))
@@ -0,0 +1,106 @@
+import struct
+from typing import NamedTuple, Optional
+
+# コンテナ毎に受け付ける拡張子
+CONTAINER_EXTENSIONS = {
+    "wav": (".wav",),
+    "mp3": (".mp3",),
+    "mp4": (".mp4", ".m4a"),
+}
+
+
+class MediaHeader(NamedTuple):
+    container: str
+    # ヘッダから分からない場合はNone
+    duration: Optional[float]
+
+
+def _iter_boxes(data: bytes, start: int, end: int):
+    """mp4のボックスを(種類, 中身の開始位置, 終了位置)で返す。途中で切れていれば止める"""
+    position = start
+    while position + 8 <= end:
+        size, box_type = struct.unpack(">I4s", data[position : position + 8])
+        header_size = 8
+        if size == 1:
+            if position + 16 > end:
+                return
+            (size,) = struct.unpack(">Q", data[position + 8 : position + 16])
+            header_size = 16
+        elif size == 0:
+            # ファイルの最後まで
+            size = end - position
+        if size < header_size:
+            return
+        yield box_type, position + header_size, position + size
+        position += size
+
+
+def _mp4_duration(data: bytes) -> Optional[float]:
+    """moovが先頭にある場合だけ、mvhdから長さを読む"""
+    for box_type, body_start, body_end in _iter_boxes(data, 0, len(data)):
+        if box_type != b"moov":
+            continue
+        for child_type, child_start, _ in _iter_boxes(
+            data, body_start, min(body_end, len(data))
+        ):
+            if child_type != b"mvhd":
+                continue
+            version = data[child_start] if child_start < len(data) else None
+            if version == 0 and child_start + 20 <= len(data):
+                timescale, duration = struct.unpack(
+                    ">II", data[child_start + 12 : child_start + 20]
+                )
+            elif version == 1 and child_start + 32 <= len(data):
+                timescale, duration = struct.unpack(
+                    ">IQ", data[child_start + 20 : child_start + 32]
+                )
+            else:
+                return None
+            return duration / timescale if timescale else None
+        return None
+    return None
+
+
+def _wav_duration(data: bytes) -> Optional[float]:
+    """
+    fmtとdataのチャンクから長さを計算する
+    RF64(4GBを超えるWAV)のdataのサイズはds64チャンクに入っている
+    """
+    byte_rate = None
+    ds64_data_size = None
+    position = 12
+    while position + 8 <= len(data):
+        chunk_id, size = struct.unpack("<4sI", data[position : position + 8])
+        if chunk_id == b"fmt " and position + 20 <= len(data):
+            (byte_rate,) = struct.unpack("<I", data[position + 16 : position + 20])
+        elif chunk_id == b"ds64" and position + 24 <= len(data):
+            (ds64_data_size,) = struct.unpack("<Q", data[position + 16 : position + 24])
+        elif chunk_id == b"data":
+            if size == 0xFFFFFFFF and ds64_data_size is not None:
+                size = ds64_data_size
+            # 録音中に書かれたファイルはサイズが入っていないことがある
+            if not byte_rate or size in (0, 0xFFFFFFFF):
+                return None
+            return size / byte_rate
+        # チャンクは2バイト境界に揃えられる
+        position += 8 + size + size % 2
+    return None
+
+
+def sniff_media(head: bytes) -> Optional[MediaHeader]:
+    """
+    ファイルの先頭のバイト列からコンテナを判定し、分かれば長さも返す
+    対応していない形式の場合はNoneを返す
+    mp3は先頭がID3タグかフレーム同期でなければならない。
+    先頭に他のデータがあるファイルは、偶然フレーム同期に見えるバイト列と区別できないので断る
+    """
+    if head[:4] in (b"RIFF", b"RF64") and head[8:12] == b"WAVE":
+        return MediaHeader("wav", _wav_duration(head))
+    if head[4:8] == b"ftyp":
+        return MediaHeader("mp4", _mp4_duration(head))
+    # ID3タグ、またはタグなしのフレーム同期
+    if head[:3] == b"ID3" or (
+        len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0
+    ):
+        return MediaHeader("mp3", None)
+    return None
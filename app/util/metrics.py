@@ -0,0 +1,249 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from app.core.config import settings
+from app.util.logger import get_logger
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metric_values (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (name, labels)
+);
+"""
+
+# 秒単位のステージの処理時間
+STAGE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+CHUNK_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+AUDIO_DURATION_BUCKETS = (60, 300, 600, 1800, 3600, 7200, 14400)
+
+# 名前: (種類, 説明)
+METRICS = {
+    "minutes_stage_seconds": (
+        "histogram",
+        "Time spent in each pipeline stage.",
+    ),
+    "minutes_tokens_total": ("counter", "Tokens used by chat completions."),
+    "minutes_cost_dollars_total": ("counter", "Estimated OpenAI cost in dollars."),
+    "minutes_audio_seconds_total": ("counter", "Audio seconds sent to whisper."),
+    "minutes_job_chunks": ("histogram", "Number of chunks per job and stage."),
+    "minutes_audio_duration_seconds": ("histogram", "Duration of uploaded audio."),
+    "minutes_jobs_finished_total": ("counter", "Finished job attempts by result."),
+    "minutes_slack_messages_total": (
+        "counter",
+        "Slack delivery attempts by result.",
+    ),
+    "minutes_workspace_bytes_total": (
+        "counter",
+        "Bytes of intermediate data written to job workspaces by stage.",
+    ),
+    "minutes_admission_rejected_total": (
+        "counter",
+        "Uploads rejected by admission control by reason.",
+    ),
+    "minutes_jobs": ("gauge", "Jobs in the queue by status."),
+    "minutes_oldest_queued_job_age_seconds": (
+        "gauge",
+        "Age of the oldest queued job.",
+    ),
+}
+
+
+def _labels_key(labels: Dict[str, str]) -> str:
+    return json.dumps(
+        {key: str(value) for key, value in labels.items()}, sort_keys=True
+    )
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for key, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class MetricsStore:
+    """
+    APIとワーカーのプロセスで共有するメトリクス
+    カウンタとヒストグラムはSQLiteに加算し、/metricsでPrometheusの形式で返す
+    記録はメモリ上で合計しておき、別スレッドがflush_seconds毎にまとめて書き込む
+    (イベントループからSQLiteのロックを待たないようにする)。記録に失敗してもジョブは止めない
+    """
+
+    def __init__(self, db_path: str, enabled: bool = True, flush_seconds: float = 1.0):
+        self.db_path = db_path
+        self.enabled = enabled
+        self.flush_seconds = flush_seconds
+        self._initialized = False
+        self._pending: Dict[Tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(SCHEMA)
+            finally:
+                conn.close()
+            self._initialized = True
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _add(self, rows: Sequence[Tuple[str, str, float]]) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            for name, labels, value in rows:
+                key = (name, labels)
+                self._pending[key] = self._pending.get(key, 0) + value
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._run_flusher, daemon=True, name="metrics-flusher"
+                )
+                self._flusher.start()
+                # 終了時に残りを書き込む(強制終了された場合は最大flush_seconds分失われる)
+                atexit.register(self.flush)
+
+    def _run_flusher(self) -> None:
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+    def flush(self) -> None:
+        """メモリ上の記録をSQLiteに加算する。失敗した分は次に書き込む"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            with self._connect() as conn:
+                conn.executemany(
+                    """
+                    INSERT INTO metric_values (name, labels, value) VALUES (?, ?, ?)
+                    ON CONFLICT (name, labels) DO UPDATE
+                    SET value = value + excluded.value
+                    """,
+                    [
+                        (name, labels, value)
+                        for (name, labels), value in pending.items()
+                    ],
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"failed to record metrics: {e}")
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + value
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        self._add([(name, _labels_key(labels), value)])
+
+    def observe(
+        self, name: str, value: float, buckets: Sequence[float], **labels: str
+    ) -> None:
+        """ヒストグラムに記録する。バケットは累積で数える"""
+        rows = [
+            (f"{name}_bucket", _labels_key({**labels, "le": le}), 1)
+            for le in [*buckets, "+Inf"]
+            if le == "+Inf" or value <= le
+        ]
+        rows.append((f"{name}_sum", _labels_key(labels), value))
+        rows.append((f"{name}_count", _labels_key(labels), 1))
+        self._add(rows)
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """ステージの処理時間を記録する。失敗した場合も記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(
+                "minutes_stage_seconds",
+                time.perf_counter() - start,
+                STAGE_BUCKETS,
+                stage=stage,
+            )
+
+    def _load(self) -> List[Tuple[str, str, float]]:
+        if not self.enabled:
+            return []
+        # このプロセスの記録は書き込んでから読む
+        self.flush()
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT name, labels, value FROM metric_values ORDER BY name, labels"
+            ).fetchall()
+
+    def samples(self, name: str) -> List[Tuple[Dict[str, str], float]]:
+        """名前が一致する値を(ラベル, 値)で返す。ベンチマークの集計に使う"""
+        return [
+            (json.loads(labels), value)
+            for sample_name, labels, value in self._load()
+            if sample_name == name
+        ]
+
+    def render(
+        self, gauges: Optional[Dict[str, List[Tuple[Dict[str, str], float]]]] = None
+    ) -> str:
+        """
+        Prometheusのテキスト形式で返す
+        gaugesにはスクレイプ時に計算した値を{名前: [(ラベル, 値)]}で渡す
+        """
+        samples: Dict[str, List[Tuple[str, Dict[str, str], float]]] = {}
+        for name, labels, value in self._load():
+            base = name
+            for suffix in ("_bucket", "_sum", "_count"):
+                if name.endswith(suffix) and name[: -len(suffix)] in METRICS:
+                    base = name[: -len(suffix)]
+            samples.setdefault(base, []).append((name, json.loads(labels), value))
+        for name, values in (gauges or {}).items():
+            samples.setdefault(name, []).extend(
+                (name, labels, value) for labels, value in values
+            )
+
+        def sort_key(sample):
+            name, labels, _ = sample
+            # バケットはleの数値順に並べる
+            others = sorted((k, v) for k, v in labels.items() if k != "le")
+            return others, name, float(labels.get("le", 0))
+
+        lines = []
+        for base in sorted(samples):
+            metric_type, description = METRICS.get(base, ("untyped", ""))
+            lines.append(f"# HELP {base} {description}")
+            lines.append(f"# TYPE {base} {metric_type}")
+            for name, labels, value in sorted(samples[base], key=sort_key):
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsStore(
+    settings.METRICS_DB_PATH,
+    enabled=settings.METRICS_ENABLED,
+    flush_seconds=settings.METRICS_FLUSH_SECONDS,
+)
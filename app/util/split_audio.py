@@ -1,47 +1,189 @@
-from typing import List, Dict
+import math
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+# 音声区間の開始・終了サンプル位置
+SEGMENT_DTYPE = np.dtype([("start", np.int64), ("end", np.int64)])
+
+
+class SegmentPlan:
+    """
+    音声区間をチャンクに割り当てた結果
+    区間はstructured arrayで持ち、チャンクはその区間配列の境界インデックスで表す
+    チャンクiの区間は segments[chunk_bounds[i] : chunk_bounds[i + 1]]
+    """
+
+    __slots__ = ("segments", "chunk_bounds", "sample_rate")
+
+    def __init__(
+        self, segments: np.ndarray, chunk_bounds: np.ndarray, sample_rate: int
+    ):
+        self.segments = segments
+        self.chunk_bounds = chunk_bounds
+        self.sample_rate = sample_rate
+
+    def __len__(self) -> int:
+        return len(self.chunk_bounds) - 1
+
+    def chunk_segments(self, index: int) -> np.ndarray:
+        return self.segments[self.chunk_bounds[index] : self.chunk_bounds[index + 1]]
+
+    def chunk_samples(self, index: int) -> int:
+        segments = self.chunk_segments(index)
+        return int((segments["end"] - segments["start"]).sum())
+
+    def chunk_views(self, audio, index: int) -> Iterator:
+        """チャンクの音声区間をコピーせずにaudioのスライスとして返す"""
+        for start, end in self.chunk_segments(index).tolist():
+            yield audio[start:end]
+
+    def to_list(self) -> List[List[Dict[str, int]]]:
+        return [
+            [
+                {"start": start, "end": end}
+                for start, end in self.chunk_segments(index).tolist()
+            ]
+            for index in range(len(self))
+        ]
+
+
+def to_segments(voiced_segments: Sequence[Dict[str, int]]) -> np.ndarray:
+    return np.fromiter(
+        ((segment["start"], segment["end"]) for segment in voiced_segments),
+        dtype=SEGMENT_DTYPE,
+        count=len(voiced_segments),
+    )
 
 
 def split_audio_voiced(
-    audio: List[int],
-    voiced_segments: List[Dict[str, int]],
+    voiced_segments: Sequence[Dict[str, int]],
     sample_rate: int = 16000,
     chunk_min: int = 5,
-) -> List[Dict]:
+) -> SegmentPlan:
     # Calculate the maximum number of samples in 5 minutes of voiced segments
     max_samples_per_5min = chunk_min * 60 * sample_rate
 
-    # Initialize the list to hold the split audio segments and the variables for the current split audio segment
-    split_audio_segments = []
-    current_voiced_samples = (
-        0  # Total number of samples in the current split audio segment
-    )
-    current_voiced_segments = (
-        []
-    )  # List to hold the voiced segments for the current split audio segment
-
-    for segment in voiced_segments:
-        # Calculate the number of samples in the current voiced segment
-        segment_samples = segment["end"] - segment["start"]
-
-        # Check if adding the current voiced segment would exceed the maximum number of samples for the current split audio segment
-        if current_voiced_samples + segment_samples > max_samples_per_5min:
-            # Append the current split audio segment to the list and reset the variables for the next split audio segment
-            split_audio_segments.append({"voiced_segments": current_voiced_segments})
-            current_voiced_samples = 0
-            current_voiced_segments = []
-
-        # Append the current voiced segment to the list for the current split audio segment
-        current_voiced_segments.append(
-            {
-                "start": segment["start"],
-                "end": segment["end"],
-                "audio": audio[segment["start"] : segment["end"]],
-            }
+    segments = to_segments(voiced_segments)
+    # 各区間までの累積サンプル数から、チャンクの境界を二分探索で求める
+    cumulative_samples = np.cumsum(segments["end"] - segments["start"])
+
+    chunk_bounds = [0]
+    while chunk_bounds[-1] < len(segments):
+        first = chunk_bounds[-1]
+        base = cumulative_samples[first - 1] if first > 0 else 0
+        last = int(
+            np.searchsorted(
+                cumulative_samples, base + max_samples_per_5min, side="right"
+            )
         )
-        current_voiced_samples += segment_samples
+        # 1区間だけで上限を超える場合もその区間を1チャンクとする
+        chunk_bounds.append(max(last, first + 1))
+
+    return SegmentPlan(segments, np.asarray(chunk_bounds, dtype=np.int64), sample_rate)
+
+
+def find_low_energy_cut(
+    audio: Optional[np.ndarray],
+    start: int,
+    end: int,
+    max_samples: int,
+    frame_samples: int = 320,
+) -> int:
+    """
+    区間の先頭からmax_samples以内で、後半の一番音量の小さいフレームの位置を返す
+    音声がない(ストリーム処理の)場合はmax_samplesの位置で切る
+    """
+    lo = start + max_samples // 2
+    hi = min(start + max_samples, end)
+    if audio is None or hi - lo < frame_samples:
+        return start + max_samples
+    window = np.asarray(audio[lo:hi], dtype=np.float32)
+    num_frames = len(window) // frame_samples
+    energy = np.square(window[: num_frames * frame_samples]).reshape(
+        num_frames, frame_samples
+    )
+    return lo + int(np.argmin(energy.mean(axis=1))) * frame_samples + frame_samples // 2
+
+
+def split_long_segments(
+    segments: np.ndarray,
+    max_samples: int,
+    audio: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """max_samplesより長い区間を、音量の小さい位置で分割する"""
+    if not ((segments["end"] - segments["start"]) > max_samples).any():
+        return segments
+    pieces = []
+    for start, end in segments.tolist():
+        while end - start > max_samples:
+            cut = find_low_energy_cut(audio, start, end, max_samples)
+            pieces.append((start, cut))
+            start = cut
+        pieces.append((start, end))
+    return np.array(pieces, dtype=SEGMENT_DTYPE)
+
 
-    # Append the last split audio segment to the list if it is not empty
-    if current_voiced_segments:
-        split_audio_segments.append({"voiced_segments": current_voiced_segments})
+def plan_balanced_chunks(
+    voiced_segments: Sequence[Dict[str, int]],
+    sample_rate: int = 16000,
+    target_seconds: float = 300,
+    num_chunks: int = 0,
+    max_segment_seconds: float = 60,
+    tolerance: float = 0.1,
+    audio: Optional[np.ndarray] = None,
+) -> SegmentPlan:
+    """
+    全ての音声区間を見て、チャンクの長さが揃うように区間の間の無音で切る
+    チャンク数はnum_chunks(0の場合は音声の長さ/target_seconds)で、
+    各境界は理想の位置からチャンクの長さのtolerance倍以内にある一番長い無音を選ぶ
+    長すぎる区間は先に分割しておくので、1区間だけの巨大なチャンクはできない
+    """
+    segments = to_segments(voiced_segments)
+    if len(segments) == 0:
+        return SegmentPlan(segments, np.zeros(1, dtype=np.int64), sample_rate)
+    segments = split_long_segments(
+        segments, int(max_segment_seconds * sample_rate), audio
+    )
+
+    num_segments = len(segments)
+    cumulative_samples = np.cumsum(segments["end"] - segments["start"])
+    total_samples = int(cumulative_samples[-1])
+    if num_chunks <= 0:
+        num_chunks = math.ceil(total_samples / (target_seconds * sample_rate))
+    num_chunks = min(max(num_chunks, 1), num_segments)
+
+    # i番目の区間の後ろで切った場合の、それまでの音声の長さと無音の長さ
+    cut_positions = cumulative_samples[:-1]
+    gaps = segments["start"][1:] - segments["end"][:-1]
+
+    chunk_bounds = [0]
+    for j in range(1, num_chunks):
+        # 残りの音声を残りのチャンク数で等分した位置を理想の境界とする
+        done_samples = int(cumulative_samples[chunk_bounds[-1] - 1]) if j > 1 else 0
+        ideal_samples = (total_samples - done_samples) / (num_chunks - j + 1)
+        center = done_samples + ideal_samples
+        # 前の境界より後ろで、残りの境界を置ける余地を残す
+        first = chunk_bounds[-1]
+        last = num_segments - 1 - (num_chunks - 1 - j)
+        lo = max(
+            int(np.searchsorted(cut_positions, center - tolerance * ideal_samples)),
+            first,
+        )
+        hi = min(
+            int(
+                np.searchsorted(
+                    cut_positions, center + tolerance * ideal_samples, side="right"
+                )
+            ),
+            last,
+        )
+        if lo < hi:
+            cut = lo + int(np.argmax(gaps[lo:hi]))
+        else:
+            # 近くに区間の切れ目がなければ理想の位置に一番近い切れ目にする
+            cut = min(max(int(np.searchsorted(cut_positions, center)), first), last - 1)
+        chunk_bounds.append(cut + 1)
+    chunk_bounds.append(num_segments)
 
-    return split_audio_segments
+    return SegmentPlan(segments, np.asarray(chunk_bounds, dtype=np.int64), sample_rate)
@@ -0,0 +1,196 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from app.core.config import settings
+from app.services.job_queue import job_queue
+from app.util.logger import get_logger
+from app.util.metrics import metrics
+
+logger = get_logger(__name__)
+
+
+def remove_input(job: dict) -> None:
+    try:
+        os.remove(job["input_path"])
+    except FileNotFoundError:
+        pass
+
+
+def run_job(job: dict) -> None:
+    from app.services.pipeline import execute_summarize
+    from app.services.workspace import get_job_workspace
+
+    job_id = job["id"]
+
+    # パイプラインがステージの途中で長く止まってもハートビートは送る
+    finished = threading.Event()
+
+    def send_heartbeat():
+        while not finished.wait(settings.JOB_STALE_SECONDS / 4):
+            job_queue.heartbeat(job_id)
+
+    heartbeat_thread = threading.Thread(target=send_heartbeat, daemon=True)
+    heartbeat_thread.start()
+
+    # 進捗・イベントの記録はSQLiteへの書き込みなので、イベントループを止めないよう
+    # 別スレッドで順に行う。記録に失敗してもジョブは続ける
+    recorder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-events")
+
+    def record(write, *args, **kwargs) -> None:
+        def run():
+            try:
+                write(job_id, *args, **kwargs)
+            except Exception:
+                logger.exception(f"failed to record {write.__name__}: {job_id}")
+
+        recorder.submit(run)
+
+    try:
+        # 中間データは試行毎のワークスペースに置き、成功しても失敗しても削除する
+        with get_job_workspace(job_id) as workspace:
+            try:
+                result = asyncio.run(
+                    execute_summarize(
+                        job["input_path"],
+                        job["filename"],
+                        job["content_hash"],
+                        prompt=job["prompt"],
+                        response_format=job["response_format"],
+                        duration=job["duration"],
+                        report=lambda stage, **info: record(
+                            job_queue.update_progress, stage, **info
+                        ),
+                        publish=lambda event_type, **data: record(
+                            job_queue.add_event, event_type, **data
+                        ),
+                        workspace=workspace,
+                        job_id=job_id,
+                    )
+                )
+            finally:
+                # 完了・失敗のイベントより前に、途中のイベントを書き終える
+                recorder.shutdown(wait=True)
+        result["workspace_bytes"] = workspace.stage_bytes
+    except Exception as e:
+        logger.exception(f"job failed: {job_id}")
+        retry = job_queue.fail(job_id, f"{e.__class__.__name__}: {e}")
+        metrics.inc(
+            "minutes_jobs_finished_total", result="retrying" if retry else "failed"
+        )
+        if not retry:
+            remove_input(job)
+    else:
+        job_queue.complete(job_id, result)
+        metrics.inc("minutes_jobs_finished_total", result="succeeded")
+        remove_input(job)
+    finally:
+        finished.set()
+        heartbeat_thread.join()
+
+
+def fail_crashed_jobs(jobs: List[dict]) -> None:
+    """ワーカーごと落ちて試行回数を使い切ったジョブの後始末"""
+    for job in jobs:
+        metrics.inc("minutes_jobs_finished_total", result="failed")
+        remove_input(job)
+
+
+def run_slack_dispatcher() -> None:
+    """Slackへの通知をoutboxから送り続ける。落ちても少し待って再開する"""
+    from app.services.slack import slack_notifier
+
+    while True:
+        try:
+            asyncio.run(slack_notifier.run())
+        except Exception:
+            logger.exception("slack dispatcher stopped, restarting")
+            time.sleep(settings.SLACK_POLL_SECONDS)
+
+
+def get_worker_id(pid: int, worker_index: int) -> str:
+    return f"{socket.gethostname()}-{pid}-{worker_index}"
+
+
+def run_worker(worker_index: int) -> None:
+    """ジョブキューからジョブを1つずつ取り出して処理し続ける"""
+    from app.services.warmup import warm_up_worker
+    from app.services.workspace import JobWorkspace, default_workspace_root
+
+    worker_id = get_worker_id(os.getpid(), worker_index)
+    # supervisorに止められた場合も、メモリ上のメトリクスを書き込んでから終了する
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    # 前に落ちたワーカーのワークスペースが残っていれば削除する
+    JobWorkspace.cleanup_orphans(default_workspace_root())
+    if settings.FAST_START:
+        # 読み込みを待たずにジョブを取り、最初のジョブのデコードと並行して読み込む
+        # VADを使う時点でロードが終わっていなければ、そこで待つ
+        threading.Thread(target=warm_up_worker, daemon=True, name="warmup").start()
+    else:
+        # 最初のジョブで待たないように、VADモデル等を先にロードしておく
+        warm_up_worker()
+    logger.info(f"worker {worker_id} started")
+
+    while True:
+        job = job_queue.claim(worker_id)
+        if job is None:
+            time.sleep(settings.WORKER_POLL_SECONDS)
+            continue
+        logger.info(f"worker {worker_id} running job {job['id']}")
+        run_job(job)
+
+
+def main() -> None:
+    """
+    ワーカープロセスを起動し、落ちたものは起動し直す
+    HTTPを受けるプロセスとは別に、python -m app.worker で起動する
+    """
+    job_queue.initialize()
+    # docker stop等で止められた場合もワーカーを終了させる
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    # 通知はジョブとは別に送るので、Slackが遅くてもワーカーは次のジョブに進める
+    threading.Thread(
+        target=run_slack_dispatcher, daemon=True, name="slack-dispatcher"
+    ).start()
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+    try:
+        while True:
+            fail_crashed_jobs(job_queue.requeue_stale(settings.JOB_STALE_SECONDS))
+            job_queue.prune_events(settings.JOB_EVENTS_TTL_SECONDS)
+            for index in range(settings.WORKER_PROCESSES):
+                process = processes.get(index)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    logger.warning(
+                        f"worker {index} exited with {process.exitcode}, restarting"
+                    )
+                    # 実行中だったジョブはハートビートの期限切れを待たずに戻す
+                    fail_crashed_jobs(
+                        job_queue.requeue_worker(get_worker_id(process.pid, index))
+                    )
+                process = context.Process(
+                    target=run_worker, args=(index,), name=f"worker-{index}"
+                )
+                process.start()
+                processes[index] = process
+            time.sleep(5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
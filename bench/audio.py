@@ -0,0 +1,85 @@
+"""
+ベンチマーク用の会議音声を合成する
+発話と無音を交互に並べ、全体に占める発話の割合をspeech_densityで指定する
+"""
+import wave
+from typing import Iterator, Optional
+
+import numpy as np
+
+SAMPLING_RATE = 16000
+
+
+def synth_utterance(rng: np.random.Generator, seconds: float) -> np.ndarray:
+    """
+    音節ごとに基本周波数とフォルマントを変えた倍音で、声に近い信号を作る
+    VADの精度は実際の音声と異なるので、speech_fileがあればそちらを使う
+    """
+    samples = int(seconds * SAMPLING_RATE)
+    out = np.zeros(samples, dtype=np.float32)
+    position = 0
+    while position < samples:
+        length = min(int(rng.uniform(0.12, 0.3) * SAMPLING_RATE), samples - position)
+        t = np.arange(length) / SAMPLING_RATE
+        f0 = rng.uniform(100, 220) * (1 + 0.05 * np.sin(2 * np.pi * 3 * t))
+        phase = 2 * np.pi * np.cumsum(f0) / SAMPLING_RATE
+        formants = rng.uniform([300, 900, 2200], [900, 2200, 3200])
+        syllable = np.zeros(length)
+        for harmonic in range(1, 25):
+            frequency = harmonic * f0.mean()
+            if frequency > SAMPLING_RATE / 2:
+                break
+            gain = sum(np.exp(-(((frequency - f) / 150) ** 2)) for f in formants)
+            syllable += (gain + 0.05) / harmonic * np.sin(harmonic * phase)
+        syllable *= np.hanning(length)
+        out[position : position + length] = syllable / (np.abs(syllable).max() + 1e-9)
+        position += length
+    out += rng.normal(0, 0.01, samples).astype(np.float32)
+    return out * 0.5
+
+
+def iter_meeting_audio(
+    seconds: float,
+    speech_density: float = 0.7,
+    seed: int = 0,
+    speech: Optional[np.ndarray] = None,
+) -> Iterator[np.ndarray]:
+    """発話と無音を順に返す。speechを渡すとその音声から切り出して発話にする"""
+    rng = np.random.default_rng(seed)
+    total = int(seconds * SAMPLING_RATE)
+    position = 0
+    while position < total:
+        utterance_seconds = rng.uniform(1.5, 12)
+        # 発話の割合がspeech_densityになるように無音の長さを決める
+        mean_gap = utterance_seconds * (1 - speech_density) / max(speech_density, 0.01)
+        gap_seconds = rng.uniform(0.5, 1.5) * mean_gap
+
+        length = min(int(utterance_seconds * SAMPLING_RATE), total - position)
+        if speech is not None and len(speech) > length:
+            start = rng.integers(0, len(speech) - length)
+            yield speech[start : start + length]
+        else:
+            yield synth_utterance(rng, length / SAMPLING_RATE)
+        position += length
+
+        gap = min(int(gap_seconds * SAMPLING_RATE), total - position)
+        if gap > 0:
+            yield rng.normal(0, 0.003, gap).astype(np.float32)
+            position += gap
+
+
+def write_meeting_audio(
+    path: str,
+    seconds: float,
+    speech_density: float = 0.7,
+    seed: int = 0,
+    speech: Optional[np.ndarray] = None,
+) -> None:
+    """長い音声もメモリに載せずにWAVへ書き出す"""
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLING_RATE)
+        for piece in iter_meeting_audio(seconds, speech_density, seed, speech):
+            pcm = np.clip(piece * 32768.0, -32768, 32767).astype("<i2")
+            wav_file.writeframesraw(pcm.tobytes())
@@ -0,0 +1,266 @@
+"""
+ベンチマーク用のOpenAI(whisper, ChatCompletion)とSlackのスタブ
+実際のAPIと同じ形のレスポンスを、設定したレイテンシとレート制限で返す
+
+    # 単体で起動し、表示された環境変数をアプリとワーカーに設定する
+    python -m bench.fakes --port 8900 --slack-error-rate 0.3
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple
+
+
+class FakeConfig(NamedTuple):
+    # whisperのレイテンシ(秒)。音声1MBあたりの時間を加える
+    whisper_latency: float = 1.0
+    whisper_latency_per_mb: float = 0.5
+    # ChatCompletionのレイテンシ(秒)。出力1トークンあたりの時間を加える
+    chat_latency: float = 1.0
+    chat_latency_per_token: float = 0.02
+    slack_latency: float = 0.2
+    # Slackが失敗を返す割合(再送の確認用)
+    slack_error_rate: float = 0.0
+    # 0の場合は制限しない
+    whisper_rpm: int = 50
+    chat_rpm: int = 500
+    chat_tpm: int = 10000
+
+
+class SlidingWindow:
+    """直近60秒の使用量でレート制限を判定する"""
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self.used = deque()
+        self.lock = threading.Lock()
+
+    def try_acquire(self, amount: int = 1) -> bool:
+        if self.per_minute <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            while self.used and now - self.used[0][0] > 60:
+                self.used.popleft()
+            if sum(used for _, used in self.used) + amount > self.per_minute:
+                return False
+            self.used.append((now, amount))
+            return True
+
+
+class FakeState:
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.whisper_requests = SlidingWindow(config.whisper_rpm)
+        self.chat_requests = SlidingWindow(config.chat_rpm)
+        self.chat_tokens = SlidingWindow(config.chat_tpm)
+        self.counts = {
+            "whisper": 0,
+            "chat": 0,
+            "slack": 0,
+            "slack_errors": 0,
+            "rate_limited": 0,
+        }
+        self.lock = threading.Lock()
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.counts[name] += 1
+
+
+def estimate_tokens(messages: list) -> int:
+    # 日本語は概ね1文字1トークン
+    return sum(len(message.get("content") or "") for message in messages) + 8
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    state: FakeState
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _send(self, status: int, body, content_type: str = "application/json"):
+        if not isinstance(body, (bytes, str)):
+            body = json.dumps(body, ensure_ascii=False)
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _rate_limited(self, kind: str) -> None:
+        self.state.count("rate_limited")
+        self._send(
+            429,
+            {
+                "error": {
+                    "message": f"Rate limit reached for {kind}",
+                    "type": kind,
+                    "code": "rate_limit_exceeded",
+                }
+            },
+        )
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.path.endswith("/audio/transcriptions"):
+            self.transcribe(body)
+        elif self.path.endswith("/chat/completions"):
+            self.chat(json.loads(body))
+        elif self.path.endswith("/files.upload"):
+            time.sleep(self.state.config.slack_latency)
+            self.state.count("slack")
+            if random.random() < self.state.config.slack_error_rate:
+                # Slack APIはエラーも200で返す
+                self.state.count("slack_errors")
+                return self._send(200, {"ok": False, "error": "internal_error"})
+            file_id = uuid.uuid4().hex
+            self._send(
+                200,
+                {"ok": True, "file": {"url_private": f"http://fake/files/{file_id}"}},
+            )
+        elif self.path.endswith("/webhook"):
+            time.sleep(self.state.config.slack_latency)
+            self.state.count("slack")
+            if random.random() < self.state.config.slack_error_rate:
+                self.state.count("slack_errors")
+                return self._send(500, "internal_error", "text/plain")
+            self._send(200, "ok", "text/plain")
+        else:
+            self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def transcribe(self, body: bytes) -> None:
+        config = self.state.config
+        if not self.state.whisper_requests.try_acquire():
+            return self._rate_limited("requests")
+        time.sleep(
+            config.whisper_latency + len(body) / 1e6 * config.whisper_latency_per_mb
+        )
+        self.state.count("whisper")
+        match = re.search(rb'name="response_format"\r\n\r\n([a-z_]+)', body)
+        response_format = match.group(1).decode() if match else "json"
+        # 音声の大きさに比例した長さの文字起こしを返す
+        text = "今日の議題について確認します。" * max(len(body) // 20000, 1)
+        if response_format == "text":
+            self._send(200, text, "text/plain")
+        else:
+            self._send(200, {"text": text})
+
+    def chat(self, request: dict) -> None:
+        config = self.state.config
+        prompt_tokens = estimate_tokens(request["messages"])
+        max_tokens = request.get("max_tokens") or 256
+        if not self.state.chat_requests.try_acquire():
+            return self._rate_limited("requests")
+        if not self.state.chat_tokens.try_acquire(prompt_tokens + max_tokens):
+            return self._rate_limited("tokens")
+
+        completion_tokens = min(max_tokens, 200)
+        time.sleep(
+            config.chat_latency + completion_tokens * config.chat_latency_per_token
+        )
+        self.state.count("chat")
+        message = {"role": "assistant", "content": "議題の要点をまとめました。" * 10}
+        if request.get("functions"):
+            message["content"] = None
+            message["function_call"] = {
+                "name": request["functions"][0]["name"],
+                "arguments": json.dumps(
+                    {
+                        "summary": "ベンチマーク用の要約です。",
+                        "summary_bullet": ["要点1", "要点2"],
+                        "decisions": ["決定事項1"],
+                        "tasks": ["タスク1"],
+                    },
+                    ensure_ascii=False,
+                ),
+            }
+        self._send(
+            200,
+            {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            },
+        )
+
+
+class FakeServer:
+    """
+    別スレッドでスタブを起動する
+    OPENAI_API_BASEは{url}/v1、SLACK_API_BASEは{url}/slack/api、
+    WEBHOOK_URLは{url}/slack/webhookに向ける
+    """
+
+    def __init__(self, config: FakeConfig, host: str = "127.0.0.1", port: int = 0):
+        self.state = FakeState(config)
+        handler = type("Handler", (FakeHandler,), {"state": self.state})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def environ(self) -> dict:
+        return {
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_API_BASE": f"{self.url}/v1",
+            "slack_token": "bench",
+            "SLACK_API_BASE": f"{self.url}/slack/api",
+            "WEBHOOK_URL": f"{self.url}/slack/webhook",
+        }
+
+    def __enter__(self) -> "FakeServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    for field, default in FakeConfig._field_defaults.items():
+        parser.add_argument(
+            f"--{field.replace('_', '-')}", type=type(default), default=default
+        )
+    args = parser.parse_args()
+    config = FakeConfig(**{field: getattr(args, field) for field in FakeConfig._fields})
+
+    with FakeServer(config, args.host, args.port) as server:
+        for key, value in server.environ().items():
+            print(f"{key}={value}")
+        try:
+            while True:
+                time.sleep(60)
+                print(json.dumps(server.state.counts))
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+"""
+OpenAIとSlackのスタブに向けて、execute_summarizeを丸ごと実行するベンチマーク
+
+    # 10分と60分の会議音声で計測し、bench/results.jsonlに追記する
+    python -m bench.run run --minutes 10 60 --label baseline
+    # 設定を変えて計測する
+    python -m bench.run run --minutes 60 --set WHISPER_CONCURRENCY=8 --label whisper8
+    # 本番と同じくapp.workerのワーカープロセス(WORKER_PROCESSES=concurrency)で実行する
+    python -m bench.run run --minutes 60 --concurrency 4 --mode workers --label workers4
+    # 結果を比較する
+    python -m bench.run compare --baseline baseline
+
+設定毎に別プロセスで実行するので、ピークRSSはその設定だけのもの
+single-process(既定)は1つのプロセスでconcurrency個のジョブを並行させるので、
+レート制限・VADのプール・CPU executorをジョブ間で共有する。本番のワーカー数での
+スループットはworkersで計測する
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, List
+
+from bench.audio import write_meeting_audio
+from bench.fakes import FakeConfig, FakeServer
+
+DEFAULT_RESULTS = os.path.join(os.path.dirname(__file__), "results.jsonl")
+AUDIO_DIR = os.path.join(tempfile.gettempdir(), "minutes-generator-bench")
+MODES = ("single-process", "workers")
+# ワーカーの読み込みが終わった時のログ
+WORKER_STARTED = re.compile(r"worker \S+ started")
+WORKER_WARMUP_TIMEOUT = 600
+
+
+def collect_result(
+    metrics, wall_seconds: float, jobs: int, errors: List[str], **extra
+) -> dict:
+    """ステージ毎の時間等はAPIと同じくメトリクスのSQLiteから集計する"""
+    succeeded = jobs - len(errors)
+    return {
+        "wall_seconds": wall_seconds,
+        "jobs": jobs,
+        "succeeded": succeeded,
+        "errors": errors,
+        "jobs_per_hour": succeeded * 3600 / wall_seconds,
+        **extra,
+        "stages": {
+            labels["stage"]: value
+            for labels, value in metrics.samples("minutes_stage_seconds_sum")
+        },
+        "tokens": sum(value for _, value in metrics.samples("minutes_tokens_total")),
+        "cost_dollars": sum(
+            value for _, value in metrics.samples("minutes_cost_dollars_total")
+        ),
+        "workspace_bytes": {
+            labels["stage"]: value
+            for labels, value in metrics.samples("minutes_workspace_bytes_total")
+        },
+        # LinuxではKB単位
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "children_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        / 1024,
+    }
+
+
+def run_config(config: dict, environ: Dict[str, str], result_queue) -> None:
+    """子プロセスで実行する。環境変数を設定してからappを読み込む"""
+    os.environ.update(environ)
+
+    import aiohttp
+
+    from app.services.pipeline import execute_summarize
+    from app.services.slack import slack_notifier
+    from app.services.vad import vad_pool
+    from app.services.workspace import get_job_workspace
+    from app.util.metrics import metrics
+
+    vad_warmup_seconds = vad_pool.load()
+
+    async def run_job():
+        # 同じ音声でもキャッシュやチェックポイントを使わないようにハッシュを変える
+        content_hash = f"bench-{uuid.uuid4().hex}"
+        with get_job_workspace(content_hash) as workspace:
+            return await execute_summarize(
+                config["audio_path"],
+                os.path.basename(config["audio_path"]),
+                content_hash=content_hash,
+                duration=config["minutes"] * 60,
+                workspace=workspace,
+                job_id=content_hash,
+            )
+
+    async def run_jobs():
+        return await asyncio.gather(
+            *[run_job() for _ in range(config["concurrency"])],
+            return_exceptions=True,
+        )
+
+    start = time.perf_counter()
+    outputs = asyncio.run(run_jobs())
+    wall_seconds = time.perf_counter() - start
+
+    async def deliver_slack():
+        # 本番ではsupervisorが送る通知を、ジョブの後にまとめて送る
+        async with aiohttp.ClientSession() as session:
+            while await slack_notifier.dispatch_once(session):
+                pass
+
+    start = time.perf_counter()
+    asyncio.run(deliver_slack())
+    slack_seconds = time.perf_counter() - start
+
+    errors = [repr(output) for output in outputs if isinstance(output, BaseException)]
+    result_queue.put(
+        collect_result(
+            metrics,
+            wall_seconds,
+            len(outputs),
+            errors,
+            vad_warmup_seconds=vad_warmup_seconds,
+            slack_seconds=slack_seconds,
+        )
+    )
+
+
+def run_workers(config: dict, environ: Dict[str, str], result_queue) -> None:
+    """
+    子プロセスで実行する。python -m app.workerのsupervisorを起動し、
+    WORKER_PROCESSES個のワーカープロセスにジョブキューからジョブを取らせる
+    ワーカーの読み込みが終わってから、全てのジョブが終わるまでを計測する
+    """
+    os.environ.update(environ)
+
+    from app.core.config import settings
+    from app.services.job_queue import FAILED, SUCCEEDED, job_queue
+    from app.services.slack import slack_notifier
+    from app.util.metrics import metrics
+
+    job_queue.initialize()
+    supervisor = subprocess.Popen(
+        [sys.executable, "-m", "app.worker"],
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    ready = threading.Semaphore(0)
+
+    def watch_log():
+        for line in supervisor.stderr:
+            if WORKER_STARTED.search(line):
+                ready.release()
+
+    threading.Thread(target=watch_log, daemon=True).start()
+    try:
+        start = time.perf_counter()
+        for _ in range(settings.WORKER_PROCESSES):
+            while not ready.acquire(timeout=1):
+                if supervisor.poll() is not None:
+                    raise RuntimeError(
+                        f"app.worker exited with {supervisor.returncode}"
+                    )
+                if time.perf_counter() - start > WORKER_WARMUP_TIMEOUT:
+                    raise RuntimeError("workers did not start")
+        worker_warmup_seconds = time.perf_counter() - start
+
+        # ワーカーは終わったジョブの入力を削除するので、ジョブ毎に置く
+        os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+        job_ids = []
+        start = time.perf_counter()
+        for _ in range(config["concurrency"]):
+            content_hash = f"bench-{uuid.uuid4().hex}"
+            input_path = os.path.join(settings.UPLOAD_DIR, f"{content_hash}.wav")
+            shutil.copyfile(config["audio_path"], input_path)
+            job_ids.append(
+                job_queue.enqueue(
+                    os.path.basename(config["audio_path"]),
+                    input_path,
+                    content_hash,
+                    prompt=None,
+                    response_format="text",
+                    duration=config["minutes"] * 60,
+                )
+            )
+        while True:
+            jobs = [job_queue.get(job_id) for job_id in job_ids]
+            if all(job["status"] in (SUCCEEDED, FAILED) for job in jobs):
+                break
+            time.sleep(0.2)
+        wall_seconds = time.perf_counter() - start
+
+        # 通知はsupervisorが送るので、送り終わるのを待つ
+        start = time.perf_counter()
+        while slack_notifier.due_messages(1):
+            time.sleep(0.2)
+        slack_seconds = time.perf_counter() - start
+    finally:
+        # ワーカーはメトリクスを書き込んでから終了する
+        supervisor.terminate()
+        supervisor.wait()
+
+    errors = [job["error"] for job in jobs if job["status"] == FAILED]
+    result = collect_result(
+        metrics,
+        wall_seconds,
+        len(jobs),
+        errors,
+        worker_warmup_seconds=worker_warmup_seconds,
+        slack_seconds=slack_seconds,
+    )
+    # ジョブはsupervisorの子プロセスで動くので、そのピークRSSを見る
+    result["peak_rss_mb"] = result["children_peak_rss_mb"]
+    result_queue.put(result)
+
+
+def wait_result(process, result_queue) -> dict:
+    """子プロセスが結果を返さずに落ちた場合も止まらないようにする"""
+    while True:
+        try:
+            return result_queue.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                return {
+                    "wall_seconds": 0,
+                    "jobs": 0,
+                    "succeeded": 0,
+                    "errors": [f"benchmark process exited with {process.exitcode}"],
+                    "jobs_per_hour": 0,
+                    "stages": {},
+                    "peak_rss_mb": 0,
+                }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def prepare_audio(minutes: float, density: float, seed: int) -> str:
+    os.makedirs(AUDIO_DIR, exist_ok=True)
+    path = os.path.join(AUDIO_DIR, f"meeting_{minutes:g}m_{density:g}_{seed}.wav")
+    if not os.path.exists(path):
+        print(f"generating {path}")
+        write_meeting_audio(path + ".tmp", minutes * 60, density, seed)
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def parse_settings(items: List[str]) -> Dict[str, str]:
+    overrides = {}
+    for item in items:
+        key, _, value = item.partition("=")
+        overrides[key] = value
+    return overrides
+
+
+def run(args: argparse.Namespace) -> None:
+    fake_config = FakeConfig(
+        whisper_latency=args.whisper_latency,
+        chat_latency=args.chat_latency,
+        whisper_rpm=args.whisper_rpm,
+        chat_rpm=args.chat_rpm,
+        chat_tpm=args.chat_tpm,
+    )
+    overrides = parse_settings(args.set)
+    context = multiprocessing.get_context("spawn")
+    revision = git_revision()
+
+    with FakeServer(fake_config) as server:
+        for minutes in args.minutes:
+            audio_path = prepare_audio(minutes, args.density, args.seed)
+            for repeat in range(args.repeat):
+                workdir = tempfile.mkdtemp(prefix="bench-")
+                environ = {
+                    **server.environ(),
+                    "CACHE_ENABLED": "true" if args.cache else "false",
+                    "CACHE_DIR": os.path.join(workdir, "cache"),
+                    "CHECKPOINT_DIR": os.path.join(workdir, "jobs"),
+                    "METRICS_DB_PATH": os.path.join(workdir, "metrics.sqlite3"),
+                    "SLACK_OUTBOX_DB_PATH": os.path.join(workdir, "slack.sqlite3"),
+                    "RATE_LIMIT_DB_PATH": os.path.join(workdir, "rate_limit.sqlite3"),
+                    "JOB_DB_PATH": os.path.join(workdir, "jobs.sqlite3"),
+                    "UPLOAD_DIR": os.path.join(workdir, "uploads"),
+                    "WORKER_PROCESSES": str(args.concurrency),
+                    **overrides,
+                }
+                config = {
+                    "audio_path": audio_path,
+                    "minutes": minutes,
+                    "density": args.density,
+                    "concurrency": args.concurrency,
+                    "mode": args.mode,
+                }
+                counts_before = dict(server.state.counts)
+
+                result_queue = context.Queue()
+                process = context.Process(
+                    target=run_workers if args.mode == "workers" else run_config,
+                    args=(config, environ, result_queue),
+                )
+                process.start()
+                result = wait_result(process, result_queue)
+                process.join()
+
+                record = {
+                    "label": args.label,
+                    "revision": revision,
+                    "timestamp": time.time(),
+                    "repeat": repeat,
+                    "config": {
+                        key: value
+                        for key, value in config.items()
+                        if key != "audio_path"
+                    },
+                    "settings": overrides,
+                    "fake": fake_config._asdict(),
+                    "requests": {
+                        key: value - counts_before[key]
+                        for key, value in server.state.counts.items()
+                    },
+                    **result,
+                }
+                with open(args.results, "a") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                print(
+                    f"[{args.label}] {minutes:g}min x{args.concurrency} "
+                    f"({args.mode}): "
+                    f"wall {result['wall_seconds']:.1f}s, "
+                    f"{result['jobs_per_hour']:.1f} jobs/h, "
+                    f"peak RSS {result['peak_rss_mb']:.0f}MB, "
+                    f"errors {len(result['errors'])}"
+                )
+
+
+def compare(args: argparse.Namespace) -> None:
+    """ラベルと条件毎に中央値を並べる。baselineがあれば比も出す"""
+    groups: Dict[tuple, List[dict]] = {}
+    with open(args.results) as f:
+        for line in f:
+            record = json.loads(line)
+            config = record["config"]
+            key = (
+                config["minutes"],
+                config["density"],
+                config["concurrency"],
+                # modeがない古い結果は1プロセスで並行させたもの
+                config.get("mode", "single-process"),
+            )
+            groups.setdefault(key, []).append(record)
+
+    for key in sorted(groups):
+        print(f"== {key[0]:g}min, density {key[1]:g}, concurrency {key[2]} ({key[3]})")
+        by_label: Dict[str, List[dict]] = {}
+        for record in groups[key]:
+            by_label.setdefault(record["label"], []).append(record)
+
+        def median(records, field):
+            return statistics.median(record[field] for record in records)
+
+        baseline = by_label.get(args.baseline)
+        stages = sorted({stage for r in groups[key] for stage in r["stages"]})
+        print(
+            f"{'label':<20}{'runs':>5}{'wall[s]':>10}{'jobs/h':>9}{'rss[MB]':>9}"
+            + "".join(f"{stage:>11}" for stage in stages)
+        )
+        for label, records in sorted(by_label.items()):
+            wall = median(records, "wall_seconds")
+            ratio = ""
+            if baseline is not None and label != args.baseline:
+                ratio = f" ({wall / median(baseline, 'wall_seconds'):.2f}x)"
+            stage_medians = [
+                statistics.median(r["stages"].get(stage, 0) for r in records)
+                for stage in stages
+            ]
+            print(
+                f"{label:<20}{len(records):>5}{wall:>10.1f}"
+                f"{median(records, 'jobs_per_hour'):>9.1f}"
+                f"{median(records, 'peak_rss_mb'):>9.0f}"
+                + "".join(f"{value:>11.1f}" for value in stage_medians)
+                + ratio
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="ベンチマークを実行する")
+    run_parser.add_argument("--label", default="default")
+    run_parser.add_argument("--minutes", type=float, nargs="+", default=[10])
+    run_parser.add_argument("--density", type=float, default=0.7, help="発話の割合")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--repeat", type=int, default=1)
+    run_parser.add_argument("--concurrency", type=int, default=1, help="同時に実行するジョブ数")
+    run_parser.add_argument(
+        "--mode",
+        choices=MODES,
+        default="single-process",
+        help="single-processは1プロセスでジョブを並行させ、workersはジョブ毎にワーカープロセスを使う",
+    )
+    run_parser.add_argument(
+        "--set", action="append", default=[], help="設定の上書き (KEY=VALUE)"
+    )
+    run_parser.add_argument("--cache", action="store_true", help="結果のキャッシュを使う")
+    run_parser.add_argument("--whisper-latency", type=float, default=1.0)
+    run_parser.add_argument("--chat-latency", type=float, default=1.0)
+    run_parser.add_argument("--whisper-rpm", type=int, default=50)
+    run_parser.add_argument("--chat-rpm", type=int, default=500)
+    run_parser.add_argument("--chat-tpm", type=int, default=10000)
+    run_parser.add_argument("--results", default=DEFAULT_RESULTS)
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare", help="結果を比較する")
+    compare_parser.add_argument("--results", default=DEFAULT_RESULTS)
+    compare_parser.add_argument("--baseline", default=None)
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+APIとワーカーの起動時間を計測するベンチマーク
+
+    # app.mainのモジュール毎のimport時間と、/heartbeatが応答するまでの時間を5回計測する
+    python -m bench.startup --runs 5
+    # ワーカーの読み込み(import・tiktoken・VADモデル)の時間も計測する
+    python -m bench.startup --runs 5 --worker
+    # app.mainが重いモジュールをimportしていたら失敗する
+    python -m bench.startup --runs 1 --check
+
+import時間はpython -X importtimeの出力から集計する。毎回新しいプロセスで計測する
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, NamedTuple
+
+# APIの起動時に読み込まれてはいけないモジュール
+HEAVY_MODULES = ("torch", "torchaudio", "openai", "langchain", "ffmpeg", "tiktoken")
+
+
+class ImportTime(NamedTuple):
+    module: str
+    self_seconds: float
+    cumulative_seconds: float
+
+
+def group_name(module: str) -> str:
+    """appのモジュールはそれぞれ、それ以外はパッケージ毎にまとめる"""
+    return module if module.startswith("app.") else module.split(".")[0]
+
+
+def bench_environ() -> Dict[str, str]:
+    """ジョブキュー等の置き場所を一時ディレクトリにする"""
+    directory = tempfile.mkdtemp(prefix="minutes-generator-startup-")
+    return {
+        **os.environ,
+        "JOB_DB_PATH": os.path.join(directory, "jobs.sqlite3"),
+        "METRICS_DB_PATH": os.path.join(directory, "metrics.sqlite3"),
+        "SLACK_OUTBOX_DB_PATH": os.path.join(directory, "slack.sqlite3"),
+        "UPLOAD_DIR": os.path.join(directory, "uploads"),
+    }
+
+
+def import_times(module: str, environ: Dict[str, str]) -> List[ImportTime]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env=environ,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+    times = []
+    for line in result.stderr.splitlines():
+        # import time:       self [us] |  cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        times.append(
+            ImportTime(name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6)
+        )
+    return times
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_to_heartbeat(environ: Dict[str, str], timeout: float = 120) -> float:
+    """hypercornを起動してから/heartbeatが200を返すまでの秒数"""
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "hypercorn",
+            "app.main:app",
+            "--bind",
+            f"127.0.0.1:{port}",
+        ],
+        env=environ,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"hypercorn exited with {process.returncode}")
+            try:
+                with urllib.request.urlopen(
+                    f"http://127.0.0.1:{port}/heartbeat", timeout=1
+                ) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            time.sleep(0.02)
+        raise RuntimeError(f"/heartbeat did not respond in {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def worker_warmup(environ: Dict[str, str]) -> Dict[str, float]:
+    """新しいプロセスでワーカーの読み込みを行い、ステップ毎の秒数を返す"""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import json; from app.services.warmup import warm_up_worker; "
+            "print(json.dumps(warm_up_worker()))",
+        ],
+        capture_output=True,
+        text=True,
+        env=environ,
+        check=True,
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--module", default="app.main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="表示するモジュールの数")
+    parser.add_argument("--worker", action="store_true", help="ワーカーの読み込みも計測する")
+    parser.add_argument("--check", action="store_true", help="重いモジュールがimportされていたら失敗する")
+    parser.add_argument("--output", default=None, help="結果を追記するJSONLのパス")
+    args = parser.parse_args()
+
+    environ = bench_environ()
+    runs = [import_times(args.module, environ) for _ in range(args.runs)]
+
+    # モジュールのまとまり毎に、それ自体のimport時間(self)の合計の中央値を出す
+    grouped: Dict[str, List[float]] = {}
+    for index, times in enumerate(runs):
+        for item in times:
+            seconds = grouped.setdefault(group_name(item.module), [0.0] * len(runs))
+            seconds[index] += item.self_seconds
+    medians = {name: statistics.median(seconds) for name, seconds in grouped.items()}
+    import_seconds = statistics.median(
+        next(item.cumulative_seconds for item in times if item.module == args.module)
+        for times in runs
+    )
+    print(
+        f"import {args.module}: {import_seconds * 1000:.0f}ms (median of {args.runs})"
+    )
+    for module, seconds in sorted(medians.items(), key=lambda item: -item[1])[
+        : args.top
+    ]:
+        print(f"  {seconds * 1000:8.1f}ms  {module}")
+
+    imported = {item.module.split(".")[0] for item in runs[0]}
+    heavy = sorted(imported.intersection(HEAVY_MODULES))
+    print(f"heavy modules imported: {', '.join(heavy) or 'none'}")
+
+    heartbeat_seconds = [time_to_heartbeat(environ) for _ in range(args.runs)]
+    print(
+        f"time to first heartbeat: {statistics.median(heartbeat_seconds):.2f}s "
+        f"(min {min(heartbeat_seconds):.2f}s, max {max(heartbeat_seconds):.2f}s)"
+    )
+
+    record = {
+        "module": args.module,
+        "runs": args.runs,
+        "import_seconds": import_seconds,
+        "module_import_seconds": medians,
+        "heavy_modules": heavy,
+        "heartbeat_seconds": statistics.median(heartbeat_seconds),
+    }
+    if args.worker:
+        warmups = [worker_warmup(environ) for _ in range(args.runs)]
+        record["worker_warmup_seconds"] = {
+            step: statistics.median(warmup[step] for warmup in warmups)
+            for step in warmups[0]
+        }
+        print(
+            "worker warm-up: "
+            + ", ".join(
+                f"{step} {seconds:.2f}s"
+                for step, seconds in record["worker_warmup_seconds"].items()
+            )
+        )
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    if args.check and heavy:
+        sys.exit(f"{args.module} imports heavy modules: {', '.join(heavy)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+逐次のVADとバッチのVADの処理時間と結果の一致を比べるベンチマーク
+
+    # 60分の会議音声で、区間数とスレッド数を変えて比べる
+    python -m bench.vad --minutes 60 --shards 4 8 16 --threads 1 4
+
+VADのモデル(VAD_REPO_DIR)が必要。OpenAIとSlackは使わない
+"""
+import argparse
+import json
+import os
+import time
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from bench.audio import SAMPLING_RATE, iter_meeting_audio
+
+
+def voiced_mask(timestamps: List[Dict[str, int]], length: int) -> np.ndarray:
+    mask = np.zeros(length, dtype=bool)
+    for timestamp in timestamps:
+        mask[timestamp["start"] : timestamp["end"]] = True
+    return mask
+
+
+def agreement(
+    serial: List[Dict[str, int]], batched: List[Dict[str, int]], length: int
+) -> dict:
+    """発話と判定したサンプルのIoUと、対応する境界のずれ(ミリ秒)"""
+    serial_mask = voiced_mask(serial, length)
+    batched_mask = voiced_mask(batched, length)
+    union = np.count_nonzero(serial_mask | batched_mask)
+    iou = np.count_nonzero(serial_mask & batched_mask) / union if union else 1.0
+    boundary_ms = None
+    if len(serial) == len(batched):
+        boundary_ms = max(
+            (
+                abs(a[key] - b[key]) * 1000 / SAMPLING_RATE
+                for a, b in zip(serial, batched)
+                for key in ("start", "end")
+            ),
+            default=0.0,
+        )
+    return {
+        "segments": len(batched),
+        "identical": serial == batched,
+        "iou": iou,
+        "max_boundary_ms": boundary_ms,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--minutes", type=float, default=60)
+    parser.add_argument("--density", type=float, default=0.7, help="発話の割合")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shards", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1])
+    parser.add_argument(
+        "--context-seconds", type=float, default=4.0, help="区間の境界の前で状態を温める長さ"
+    )
+    parser.add_argument("--output", default=None, help="結果を追記するJSONLのパス")
+    args = parser.parse_args()
+
+    from app.services.vad import vad_pool
+
+    audio = np.concatenate(
+        list(iter_meeting_audio(args.minutes * 60, args.density, args.seed))
+    )
+    vad_pool.load()
+    torch.set_num_threads(1)
+
+    start = time.perf_counter()
+    with vad_pool.acquire() as model:
+        serial = vad_pool.utils.get_speech_timestamps(
+            torch.from_numpy(audio), model, sampling_rate=SAMPLING_RATE
+        )
+    serial_seconds = time.perf_counter() - start
+    print(
+        f"serial: {serial_seconds:.1f}s, {len(serial)} segments "
+        f"({args.minutes:g}min audio)"
+    )
+
+    records = []
+    for threads in args.threads:
+        for shards in args.shards:
+            start = time.perf_counter()
+            batched = vad_pool.batched_speech_timestamps(
+                audio,
+                num_shards=shards,
+                context_seconds=args.context_seconds,
+                num_threads=threads,
+            )
+            seconds = time.perf_counter() - start
+            record = {
+                "minutes": args.minutes,
+                "density": args.density,
+                "shards": shards,
+                "threads": threads,
+                "context_seconds": args.context_seconds,
+                "serial_seconds": serial_seconds,
+                "batched_seconds": seconds,
+                "speedup": serial_seconds / seconds,
+                **agreement(serial, batched, len(audio)),
+            }
+            records.append(record)
+            print(
+                f"shards {shards:>3} threads {threads:>2}: {seconds:.1f}s "
+                f"({record['speedup']:.1f}x), {record['segments']} segments, "
+                f"IoU {record['iou']:.4f}, identical {record['identical']}"
+            )
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
+# 要約の処理はHTTPとは別のワーカープロセスで行う (WORKER_PROCESSESで数を指定)
+poetry run python -m app.worker &
+
 # http2に対応するため、hypercornにする
 # CloudRun のリソース制限により、リクエストファイルサイズは HTTP/1 で 32MB に制限されています。
 # しかし、HTTP/2 にはそのような制限はありません。
 # https://cloud.google.com/run/quotas?hl=ja
-poetry run hypercorn app.main:app --reload --bind 0.0.0.0:9000
\ No newline at end of file
+poetry run hypercorn app.main:app --reload --bind 0.0.0.0:9000
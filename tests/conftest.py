@@ -0,0 +1,36 @@
+import os
+import tempfile
+
+import pytest
+
+# 設定を読み込む前に、テストではメトリクスを記録せず、ファイルは一時ディレクトリに置く
+TEST_DIR = tempfile.mkdtemp(prefix="minutes-generator-test-")
+os.environ.setdefault("METRICS_ENABLED", "false")
+for name, path in {
+    "JOB_DB_PATH": "jobs.sqlite3",
+    "UPLOAD_DIR": "uploads",
+    "CACHE_DIR": "cache",
+    "CHECKPOINT_DIR": "jobs",
+    "SLACK_OUTBOX_DB_PATH": "slack.sqlite3",
+    "RATE_LIMIT_DB_PATH": "rate_limit.sqlite3",
+    "WORKSPACE_DIR": "workspace",
+}.items():
+    os.environ.setdefault(name, os.path.join(TEST_DIR, path))
+
+
+@pytest.fixture
+def toy_encoding(monkeypatch):
+    """BPEのダウンロードが要らない、1バイトを1トークンとするエンコーディング"""
+    import tiktoken
+
+    from app.services import model, tokenizer
+
+    encoding = tiktoken.Encoding(
+        name="toy",
+        pat_str=r"""\S+|\s+""",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={},
+    )
+    monkeypatch.setattr(tokenizer, "get_encoding", lambda model: encoding)
+    monkeypatch.setattr(model, "get_encoding", lambda model: encoding)
+    return encoding
@@ -0,0 +1,203 @@
+import asyncio
+import io
+import json
+import os
+import sqlite3
+import struct
+import wave
+from typing import List
+
+import pytest
+from fastapi import FastAPI
+
+from app.api.api import api_router
+from app.core.config import settings
+from app.services.admission import AdmissionRejected, admission
+from app.services.job_queue import job_queue
+from app.services.model import Transcriber
+
+BOUNDARY = "test-boundary"
+
+
+@pytest.fixture
+def app(monkeypatch):
+    # 先頭の確認とバッファを小さくして、数チャンクで確認が済むようにする
+    monkeypatch.setattr(settings, "UPLOAD_SNIFF_BYTES", 64)
+    monkeypatch.setattr(settings, "UPLOAD_BUFFER_BYTES", 1024)
+    # ffprobeの代わりに、ヘッダではなくファイルの大きさから長さを測る
+    monkeypatch.setattr(
+        Transcriber,
+        "get_audio_duration",
+        staticmethod(lambda path: (os.path.getsize(path) - 44) / 32000),
+    )
+    app = FastAPI()
+    app.include_router(api_router, prefix=settings.API_V1_STR)
+    return app
+
+
+def wav_bytes(seconds: float = 1.0) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(16000)
+        f.writeframes(b"\0\0" * int(16000 * seconds))
+    return buffer.getvalue()
+
+
+def multipart_body(filename: str, data: bytes) -> bytes:
+    return (
+        (
+            f"--{BOUNDARY}\r\n"
+            f'Content-Disposition: form-data; name="upload_file"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        + data
+        + f"\r\n--{BOUNDARY}--\r\n".encode()
+    )
+
+
+def split(data: bytes, size: int) -> List[bytes]:
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def call(app, method: str, path: str, chunks: List[bytes], headers=None, query=""):
+    """
+    ASGIのアプリを直接呼び、本体をchunks毎に渡す
+    応答までに読まれたチャンク数も返す(TestClientは本体をまとめて渡すので使わない)
+    """
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": True} for chunk in chunks
+    ] + [{"type": "http.request", "body": b"", "more_body": False}]
+    num_read = 0
+    sent = []
+
+    async def receive():
+        nonlocal num_read
+        if messages:
+            num_read += 1
+            return messages.pop(0)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": query.encode(),
+        "headers": [
+            (key.lower().encode(), value.encode())
+            for key, value in (headers or {}).items()
+        ],
+        "server": ("testserver", 80),
+        "client": ("testclient", 50000),
+    }
+    asyncio.run(app(scope, receive, send))
+    start = sent[0]
+    body = b"".join(message.get("body", b"") for message in sent[1:])
+    return start["status"], dict(start["headers"]), body, num_read
+
+
+def post_summarize(app, body: bytes, chunk_size: int = 256):
+    return call(
+        app,
+        "POST",
+        "/api/v1/summarize",
+        split(body, chunk_size),
+        {"content-type": f"multipart/form-data; boundary={BOUNDARY}"},
+    )
+
+
+def test_summarize_enqueues_the_uploaded_file(app):
+    data = wav_bytes()
+    status, _, body, _ = post_summarize(app, multipart_body("meeting.wav", data))
+    assert status == 200, body
+    job = job_queue.get(json.loads(body)["job_id"])
+    assert job["filename"] == "meeting.wav"
+    assert job["duration"] == pytest.approx(1.0)
+    with open(job["input_path"], "rb") as f:
+        assert f.read() == data
+
+
+def test_summarize_does_not_trust_the_header_duration(app, monkeypatch):
+    monkeypatch.setattr(settings, "MAX_AUDIO_SECONDS", 2)
+    # dataチャンクのサイズを書き換えて、3秒の音声を1秒と偽る
+    data = bytearray(wav_bytes(3.0))
+    data[40:44] = struct.pack("<I", 32000)
+    status, _, body, _ = post_summarize(app, multipart_body("meeting.wav", data))
+    assert status == 400
+    assert b"Too long" in body
+
+
+def test_summarize_rejects_bad_header_before_reading_the_rest(app):
+    chunks = split(multipart_body("meeting.wav", b"not a wav file" * 10000), 256)
+    status, _, _, num_read = post_summarize(app, b"".join(chunks))
+    assert status == 400
+    assert num_read < 5 < len(chunks)
+
+
+def test_summarize_rejects_unsupported_extension_from_part_headers(app):
+    chunks = split(multipart_body("notes.txt", wav_bytes()), 256)
+    status, _, _, num_read = post_summarize(app, b"".join(chunks))
+    assert status == 400
+    assert num_read == 1
+
+
+def test_summarize_returns_429_before_reading_the_body(app, monkeypatch):
+    def reject():
+        raise AdmissionRejected("jobs", 42)
+
+    monkeypatch.setattr(admission, "precheck", reject)
+    status, headers, _, num_read = post_summarize(
+        app, multipart_body("meeting.wav", wav_bytes())
+    )
+    assert status == 429
+    assert headers[b"retry-after"] == b"42"
+    assert num_read == 0
+
+
+def test_put_upload_stops_at_the_declared_size(app):
+    status, _, body, _ = call(
+        app, "POST", "/api/v1/uploads", [], query="filename=meeting.wav&size=1000"
+    )
+    assert status == 200
+    upload_id = json.loads(body)["upload_id"]
+
+    chunks = split(wav_bytes(), 256)
+    status, _, body, num_read = call(
+        app, "PUT", f"/api/v1/uploads/{upload_id}", chunks, query="offset=0"
+    )
+    assert status == 400
+    assert b"declared size" in body
+    assert num_read == 4 < len(chunks)
+
+
+def test_summarize_removes_the_upload_when_enqueue_fails(app, monkeypatch):
+    def locked(**kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(job_queue, "enqueue", locked)
+    os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+    before = set(os.listdir(settings.UPLOAD_DIR))
+    with pytest.raises(sqlite3.OperationalError):
+        post_summarize(app, multipart_body("meeting.wav", wav_bytes()))
+    assert set(os.listdir(settings.UPLOAD_DIR)) == before
+
+
+def test_summarize_removes_the_upload_when_admission_fails(app, monkeypatch):
+    def locked(duration):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(admission, "admit", locked)
+    os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+    before = set(os.listdir(settings.UPLOAD_DIR))
+    with pytest.raises(sqlite3.OperationalError):
+        post_summarize(app, multipart_body("meeting.wav", wav_bytes()))
+    assert set(os.listdir(settings.UPLOAD_DIR)) == before
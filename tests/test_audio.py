@@ -0,0 +1,50 @@
+import os
+import stat
+
+import numpy as np
+import pytest
+
+from app.services.audio import decode_pcm, iter_pcm_frames
+
+SAMPLE_RATE = 16000
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    """引数を記録し、環境変数で指定したバイト数の無音を出力するffmpeg"""
+    script = tmp_path / "ffmpeg"
+    script.write_text(
+        '#!/bin/sh\necho "$@" > "$FAKE_FFMPEG_ARGS"\nhead -c "$FAKE_FFMPEG_BYTES" /dev/zero\n'
+    )
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_FFMPEG_ARGS", str(tmp_path / "args"))
+
+    def output(seconds, bytes_per_sample):
+        monkeypatch.setenv(
+            "FAKE_FFMPEG_BYTES", str(int(seconds * SAMPLE_RATE) * bytes_per_sample)
+        )
+        return tmp_path / "args"
+
+    return output
+
+
+def test_decode_pcm_checks_the_decoded_length(fake_ffmpeg):
+    args = fake_ffmpeg(3, 4)
+    # ヘッダの長さ(duration)が短くても、デコードした長さで断る
+    with pytest.raises(ValueError, match="Too long"):
+        decode_pcm("in.wav", SAMPLE_RATE, duration=1, max_seconds=2)
+    assert "-t 3" in args.read_text()
+
+    fake_ffmpeg(2, 4)
+    audio = decode_pcm("in.wav", SAMPLE_RATE, duration=1, max_seconds=2)
+    assert len(audio) == 2 * SAMPLE_RATE and not np.any(audio)
+
+
+def test_iter_pcm_frames_checks_the_decoded_length(fake_ffmpeg):
+    fake_ffmpeg(3, 2)
+    frames = iter_pcm_frames("in.wav", SAMPLE_RATE, SAMPLE_RATE, max_seconds=2)
+    assert len(next(frames)) == SAMPLE_RATE
+    assert len(next(frames)) == SAMPLE_RATE
+    with pytest.raises(ValueError, match="Too long"):
+        next(frames)
@@ -0,0 +1,102 @@
+import threading
+import time
+
+from app.services.job_queue import JobQueue
+
+
+def test_prune_events_only_removes_finished_jobs(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+    old = queue.enqueue("old.wav", "old.wav", "a", None, None)
+    running = queue.enqueue("running.wav", "running.wav", "b", None, None)
+    recent = queue.enqueue("recent.wav", "recent.wav", "c", None, None)
+    for job_id in (old, running, recent):
+        queue.add_event(job_id, "transcript", chunk=0, chunks=1, text="...")
+    queue.claim("worker")
+    queue.complete(old, {})
+    queue.claim("worker")
+    queue.claim("worker")
+    queue.complete(recent, {})
+    with queue._connect() as conn:
+        conn.execute(
+            "UPDATE jobs SET finished_at = ? WHERE id = ?", (time.time() - 7200, old)
+        )
+
+    assert queue.prune_events(3600) == 2
+    assert queue.get_events(old) == []
+    assert [event["type"] for event in queue.get_events(running)] == ["transcript"]
+    assert [event["type"] for event in queue.get_events(recent)] == [
+        "transcript",
+        "succeeded",
+    ]
+
+
+def test_run_job_records_events_off_the_event_loop(monkeypatch, tmp_path):
+    from app import worker
+    from app.services import pipeline
+
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setattr(worker, "job_queue", queue)
+    writer_threads = []
+    add_event = queue.add_event
+
+    def record_thread(job_id, event_type, **data):
+        writer_threads.append(threading.current_thread())
+        add_event(job_id, event_type, **data)
+
+    monkeypatch.setattr(queue, "add_event", record_thread)
+
+    async def execute_summarize(*args, report, publish, **kwargs):
+        loop_thread = threading.current_thread()
+        for index in range(3):
+            report("map", chunk=index, chunks=3)
+            publish("summary", chunk=index, chunks=3, text=str(index))
+        return {"loop_thread": loop_thread}
+
+    monkeypatch.setattr(pipeline, "execute_summarize", execute_summarize)
+    job_id = queue.enqueue("a.wav", str(tmp_path / "a.wav"), "a", None, None)
+    job = queue.claim("worker")
+    # 結果はJSONで保存するので、スレッドは別に控える
+    results = {}
+    monkeypatch.setattr(
+        queue, "complete", lambda job_id, result: results.update(result)
+    )
+    worker.run_job(job)
+
+    assert writer_threads and results["loop_thread"] not in writer_threads
+    assert [event["data"]["chunk"] for event in queue.get_events(job_id)] == [0, 1, 2]
+    assert queue.get(job_id)["progress"] == {"stage": "map", "chunk": 2, "chunks": 3}
+
+
+def test_job_that_crashes_its_worker_fails_after_max_attempts(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), max_attempts=3)
+    job_id = queue.enqueue("a.wav", "a.wav", "a", None, None)
+
+    for attempt in range(1, 4):
+        job = queue.claim(f"worker-{attempt}")
+        assert job["id"] == job_id and job["attempts"] == attempt
+        failed = queue.requeue_worker(f"worker-{attempt}")
+        assert [job["id"] for job in failed] == ([job_id] if attempt == 3 else [])
+
+    job = queue.get(job_id)
+    assert job["status"] == "failed" and job["finished_at"] is not None
+    assert queue.claim("worker-4") is None
+    # SSEのストリームが終わるように、最後は失敗のイベントになる
+    assert [event["type"] for event in queue.get_events(job_id)] == [
+        "retrying",
+        "retrying",
+        "failed",
+    ]
+
+
+def test_requeue_stale_only_touches_stale_jobs(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), max_attempts=1)
+    stale = queue.enqueue("a.wav", "a.wav", "a", None, None)
+    queue.claim("worker")
+    with queue._connect() as conn:
+        conn.execute("UPDATE jobs SET heartbeat_at = 0 WHERE id = ?", (stale,))
+    fresh = queue.enqueue("b.wav", "b.wav", "b", None, None)
+    queue.claim("worker")
+
+    assert [job["input_path"] for job in queue.requeue_stale(60)] == ["a.wav"]
+    assert queue.get(stale)["status"] == "failed"
+    assert queue.get(fresh)["status"] == "running"
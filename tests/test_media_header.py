@@ -0,0 +1,74 @@
+import struct
+
+from app.util.media_header import MediaHeader, sniff_media
+
+
+def wav_header(seconds, riff=b"RIFF", byte_rate=32000, data_size=None):
+    fmt = struct.pack("<HHIIHH", 1, 1, 16000, byte_rate, 2, 16)
+    size = int(seconds * byte_rate) if data_size is None else data_size
+    chunks = b"LIST" + struct.pack("<I", 3) + b"abc\0"
+    chunks += b"fmt " + struct.pack("<I", len(fmt)) + fmt
+    if riff == b"RF64":
+        ds64 = struct.pack("<QQQI", 0, int(seconds * byte_rate), 0, 0)
+        chunks = b"ds64" + struct.pack("<I", len(ds64)) + ds64 + chunks
+        size = 0xFFFFFFFF
+    return (
+        riff
+        + struct.pack("<I", 0)
+        + b"WAVE"
+        + chunks
+        + b"data"
+        + struct.pack("<I", size)
+    )
+
+
+def box(box_type, body):
+    return struct.pack(">I", 8 + len(body)) + box_type + body
+
+
+def mp4_header(seconds, version=0, moov_first=True):
+    timescale = 1000
+    if version == 0:
+        mvhd = bytes(4) + struct.pack(">IIII", 0, 0, timescale, seconds * timescale)
+    else:
+        mvhd = bytes([1, 0, 0, 0]) + struct.pack(
+            ">QQIQ", 0, 0, timescale, seconds * timescale
+        )
+    ftyp = box(b"ftyp", b"M4A \0\0\0\0")
+    moov = box(b"moov", box(b"mvhd", mvhd + bytes(80)))
+    mdat = box(b"mdat", bytes(64))
+    return ftyp + (moov + mdat if moov_first else mdat + moov)
+
+
+def test_wav():
+    assert sniff_media(wav_header(90)) == MediaHeader("wav", 90)
+    # 録音中に書かれたファイル等、長さが分からない
+    assert sniff_media(wav_header(90, data_size=0)) == MediaHeader("wav", None)
+    assert sniff_media(wav_header(90)[:30]) == MediaHeader("wav", None)
+
+
+def test_rf64_wav_reads_size_from_ds64():
+    assert sniff_media(wav_header(5 * 60 * 60, riff=b"RF64")) == MediaHeader(
+        "wav", 5 * 60 * 60
+    )
+
+
+def test_mp4():
+    assert sniff_media(mp4_header(3600)) == MediaHeader("mp4", 3600)
+    assert sniff_media(mp4_header(3600, version=1)) == MediaHeader("mp4", 3600)
+    # moovがmdatの後ろにある場合は先頭だけでは分からない
+    head = mp4_header(3600, moov_first=False)[:40]
+    assert sniff_media(head) == MediaHeader("mp4", None)
+
+
+def test_mp3():
+    assert sniff_media(b"ID3\x04\x00" + bytes(100)) == MediaHeader("mp3", None)
+    assert sniff_media(b"\xff\xfb\x90\x64" + bytes(100)) == MediaHeader("mp3", None)
+
+
+def test_unsupported():
+    # 先頭にフレーム以外のデータがあるmp3は断る
+    assert sniff_media(b"\0\0junk" + b"\xff\xfb\x90\x64" + bytes(100)) is None
+    assert sniff_media(b"OggS" + bytes(100)) is None
+    assert sniff_media(b"RIFF" + bytes(4) + b"AVI ") is None
+    assert sniff_media(b"") is None
@@ -0,0 +1,49 @@
+import sqlite3
+
+import pytest
+
+from app.util.metrics import STAGE_BUCKETS, MetricsStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    # テスト中に別スレッドが書き込まないように、間隔を長くしておく
+    return MetricsStore(str(tmp_path / "metrics.sqlite3"), flush_seconds=3600)
+
+
+def test_records_are_summed_in_memory_until_flush(store, monkeypatch):
+    def fail():
+        raise AssertionError("recording must not touch SQLite")
+
+    with monkeypatch.context() as m:
+        m.setattr(store, "_connect", fail)
+        store.inc("minutes_tokens_total", 10, model="a")
+        store.inc("minutes_tokens_total", 5, model="a")
+        store.observe("minutes_stage_seconds", 0.3, STAGE_BUCKETS, stage="vad")
+
+    assert store.samples("minutes_tokens_total") == [({"model": "a"}, 15)]
+    assert store.samples("minutes_stage_seconds_count") == [({"stage": "vad"}, 1)]
+
+
+def test_failed_flush_is_retried(store, monkeypatch):
+    store.inc("minutes_jobs_finished_total", result="succeeded")
+
+    def locked():
+        raise sqlite3.OperationalError("database is locked")
+
+    with monkeypatch.context() as m:
+        m.setattr(store, "_connect", locked)
+        store.flush()
+    store.inc("minutes_jobs_finished_total", result="succeeded")
+
+    assert store.samples("minutes_jobs_finished_total") == [
+        ({"result": "succeeded"}, 2)
+    ]
+
+
+def test_processes_share_values_through_sqlite(store, tmp_path):
+    other = MetricsStore(store.db_path, flush_seconds=3600)
+    store.inc("minutes_audio_seconds_total", 60)
+    other.inc("minutes_audio_seconds_total", 30)
+    store.flush()
+    assert other.samples("minutes_audio_seconds_total") == [({}, 90)]
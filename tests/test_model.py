@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from app.services.model import MinutesSummarizer, ModelProfile
+from app.services.tokenizer import count_tokens
+
+
+def fake_chat_completion(calls):
+    """max_tokensいっぱいの長さの要約を返す(まとめ直しても短くならない最悪の場合)"""
+
+    async def create_chat_completion(cls, estimated_tokens, **kwargs):
+        calls.append(kwargs)
+        assert (
+            estimated_tokens
+            <= MinutesSummarizer.get_profile(kwargs["model"]).max_tokens
+        )
+        usage = {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+        return {
+            "choices": [{"message": {"content": "x" * kwargs["max_tokens"]}}],
+            "usage": usage,
+        }
+
+    return classmethod(create_chat_completion)
+
+
+@pytest.mark.parametrize("model", list(MinutesSummarizer.PROFILES))
+def test_any_two_merged_summaries_share_a_batch(toy_encoding, model):
+    profile = MinutesSummarizer.get_profile(model)
+    merge_max_tokens, merge_budget = MinutesSummarizer.merge_limits(profile)
+    summaries = ["x" * merge_max_tokens] * 5
+    batches = MinutesSummarizer.batch_summaries(
+        summaries, merge_budget, merge_max_tokens, model
+    )
+    # 最大の長さの要約でも、最後のバッチ以外は2つ以上入る
+    assert all(len(batch) >= 2 for batch in batches[:-1])
+    assert len(batches) <= 3
+
+
+def test_batch_summaries_keeps_order_and_splits_long_items(toy_encoding):
+    summaries = ["a" * 30, "b" * 250, "c" * 30]
+    batches = MinutesSummarizer.batch_summaries(
+        summaries, budget=208, max_item_tokens=100, model="gpt-4-0613"
+    )
+    items = [item for batch in batches for item in batch]
+    assert "".join(items) == "".join(summaries)
+    assert all(count_tokens(item, "gpt-4-0613") <= 100 for item in items)
+    for batch in batches:
+        tokens = sum(count_tokens(item, "gpt-4-0613") + 4 for item in batch)
+        assert tokens <= 208
+
+
+def test_tree_reduce_halves_full_length_merges(toy_encoding, monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        MinutesSummarizer, "create_chat_completion", fake_chat_completion(calls)
+    )
+    profile = MinutesSummarizer.get_profile("gpt-4-0613")
+    summaries = ["y" * 1500 for _ in range(40)]
+
+    reduced, _ = asyncio.run(MinutesSummarizer.tree_reduce(summaries, profile))
+
+    assert len(reduced) < len(summaries)
+    # 段毎に半分以下になるので、まとめ直しの回数は要約の数より少ない
+    assert len(calls) < len(summaries)
+
+
+def test_tree_reduce_fails_instead_of_looping(toy_encoding, monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        MinutesSummarizer, "create_chat_completion", fake_chat_completion(calls)
+    )
+    # まとめ直した要約1つでもSimpleSummaryのリクエストに収まらない
+    profile = ModelProfile("gpt-4-0613", 1000, 2600)
+    monkeypatch.setitem(MinutesSummarizer.PROFILES, "gpt-4-0613", profile)
+
+    with pytest.raises(RuntimeError, match="no progress"):
+        asyncio.run(MinutesSummarizer.tree_reduce(["z" * 3000] * 4, profile))
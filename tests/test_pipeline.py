@@ -0,0 +1,41 @@
+import asyncio
+import os
+
+import pytest
+
+from app.core.config import settings
+from app.services import pipeline
+
+TOO_LONG = settings.MAX_AUDIO_SECONDS + 1
+
+
+def run_until_probe(job_id, duration):
+    # 長すぎる音声はprobeの保存直後に失敗するので、チェックポイントだけが残る
+    with pytest.raises(ValueError):
+        asyncio.run(
+            pipeline.execute_summarize(
+                "meeting.wav",
+                "meeting.wav",
+                "same-upload",
+                duration=duration,
+                job_id=job_id,
+            )
+        )
+
+
+def test_checkpoint_is_per_job(monkeypatch):
+    run_until_probe("job-a", TOO_LONG)
+    run_until_probe("job-b", TOO_LONG)
+
+    # 同じアップロードでもジョブ毎に別の途中結果になる
+    for job_id in ("job-a", "job-b"):
+        assert os.path.exists(
+            os.path.join(settings.CHECKPOINT_DIR, job_id, "probe.json")
+        )
+
+    # やり直しは保存したprobeから再開し、音声を読み直さない
+    def probe_again(path):
+        raise AssertionError("probe should be resumed from the checkpoint")
+
+    monkeypatch.setattr(pipeline.tc, "get_audio_duration", probe_again)
+    run_until_probe("job-a", None)
@@ -0,0 +1,71 @@
+import multiprocessing
+
+import pytest
+
+from app.services.rate_limit import SQLiteTokenBucket, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """TokenBucketとSQLiteTokenBucketの時刻を進められるようにする"""
+    import app.services.rate_limit as rate_limit
+
+    now = [1000.0]
+    monkeypatch.setattr(rate_limit.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(rate_limit.time, "time", lambda: now[0])
+    return now
+
+
+def create_buckets(tmp_path):
+    return [
+        TokenBucket(60),
+        SQLiteTokenBucket(str(tmp_path / "rate_limit.sqlite3"), "test", 60),
+    ]
+
+
+@pytest.mark.parametrize("index", [0, 1])
+def test_waits_for_refill(tmp_path, clock, index):
+    bucket = create_buckets(tmp_path)[index]
+    assert bucket.reserve(60) == 0
+    # 1秒に1ずつ補充されるので、前借りした分だけ待つ
+    assert bucket.reserve(3) == pytest.approx(3)
+    assert bucket.reserve(2) == pytest.approx(5)
+    clock[0] += 10
+    assert bucket.reserve(1) == 0
+
+
+@pytest.mark.parametrize("index", [0, 1])
+def test_clamps_to_capacity(tmp_path, clock, index):
+    bucket = create_buckets(tmp_path)[index]
+    # 長く空いても上限以上は貯まらない
+    clock[0] += 3600
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(1) == pytest.approx(1)
+    # 上限を超える要求は上限分を待てば通る
+    clock[0] += 61
+    assert bucket.reserve(600) == 0
+    assert bucket.reserve(600) == pytest.approx(60)
+
+
+def reserve_in_process(db_path, result_queue):
+    bucket = SQLiteTokenBucket(db_path, "shared", 60)
+    result_queue.put([bucket.reserve(10) for _ in range(3)])
+
+
+def test_sqlite_bucket_is_shared_between_processes(tmp_path):
+    db_path = str(tmp_path / "rate_limit.sqlite3")
+    context = multiprocessing.get_context("spawn")
+    result_queue = context.Queue()
+    processes = [
+        context.Process(target=reserve_in_process, args=(db_path, result_queue))
+        for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    waits = sorted(wait for _ in processes for wait in result_queue.get(timeout=30))
+    for process in processes:
+        process.join()
+    # 4プロセスで合計120を確保するので、60を超える分は待たされる
+    assert waits[:6] == [0] * 6
+    assert all(wait > 0 for wait in waits[6:])
+    assert waits[-1] == pytest.approx(60, abs=1)
@@ -0,0 +1,60 @@
+import asyncio
+import json
+import time
+
+from app.services.slack import FAILED, PENDING, SlackNotifier
+
+
+def make_notifier(tmp_path, **kwargs):
+    return SlackNotifier(
+        str(tmp_path / "slack.sqlite3"),
+        api_base="http://127.0.0.1:1/api",
+        webhook_url="http://127.0.0.1:1/webhook",
+        token="xoxb-test",
+        channel="minutes",
+        **kwargs,
+    )
+
+
+def get_message(notifier, message_id):
+    with notifier._connect() as conn:
+        return dict(
+            conn.execute(
+                "SELECT * FROM slack_outbox WHERE id = ?", (message_id,)
+            ).fetchone()
+        )
+
+
+def test_unexpected_error_is_recorded_as_failed_attempt(tmp_path, monkeypatch):
+    notifier = make_notifier(tmp_path, max_attempts=2, backoff=60)
+
+    async def upload_without_file(session, message):
+        # files.uploadの応答に"file"がない
+        return {"ok": True}["file"]
+
+    async def post_non_json(session, blocks):
+        raise json.JSONDecodeError("Expecting value", "<html>", 0)
+
+    monkeypatch.setattr(notifier, "_upload_transcript", upload_without_file)
+    missing_file = notifier.enqueue("a.wav", [], "transcript")
+    asyncio.run(notifier.dispatch_once(None))
+
+    message = get_message(notifier, missing_file)
+    assert message["status"] == PENDING
+    assert message["attempts"] == 1
+    assert message["next_attempt_at"] > time.time() + 30
+    assert message["error"].startswith("KeyError")
+
+    # 試行回数を使い切れば失敗になり、送り直し続けない
+    monkeypatch.setattr(notifier, "_post_webhook", post_non_json)
+    with notifier._connect() as conn:
+        conn.execute(
+            "UPDATE slack_outbox SET next_attempt_at = 0, file_url = ? WHERE id = ?",
+            ("https://files.example/transcript.txt", missing_file),
+        )
+    asyncio.run(notifier.dispatch_once(None))
+
+    message = get_message(notifier, missing_file)
+    assert message["status"] == FAILED
+    assert message["attempts"] == 2
+    assert message["error"].startswith("JSONDecodeError")
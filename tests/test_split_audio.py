@@ -0,0 +1,67 @@
+import numpy as np
+
+from app.util.split_audio import plan_balanced_chunks, split_audio_voiced
+
+SAMPLE_RATE = 16000
+
+
+def speech(seconds_and_gaps):
+    """(話す秒数, 後ろの無音の秒数)の列から音声区間を作る"""
+    segments = []
+    position = 0
+    for speech_seconds, gap_seconds in seconds_and_gaps:
+        end = position + int(speech_seconds * SAMPLE_RATE)
+        segments.append({"start": position, "end": end})
+        position = end + int(gap_seconds * SAMPLE_RATE)
+    return segments
+
+
+def chunk_seconds(plan):
+    return [plan.chunk_samples(index) / SAMPLE_RATE for index in range(len(plan))]
+
+
+def test_balanced_chunks_cover_all_segments_in_order():
+    rng = np.random.default_rng(0)
+    segments = speech(zip(rng.uniform(2, 20, 200), rng.uniform(0.2, 3, 200)))
+    plan = plan_balanced_chunks(segments, SAMPLE_RATE, target_seconds=300)
+
+    bounds = plan.chunk_bounds.tolist()
+    assert bounds[0] == 0 and bounds[-1] == len(plan.segments)
+    assert all(a < b for a, b in zip(bounds, bounds[1:]))
+    total = sum(s["end"] - s["start"] for s in segments) / SAMPLE_RATE
+    assert len(plan) == int(np.ceil(total / 300))
+    assert sum(chunk_seconds(plan)) == total
+
+
+def test_balanced_chunks_are_more_even_than_greedy():
+    rng = np.random.default_rng(1)
+    segments = speech(zip(rng.uniform(2, 30, 150), rng.uniform(0.2, 2, 150)))
+    balanced = chunk_seconds(plan_balanced_chunks(segments, SAMPLE_RATE, 300))
+    greedy = chunk_seconds(split_audio_voiced(segments, SAMPLE_RATE, chunk_min=5))
+
+    # 区間が最大60秒なので、各チャンクは理想の長さから1区間分以内に収まる
+    ideal = sum(balanced) / len(balanced)
+    assert max(abs(seconds - ideal) for seconds in balanced) <= 60
+    assert np.std(balanced) < np.std(greedy)
+
+
+def test_balanced_chunks_cut_at_the_longest_silence():
+    # 理想の境界(30秒)の近くに短い無音と長い無音がある
+    segments = speech([(10, 0.3), (19, 0.3), (1, 5.0), (1, 0.3), (29, 0)])
+    plan = plan_balanced_chunks(segments, SAMPLE_RATE, num_chunks=2, tolerance=0.1)
+    assert plan.chunk_bounds.tolist() == [0, 3, 5]
+
+
+def test_long_segment_is_split_before_planning():
+    plan = plan_balanced_chunks(
+        speech([(600, 0)]), SAMPLE_RATE, target_seconds=300, max_segment_seconds=60
+    )
+    assert len(plan) == 2
+    assert (plan.segments["end"] - plan.segments["start"]).max() <= 60 * SAMPLE_RATE
+    assert chunk_seconds(plan) == [300, 300]
+
+
+def test_no_speech_and_more_chunks_than_segments():
+    assert len(plan_balanced_chunks([], SAMPLE_RATE)) == 0
+    plan = plan_balanced_chunks(speech([(5, 1), (5, 0)]), SAMPLE_RATE, num_chunks=10)
+    assert plan.chunk_bounds.tolist() == [0, 1, 2]
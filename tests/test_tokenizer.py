@@ -0,0 +1,38 @@
+import pytest
+
+from app.services.tokenizer import split_tokens
+
+
+def test_split_tokens_overlaps_and_covers_text(toy_encoding):
+    text = "abcdefghij" * 10
+    chunks = split_tokens(text, chunk_size=30, chunk_overlap=10, model="toy")
+
+    assert [chunk.num_tokens for chunk in chunks] == [30, 30, 30, 30, 20]
+    assert all(len(chunk.text) == chunk.num_tokens for chunk in chunks)
+    # 前のチャンクの最後のchunk_overlapトークンから次のチャンクが始まる
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk.text[:10] == previous.text[-10:]
+    assert chunks[0].text == text[:30]
+    assert chunks[-1].text == text[-20:]
+
+
+def test_split_tokens_does_not_cut_inside_a_character(toy_encoding):
+    # 1トークン1バイトなので、日本語の1文字(3バイト)は3トークンに分かれる
+    text = "議事録の要約" * 5
+    chunks = split_tokens(text, chunk_size=10, chunk_overlap=4, model="toy")
+
+    assert len(chunks) > 1
+    for chunk in chunks:
+        # decodeできていて、切れ目は文字の境界にずらされている
+        assert chunk.num_tokens == len(chunk.text.encode("utf-8"))
+        assert chunk.num_tokens % 3 == 0
+        assert chunk.text in text
+    assert text.endswith(chunks[-1].text)
+
+
+def test_split_tokens_edge_cases(toy_encoding):
+    assert split_tokens("", chunk_size=10, chunk_overlap=2, model="toy") == []
+    chunks = split_tokens("short", chunk_size=10, chunk_overlap=2, model="toy")
+    assert [(chunk.text, chunk.num_tokens) for chunk in chunks] == [("short", 5)]
+    with pytest.raises(ValueError):
+        split_tokens("text", chunk_size=10, chunk_overlap=10, model="toy")
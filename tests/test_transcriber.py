@@ -0,0 +1,57 @@
+import asyncio
+import io
+
+import openai
+
+from app.core.config import settings
+from app.services.checkpoint import JobCheckpoint
+from app.services.model import Transcriber
+
+
+async def chunk_files(count):
+    for index in range(count):
+        yield io.BytesIO(f"chunk-{index}".encode())
+
+
+def test_transcripts_come_back_in_chunk_order(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "OPENAI_RETRY_BACKOFF", 0)
+    calls = []
+
+    async def atranscribe(model, input_file, **kwargs):
+        name = input_file.read().decode()
+        calls.append(name)
+        # 後のチャンクほど先に終わる
+        await asyncio.sleep(0.02 * (5 - int(name.split("-")[1])))
+        if calls.count(name) == 1 and name == "chunk-2":
+            raise openai.error.APIError("temporary failure")
+        return f"text of {name}"
+
+    monkeypatch.setattr(openai.Audio, "atranscribe", atranscribe)
+    checkpoint = JobCheckpoint(str(tmp_path), "job")
+    finished = []
+    transcripts = asyncio.run(
+        Transcriber.transcribe_files(
+            chunk_files(5),
+            max_workers=5,
+            checkpoint=checkpoint,
+            on_transcribed=lambda index, transcript: finished.append(index),
+        )
+    )
+
+    assert transcripts == [f"text of chunk-{index}" for index in range(5)]
+    assert finished[0] == 4 and sorted(finished) == list(range(5))
+    # 失敗したチャンクは先頭から読み直して送り直す
+    assert calls.count("chunk-2") == 2
+    assert len(calls) == 6
+
+    # やり直しではチェックポイントの文字起こしを使い、送り直さない
+    async def no_files(count):
+        for _ in range(count):
+            yield None
+
+    calls.clear()
+    assert (
+        asyncio.run(Transcriber.transcribe_files(no_files(5), checkpoint=checkpoint))
+        == transcripts
+    )
+    assert calls == []
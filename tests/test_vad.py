@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from app.services.vad import (  # noqa: E402
+    batch_threads,
+    batched_speech_probs,
+    speech_timestamps_from_probs,
+    torch_threads,
+)
+
+WINDOW = 512
+
+
+class DecayingModel:
+    """Silero VADの代わりの状態を持つモデル。前の窓の影響は窓毎に半分になる"""
+
+    def __init__(self):
+        self.reset_states()
+
+    def reset_states(self):
+        self.state = None
+
+    def __call__(self, x, sampling_rate):
+        level = x.abs().mean(dim=-1)
+        if self.state is None or self.state.shape != level.shape:
+            self.state = torch.zeros_like(level)
+        self.state = 0.5 * self.state + level
+        return torch.sigmoid(self.state * 10 - 5).unsqueeze(-1)
+
+
+def serial_probs(model, audio):
+    """get_speech_timestampsと同じく、窓を1つずつ順に推論する"""
+    model.reset_states()
+    probs = []
+    for start in range(0, len(audio), WINDOW):
+        window = audio[start : start + WINDOW]
+        if len(window) < WINDOW:
+            window = torch.nn.functional.pad(window, (0, WINDOW - len(window)))
+        probs.append(float(model(window.unsqueeze(0), 16000)))
+    return np.array(probs, dtype=np.float32)
+
+
+@pytest.mark.parametrize("num_samples", [WINDOW * 1000 + 100, WINDOW * 1000, 300])
+def test_batched_probs_match_serial(num_samples):
+    rng = np.random.default_rng(0)
+    # 話している区間と無音が交互に続く音声
+    envelope = np.repeat(rng.random(num_samples // 4000 + 1) > 0.5, 4000)
+    audio = torch.from_numpy(
+        (rng.standard_normal(num_samples) * envelope[:num_samples]).astype(np.float32)
+    )
+    model = DecayingModel()
+
+    expected = serial_probs(model, audio)
+    batched = batched_speech_probs(model, audio, num_shards=8, context_windows=64)
+
+    assert batched.shape == expected.shape
+    np.testing.assert_allclose(batched, expected, atol=1e-5)
+
+
+def test_speech_timestamps_from_probs():
+    probs = np.array(
+        [0.1] * 10
+        # 2窓だけの無音は区間を切らない
+        + [0.9] * 20 + [0.2] * 2 + [0.9] * 18 + [0.1] * 10
+        # 250msより短い発話は捨てる
+        + [0.9] * 3 + [0.1] * 10
+        # しきい値の間の確率は発話の開始にも終了にもならない
+        + [0.45] * 27
+        # 音声の最後まで続く発話
+        + [0.9] * 20,
+        dtype=np.float32,
+    )
+    assert speech_timestamps_from_probs(probs, 61000) == [
+        {"start": 10 * WINDOW - 480, "end": 50 * WINDOW + 480},
+        {"start": 100 * WINDOW - 480, "end": 61000},
+    ]
+    assert speech_timestamps_from_probs(np.zeros(0, dtype=np.float32), 0) == []
+
+
+def test_torch_threads_restores_after_last_user(monkeypatch):
+    from app.core.config import settings
+
+    previous = torch.get_num_threads()
+    with torch_threads(2):
+        with torch_threads(2):
+            assert torch.get_num_threads() == 2
+        # 並行する他の推論が終わっても、まだ使っている間は戻さない
+        assert torch.get_num_threads() == 2
+    assert torch.get_num_threads() == previous
+
+    monkeypatch.setattr(settings, "WORKER_PROCESSES", 1)
+    monkeypatch.setattr(settings, "CPU_EXECUTOR_WORKERS", 10**6)
+    assert batch_threads(0) == 1
+    assert batch_threads(3) == 3